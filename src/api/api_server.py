@@ -5,13 +5,15 @@ import logging
 import json
 import subprocess
 import sys
-import threading
 import re
 import asyncio
 import os
 import time
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import FastAPI, UploadFile, File, Form, Request, HTTPException, WebSocket, WebSocketDisconnect, Query
-from fastapi.responses import HTMLResponse, JSONResponse, FileResponse
+from fastapi.responses import HTMLResponse, JSONResponse, FileResponse, ORJSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from pathlib import Path
@@ -25,9 +27,13 @@ import psutil
 # 將專案的 src 目錄新增到 Python 的搜尋路徑中，
 # 這樣才能正確找到 db.client 等模組。
 SRC_DIR = Path(__file__).resolve().parent.parent
-sys.path.insert(0, str(SRC_DIR))
+if str(SRC_DIR) not in sys.path:
+    sys.path.insert(0, str(SRC_DIR))
 
 from db.client import get_client
+from db.database import close_connection_pool
+from core.rendering import preload_templates
+from core import analysis_cache
 
 # --- JULES 於 2025-08-09 的修改：設定應用程式全域時區 ---
 # 為了確保所有日誌和資料庫時間戳都使用一致的時區，我們在應用程式啟動的
@@ -76,27 +82,38 @@ def setup_database_logging():
 # --- WebSocket 連線管理器 ---
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: list[WebSocket] = []
+        # 使用 set 讓新增與移除連線都是 O(1)，廣播順序對前端沒有意義
+        self.active_connections: set[WebSocket] = set()
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        self.active_connections.add(websocket)
         log.info(f"新用戶端連線。目前共 {len(self.active_connections)} 個連線。")
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        # discard: 同一個連線可能在廣播失敗與 WebSocketDisconnect 中被移除兩次
+        self.active_connections.discard(websocket)
         log.info(f"一個用戶端離線。目前共 {len(self.active_connections)} 個連線。")
 
     async def send_personal_message(self, message: str, websocket: WebSocket):
         await websocket.send_text(message)
 
     async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            await connection.send_text(message)
+        # 迭代快照，讓傳送失敗時可以安全地移除連線
+        for connection in list(self.active_connections):
+            try:
+                await connection.send_text(message)
+            except Exception as e:
+                log.warning(f"廣播訊息失敗，移除該連線: {e}")
+                self.disconnect(connection)
 
     async def broadcast_json(self, data: dict):
-        for connection in self.active_connections:
-            await connection.send_json(data)
+        for connection in list(self.active_connections):
+            try:
+                await connection.send_json(data)
+            except Exception as e:
+                log.warning(f"廣播 JSON 訊息失敗，移除該連線: {e}")
+                self.disconnect(connection)
 
 manager = ConnectionManager()
 
@@ -106,20 +123,71 @@ manager = ConnectionManager()
 # 客戶端內部有重試機制，會等待 DB 管理者服務就緒
 db_client = get_client()
 
+# --- DB 執行器 ---
+# db_client 的每個方法都是同步的 socket 往返，若在 async 端點中直接呼叫，
+# 會在等待資料庫回應期間阻塞事件迴圈，拖慢所有 WebSocket 連線。
+# 因此統一透過一個專用的小型執行緒池來執行。
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="db")
+
+async def run_db(func, *args, **kwargs):
+    """在 DB_EXECUTOR 中執行一個阻塞的 db_client 呼叫並等待其結果。"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(DB_EXECUTOR, functools.partial(func, *args, **kwargs))
+
+# --- 背景工作執行器 ---
+# 模型下載、轉錄與 YouTube 處理等長時間工作統一提交到一個有上限的執行緒池，
+# 避免突發大量請求時無限制地建立執行緒；超出上限的工作會排隊等待。
+# 這些工作大多在等待子程序 (communicate / readline)，不佔用 CPU，因此名額固定而不隨核心數縮減，
+# 避免少核心的主機上一個長時間工作就擋住所有轉錄與模型下載 (可透過 JOB_MAX_WORKERS 環境變數調整)。
+JOB_MAX_WORKERS = int(os.environ.get("JOB_MAX_WORKERS", "4"))
+JOB_EXECUTOR = ThreadPoolExecutor(max_workers=JOB_MAX_WORKERS, thread_name_prefix="job")
+# 已提交但尚未結束的工作數 (包含排隊中的工作)
+_active_jobs = 0
+_active_jobs_lock = threading.Lock()
+
+def _release_job(_future):
+    global _active_jobs
+    with _active_jobs_lock:
+        _active_jobs -= 1
+
+def _submit_job(func, loop: asyncio.AbstractEventLoop, queued_message: dict):
+    """
+    將工作提交到背景工作執行器。所有工作執行緒都忙碌時，工作無法立即開始，
+    先廣播 queued_message 讓前端顯示「排隊中」，而不是毫無回應地等待。
+    """
+    global _active_jobs
+    with _active_jobs_lock:
+        queued = _active_jobs >= JOB_MAX_WORKERS
+        _active_jobs += 1
+    if queued:
+        log.info(f"背景工作執行緒已滿 ({JOB_MAX_WORKERS})，工作排隊等待中。")
+        asyncio.run_coroutine_threadsafe(manager.broadcast_json(queued_message), loop)
+    JOB_EXECUTOR.submit(func).add_done_callback(_release_job)
+
+# 進度類 WebSocket 訊息的最小間隔 (秒)，即每個任務每秒最多 10 則
+PROGRESS_BROADCAST_INTERVAL = 0.1
+
 # --- FastAPI Lifespan Manager ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # 在應用程式啟動時執行的程式碼
     setup_database_logging()
     log.info("資料庫日誌處理器已透過 lifespan 事件設定。")
+    # 預先編譯頁面樣板，避免第一個頁面請求承擔編譯成本
+    preload_templates()
+    # 清理超過保存期限或數量上限的分析快取 (在執行緒中進行，快取很大時也不會延遲事件迴圈)
+    await asyncio.to_thread(analysis_cache.prune)
     yield
-    # 可以在此處加入應用程式關閉時執行的程式碼
+    # 應用程式關閉時，釋放路由模組共用的資料庫連線池、處理程序池、下載與分析執行緒池
+    close_connection_pool()
+    page3_processor.shutdown_process_pool()
+    page2_downloader.shutdown_download_executor()
+    page4_analyzer.shutdown_analysis_executor()
 
 # --- FastAPI 應用實例 ---
-app = FastAPI(title="鳳凰音訊轉錄儀 API (v3 - 重構)", version="3.0", lifespan=lifespan)
+# 預設以 orjson 序列化回應；未明確指定回應類別的端點 (直接 return dict/list) 也會使用它
+app = FastAPI(title="鳳凰音訊轉錄儀 API (v3 - 重構)", version="3.0", lifespan=lifespan, default_response_class=ORJSONResponse)
 app.state.manager = manager
-# 建立一個全域信號量，限制同時執行的 AI 分析任務數量為 3
-app.state.analysis_semaphore = asyncio.Semaphore(3)
 
 # --- 中介軟體 (Middleware) ---
 # JULES: 新增 CORS 中介軟體以允許來自瀏覽器腳本的跨來源請求
@@ -152,6 +220,9 @@ async def add_server_port_to_state(request: Request, call_next):
 # --- 整合模組化路由 ---
 from api.routes import ui, page1_ingestion, page2_downloader, page3_processor, page4_analyzer, page5_backup, page6_keys, page7_prompts, page8_details
 
+# 建立一個全域信號量，限制同時執行的 AI 分析任務數量 (與分析執行緒池的大小相同)
+app.state.analysis_semaphore = asyncio.Semaphore(page4_analyzer.ANALYSIS_CONCURRENCY)
+
 # UI 路由 (提供 HTML 頁面)
 app.include_router(ui.router, tags=["UI"])
 
@@ -234,6 +305,41 @@ def convert_to_media_url(absolute_path_str: str) -> str:
         return absolute_path_str
 
 
+# 完成通知中內嵌的逐字稿預覽上限；完整內容可透過 transcript_path 下載。
+TRANSCRIPT_PREVIEW_BYTES = 64 * 1024
+
+def read_transcript_preview(file_path: Path, max_bytes: int = TRANSCRIPT_PREVIEW_BYTES) -> tuple[str, bool]:
+    """
+    只讀取逐字稿檔案開頭的 `max_bytes` 位元組作為預覽，避免將長篇逐字稿整份解碼進記憶體。
+
+    :return: (預覽文字, 是否被截斷)
+    """
+    with open(file_path, 'rb') as f:
+        raw = f.read(max_bytes + 1)
+    truncated = len(raw) > max_bytes
+    # 截斷處可能切在多位元組字元中間，以 'ignore' 捨棄不完整的尾端
+    preview = raw[:max_bytes].decode('utf-8', errors='ignore' if truncated else 'replace')
+    return preview.strip(), truncated
+
+
+def parse_last_json_line(output: str) -> dict:
+    """
+    解析子程序 stdout 中最後一行 JSON 物件。
+    工具腳本可能先輸出進度等其他行，最終結果固定是最後一個 JSON 物件；
+    由尾端往前尋找，只需解析最後一行，而不是整個輸出緩衝區。
+
+    :raises ValueError: 找不到任何 JSON 物件行時。
+    """
+    end = len(output)
+    while end > 0:
+        start = output.rfind('\n', 0, end) + 1
+        line = output[start:end].strip()
+        if line.startswith('{'):
+            return json.loads(line)
+        end = start - 1
+    raise ValueError("子程序輸出中找不到 JSON 結果。")
+
+
 # --- API 端點 ---
 
 @app.get("/", response_class=HTMLResponse)
@@ -309,7 +415,7 @@ async def create_transcription_task(
     if model_is_present:
         # 模型已存在，直接建立轉錄任務
         log.info(f"✅ 模型 '{model_size}' 已存在，直接建立轉錄任務: {transcribe_task_id}")
-        db_client.add_task(transcribe_task_id, json.dumps(transcription_payload), task_type='transcribe')
+        await run_db(db_client.add_task, transcribe_task_id, json.dumps(transcription_payload), task_type='transcribe')
         # JULES: 修正 API 回應，使其與前端的通用處理邏輯一致，補上 type 欄位
         return {"task_id": transcribe_task_id, "type": "transcribe"}
     else:
@@ -318,9 +424,9 @@ async def create_transcription_task(
         log.warning(f"⚠️ 模型 '{model_size}' 不存在。建立下載任務 '{download_task_id}' 和依賴的轉錄任務 '{transcribe_task_id}'")
 
         download_payload = {"model_size": model_size}
-        db_client.add_task(download_task_id, json.dumps(download_payload), task_type='download')
+        await run_db(db_client.add_task, download_task_id, json.dumps(download_payload), task_type='download')
 
-        db_client.add_task(transcribe_task_id, json.dumps(transcription_payload), task_type='transcribe', depends_on=download_task_id)
+        await run_db(db_client.add_task, transcribe_task_id, json.dumps(transcription_payload), task_type='transcribe', depends_on=download_task_id)
 
         # 我們回傳轉錄任務的 ID，讓前端可以追蹤最終結果
         return JSONResponse(content={"tasks": [
@@ -335,7 +441,7 @@ async def get_task_status_endpoint(task_id: str):
     根據任務 ID，從資料庫查詢任務狀態。
     """
     log.debug(f"🔍 正在查詢任務狀態: {task_id}")
-    status_info = db_client.get_task_status(task_id)
+    status_info = await run_db(db_client.get_task_status, task_id)
 
     if not status_info:
         log.warning(f"❓ 找不到任務 ID: {task_id}")
@@ -443,7 +549,7 @@ async def get_all_tasks_endpoint():
     """
     獲取所有任務的列表，用於前端展示。
     """
-    tasks = db_client.get_all_tasks()
+    tasks = await run_db(db_client.get_all_tasks)
     # 嘗試解析 payload 和 result 中的 JSON 字串
     for task in tasks:
         try:
@@ -471,7 +577,7 @@ async def get_system_logs_endpoint(
     """
     log.info(f"API: 正在查詢系統日誌 (Levels: {levels}, Sources: {sources})")
     try:
-        logs = db_client.get_system_logs(levels=levels, sources=sources)
+        logs = await run_db(db_client.get_system_logs, levels=levels, sources=sources)
         return JSONResponse(content=logs)
     except Exception as e:
         log.error(f"❌ 查詢系統日誌時 API 出錯: {e}", exc_info=True)
@@ -483,7 +589,7 @@ async def download_transcript(task_id: str):
     """
     根據任務 ID 下載轉錄結果檔案。
     """
-    task = db_client.get_task_status(task_id)
+    task = await run_db(db_client.get_task_status, task_id)
     if not task:
         raise HTTPException(status_code=404, detail="找不到指定的任務 ID。")
 
@@ -556,7 +662,7 @@ async def rename_task_file(task_id: str, request: Request):
         if not new_filename_base:
             raise HTTPException(status_code=400, detail="請求中未提供 'new_filename'。")
 
-        task = db_client.get_task_status(task_id)
+        task = await run_db(db_client.get_task_status, task_id)
         if not task:
             raise HTTPException(status_code=404, detail="找不到指定的任務 ID。")
         if task['status'] != '已完成':
@@ -598,7 +704,7 @@ async def rename_task_file(task_id: str, request: Request):
         result_data["output_path"] = convert_to_media_url(str(new_path))
         result_data["video_title"] = new_filename_base
 
-        db_client.update_task_status(task_id, '已完成', json.dumps(result_data))
+        await run_db(db_client.update_task_status, task_id, '已完成', json.dumps(result_data))
         log.info(f"已更新資料庫中任務 {task_id} 的結果。")
 
         return {"status": "success", "message": "檔案重新命名成功。", "new_filename": new_filename_base}
@@ -777,7 +883,7 @@ async def process_youtube_urls(request: Request):
         if download_only:
             # JULES'S NEW FEATURE: Pass download_type to payload
             task_payload = {"url": url, "output_dir": str(UPLOADS_DIR), "custom_filename": filename, "download_type": download_type}
-            db_client.add_task(task_id, json.dumps(task_payload), task_type='youtube_download_only')
+            await run_db(db_client.add_task, task_id, json.dumps(task_payload), task_type='youtube_download_only')
             tasks.append({"url": url, "task_id": task_id})
         else:
             download_task_id = task_id
@@ -794,8 +900,8 @@ async def process_youtube_urls(request: Request):
                 "api_key": api_key # 將金鑰存入任務酬載
             }
 
-            db_client.add_task(download_task_id, json.dumps(download_payload), task_type='youtube_download')
-            db_client.add_task(process_task_id, json.dumps(process_payload), task_type='gemini_process', depends_on=download_task_id)
+            await run_db(db_client.add_task, download_task_id, json.dumps(download_payload), task_type='youtube_download')
+            await run_db(db_client.add_task, process_task_id, json.dumps(process_payload), task_type='gemini_process', depends_on=download_task_id)
 
             # JULES'S FIX: Return both task IDs so the frontend can track the full chain.
             tasks.append({
@@ -810,7 +916,7 @@ async def process_youtube_urls(request: Request):
 
 def trigger_model_download(model_size: str, loop: asyncio.AbstractEventLoop):
     """
-    在一個單獨的執行緒中執行模型下載，並透過 WebSocket 回報結果。
+    在背景工作執行器中執行模型下載，並透過 WebSocket 回報結果。
     這個版本會逐行讀取 stdout 來獲取即時的 JSON 進度更新。
     """
     def _download_in_thread():
@@ -829,11 +935,17 @@ def trigger_model_download(model_size: str, loop: asyncio.AbstractEventLoop):
             )
 
             # 逐行讀取 stdout 以獲取進度更新
+            # 進度行可能每秒數百筆，每筆都跨執行緒排入事件迴圈並廣播並無必要；
+            # 以 PROGRESS_BROADCAST_INTERVAL 節流，最終的完成/失敗訊息則一律送出。
+            last_broadcast = 0.0
             if process.stdout:
                 for line in iter(process.stdout.readline, ''):
                     line = line.strip()
                     if not line:
                         continue
+                    now = time.monotonic()
+                    if now - last_broadcast < PROGRESS_BROADCAST_INTERVAL:
+                        continue
                     try:
                         data = json.loads(line)
                         # 建立 WebSocket 訊息
@@ -846,6 +958,7 @@ def trigger_model_download(model_size: str, loop: asyncio.AbstractEventLoop):
                             }
                         }
                         asyncio.run_coroutine_threadsafe(manager.broadcast_json(message), loop)
+                        last_broadcast = now
                     except json.JSONDecodeError:
                         log.warning(f"[執行緒] 無法解析來自 transcriber 的下載進度 JSON: {line}")
 
@@ -876,14 +989,16 @@ def trigger_model_download(model_size: str, loop: asyncio.AbstractEventLoop):
             }
             asyncio.run_coroutine_threadsafe(manager.broadcast_json(message), loop)
 
-    # 建立並啟動執行緒
-    thread = threading.Thread(target=_download_in_thread)
-    thread.start()
+    # 提交到背景工作執行器
+    _submit_job(_download_in_thread, loop, {
+        "type": "DOWNLOAD_STATUS",
+        "payload": {"model": model_size, "status": "queued"}
+    })
 
 
 def trigger_transcription(task_id: str, file_path: str, model_size: str, language: Optional[str], beam_size: int, loop: asyncio.AbstractEventLoop, original_filename: Optional[str] = None):
     """
-    在一個單獨的執行緒中執行轉錄，並透過 WebSocket 即時串流結果。
+    在背景工作執行器中執行轉錄，並透過 WebSocket 即時串流結果。
     """
     def _transcribe_in_thread():
         display_name = original_filename or file_path
@@ -947,13 +1062,16 @@ def trigger_transcription(task_id: str, file_path: str, model_size: str, languag
 
             if process.returncode == 0:
                 log.info(f"✅ [執行緒] 轉錄任務 '{task_id}' 成功完成。")
-                final_transcript = output_file_path.read_text(encoding='utf-8').strip()
+                # 只內嵌有上限的預覽，完整逐字稿由前端透過 transcript_path 取得
+                final_transcript, is_truncated = read_transcript_preview(output_file_path)
 
-                # 問題二：將檔案系統路徑轉換為可存取的 URL
+                # 問題二：將檔案系統路徑轉換為可存取的 URL (只轉換一次，兩個欄位共用)
+                transcript_url = convert_to_media_url(str(output_file_path))
                 final_result_obj = {
                     "transcript": final_transcript,
-                    "transcript_path": convert_to_media_url(str(output_file_path)),
-                    "output_path": convert_to_media_url(str(output_file_path)) # 增加一個通用的 output_path
+                    "transcript_truncated": is_truncated,
+                    "transcript_path": transcript_url,
+                    "output_path": transcript_url # 增加一個通用的 output_path
                 }
                 db_client.update_task_status(task_id, 'completed', json.dumps(final_result_obj))
                 log.info(f"✅ [執行緒] 已將任務 {task_id} 的狀態和結果更新至資料庫。")
@@ -980,12 +1098,14 @@ def trigger_transcription(task_id: str, file_path: str, model_size: str, languag
             }
             asyncio.run_coroutine_threadsafe(manager.broadcast_json(error_message), loop)
 
-    thread = threading.Thread(target=_transcribe_in_thread)
-    thread.start()
+    _submit_job(_transcribe_in_thread, loop, {
+        "type": "TRANSCRIPTION_STATUS",
+        "payload": {"task_id": task_id, "status": "queued", "filename": original_filename or Path(file_path).name}
+    })
 
 
 def trigger_youtube_processing(task_id: str, loop: asyncio.AbstractEventLoop):
-    """在一個單獨的執行緒中執行 YouTube 處理流程（已更新為彈性模式）。"""
+    """在背景工作執行器中執行 YouTube 處理流程（已更新為彈性模式）。"""
     def _process_in_thread():
         log.info(f"🧵 [執行緒] 開始處理 YouTube 任務鏈，起始 ID: {task_id}")
 
@@ -1055,8 +1175,8 @@ def trigger_youtube_processing(task_id: str, loop: asyncio.AbstractEventLoop):
                 else:
                     raise RuntimeError(f"youtube_downloader.py 執行失敗，返回碼 {process_dl.returncode}。錯誤: {stderr_output}")
 
-            # 如果成功，stdout 應該包含最終的 JSON 結果
-            download_result = json.loads(stdout_output)
+            # 如果成功，stdout 的最後一行應該是最終的 JSON 結果
+            download_result = parse_last_json_line(stdout_output)
             media_file_path = download_result['output_path'] # This is an absolute path
             video_title = download_result.get('video_title', '無標題影片')
             log.info(f"✅ [執行緒] YouTube 媒體下載完成: {media_file_path}")
@@ -1133,10 +1253,14 @@ def trigger_youtube_processing(task_id: str, loop: asyncio.AbstractEventLoop):
                     raise RuntimeError(f"Gemini processor failed with exit code {process_gemini.returncode}. Stderr: {stderr_output}")
 
             process_result = json.loads(stdout_output)
-            # 問題二：將結果中的所有檔案路徑轉換為 URL
-            for key in ["output_path", "html_report_path", "pdf_report_path"]:
-                 if key in process_result and process_result[key]:
-                    process_result[key] = convert_to_media_url(process_result[key])
+            # 問題二：將結果中的所有檔案路徑轉換為 URL，相同路徑只轉換一次
+            url_cache = {}
+            for key in ("output_path", "html_report_path", "pdf_report_path"):
+                path_value = process_result.get(key)
+                if path_value:
+                    if path_value not in url_cache:
+                        url_cache[path_value] = convert_to_media_url(path_value)
+                    process_result[key] = url_cache[path_value]
 
             db_client.update_task_status(dependent_task_id, '已完成', json.dumps(process_result))
             log.info(f"✅ [執行緒] Gemini AI 處理完成。")
@@ -1170,8 +1294,10 @@ def trigger_youtube_processing(task_id: str, loop: asyncio.AbstractEventLoop):
                 "payload": {"task_id": failed_task_id, "status": "failed", **error_payload}
             }), loop)
 
-    thread = threading.Thread(target=_process_in_thread)
-    thread.start()
+    _submit_job(_process_in_thread, loop, {
+        "type": "YOUTUBE_STATUS",
+        "payload": {"task_id": task_id, "status": "queued", "message": "排隊中，等待其他工作完成..."}
+    })
 
 
 @app.post("/api/debug/clear_tasks", status_code=200)
@@ -1181,7 +1307,7 @@ async def clear_all_tasks_endpoint():
     """
     log.warning("⚠️ [僅供測試] 收到請求，將清除所有任務...")
     try:
-        success = db_client.clear_all_tasks()
+        success = await run_db(db_client.clear_all_tasks)
         if success:
             return {"status": "success", "message": "所有任務已成功清除。"}
         else:
@@ -1198,7 +1324,7 @@ async def get_latest_frontend_action_log():
     """
     try:
         # 我們只關心來自 'frontend_action' logger 的日誌
-        logs = db_client.get_system_logs(sources=['frontend_action'])
+        logs = await run_db(db_client.get_system_logs, sources=['frontend_action'])
         if not logs:
             # 如果沒有日誌，返回一個清晰的空回應，而不是 404
             return JSONResponse(content={"latest_log": None}, status_code=200)
@@ -1243,7 +1369,7 @@ async def websocket_endpoint(websocket: WebSocket):
                         await manager.broadcast_json({"type": "ERROR", "payload": "缺少 task_id 參數"})
                         continue
 
-                    task_info = db_client.get_task_status(task_id)
+                    task_info = await run_db(db_client.get_task_status, task_id)
                     if not task_info:
                         await manager.broadcast_json({"type": "ERROR", "payload": f"找不到任務 {task_id}"})
                         continue
@@ -1315,7 +1441,7 @@ async def set_app_state_endpoint(payload: AppStatePayload):
     設定一個應用程式狀態值。
     """
     try:
-        success = db_client.set_app_state(payload.key, payload.value)
+        success = await run_db(db_client.set_app_state, payload.key, payload.value)
         if success:
             # 廣播狀態變更
             await manager.broadcast_json({"type": "APP_STATE_UPDATE", "payload": {payload.key: payload.value}})
@@ -1332,7 +1458,7 @@ async def get_all_app_states_endpoint():
     獲取所有應用程式狀態值。
     """
     try:
-        states = db_client.get_all_app_states()
+        states = await run_db(db_client.get_all_app_states)
         return JSONResponse(content=states)
     except Exception as e:
         log.error(f"❌ 獲取所有應用程式狀態時 API 出錯: {e}", exc_info=True)
@@ -1348,8 +1474,13 @@ async def notify_task_update(payload: Dict):
     task_id = payload.get("task_id")
     status = payload.get("status")
     result = payload.get("result")
-    # 從 payload 獲取 task_type，這是從背景任務傳來的，比重新查詢資料庫更可靠
-    task_type = payload.get("task_type", "unknown")
+    # 從 payload 獲取 task_type，這是從背景任務傳來的，比重新查詢資料庫更可靠，
+    # 也省下完成路徑上的一次資料庫往返。只有舊版 Worker 未提供時才退回查詢資料庫。
+    task_type = payload.get("task_type")
+    if not task_type and task_id:
+        task_info = await run_db(db_client.get_task_status, task_id)
+        task_type = task_info.get("type") if task_info else None
+    task_type = task_type or "unknown"
 
     log.info(f"🔔 收到來自背景任務的更新通知: Task {task_id} ({task_type}) -> {status}")
 
@@ -1387,7 +1518,8 @@ async def notify_task_update(payload: Dict):
 
 
 # --- 主程式啟動 ---
-if __name__ == "__main__":
+def main():
+    """解析命令列參數並啟動 uvicorn (由 api.server_main 呼叫)。"""
     import uvicorn
     import argparse
 
@@ -1409,3 +1541,7 @@ if __name__ == "__main__":
     log.info("🚀 啟動 API 伺服器 (v3)...")
     log.info(f"請在瀏覽器中開啟 http://127.0.0.1:{args.port}")
     uvicorn.run(app, host="0.0.0.0", port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,34 @@
 import logging
-import sys
-from pathlib import Path
+import sqlite3
 
 from fastapi import APIRouter, HTTPException, Request
-from fastapi.responses import HTMLResponse, JSONResponse
-from fastapi.templating import Jinja2Templates
+from fastapi.responses import HTMLResponse, ORJSONResponse
 from pydantic import BaseModel
 
-# --- 路徑修正與模組匯入 ---
-# 這是必要的，因為我們的工具和資料庫模組都在 src 下
-# 我們需要確保 src 目錄在 Python 的搜尋路徑中
-SRC_DIR = Path(__file__).resolve().parent.parent.parent
-sys.path.insert(0, str(SRC_DIR))
-
-# 現在可以安全地匯入我們的工具了
+# --- 模組匯入 ---
+# 本模組只會經由 api.api_server (或已設定 pythonpath 的測試) 匯入，
+# src 目錄此時已在搜尋路徑中，不需要在每次匯入時再修改 sys.path。
 from tools.url_extractor import parse_chat_log, save_urls_to_db
+from db.database import acquire_conn
 
 # --- 常數與設定 ---
 log = logging.getLogger(__name__)
-templates = Jinja2Templates(directory=str(SRC_DIR / "static"))
 router = APIRouter()
 
+# --- 搜尋 SQL 陳述式 ---
+# 關鍵字以空白切分為最多 SEARCH_MAX_TERMS 個詞 (彼此為 AND 關係)。
+# LIKE 查詢固定使用 4 個佔位符，未使用的位置綁定 '%'，無論詞數多寡都是同一個
+# SQL 文字，始終命中連線上的陳述式快取，不會因詞數不同而產生多種查詢形狀。
+SEARCH_MAX_TERMS = 4
+SQL_SEARCH_FTS = (
+    "SELECT e.id, e.url, e.created_at FROM extracted_urls_fts f "
+    "JOIN extracted_urls e ON e.id = f.rowid WHERE extracted_urls_fts MATCH ?"
+)
+SQL_SEARCH_LIKE = (
+    "SELECT id, url, created_at FROM extracted_urls "
+    "WHERE url LIKE ?1 AND url LIKE ?2 AND url LIKE ?3 AND url LIKE ?4"
+)
+
 # --- Pydantic 模型 ---
 class UrlExtractionRequest(BaseModel):
     text: str
@@ -44,11 +52,9 @@ async def extract_urls_endpoint(payload: UrlExtractionRequest, request: Request)
 
         # [步驟四完成] - 重新啟用儲存功能
         if parsed_data:
-            # 使用 'with' 陳述式來安全地管理資料庫連線
-            from db.database import get_db_connection
-            with get_db_connection() as conn:
-                if not conn:
-                    raise HTTPException(status_code=503, detail="無法建立資料庫連線。")
+            # 從連線池借用連線；save_urls_to_db 會以 executemany 在單一交易中寫入所有資料
+            # (注意：sqlite3 連線本身的 'with' 只管理交易，並不會關閉連線)
+            async with acquire_conn() as conn:
                 save_urls_to_db(parsed_data, source_text, conn)
 
             log.info(f"API: 成功解析並儲存 {count} 筆資料。")
@@ -61,7 +67,7 @@ async def extract_urls_endpoint(payload: UrlExtractionRequest, request: Request)
             log.info("API: 在提供的文字中未找到任何可解析的資料。")
 
         # 步驟 2: 直接回傳解析後的結構化資料列表給前端
-        return JSONResponse(content=parsed_data)
+        return ORJSONResponse(content=parsed_data)
 
     except Exception as e:
         log.error(f"API: 處理網址提取請求時發生未預期錯誤: {e}", exc_info=True)
@@ -74,25 +80,33 @@ async def search_urls_endpoint(q: str = ""):
     從資料庫中搜尋符合關鍵字的網址。
     """
     if not q.strip():
-        return JSONResponse(content=[])
+        return ORJSONResponse(content=[])
 
     log.info(f"API: 收到網址搜尋請求，關鍵字: '{q}'")
-    conn = None
+    terms = q.split()[:SEARCH_MAX_TERMS]
     try:
-        # 從 db 模組獲取資料庫連線
-        from db.database import get_db_connection
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        # 使用 LIKE 進行簡單的子字串搜尋
-        cursor.execute("SELECT id, url, created_at FROM extracted_urls WHERE url LIKE ?", (f"%{q}%",))
-        rows = cursor.fetchall()
+        # 從 db 模組的唯讀連線池借用連線，避免每次請求都重新開啟資料庫
+        async with acquire_conn(read_only=True) as conn:
+            cursor = conn.cursor()
+            rows = None
+            # trigram 分詞器至少需要 3 個字元才能比對，任一詞較短時直接走 LIKE
+            if all(len(term) >= 3 for term in terms):
+                try:
+                    # 將每個詞包成 FTS5 片語 (以空白相連即為 AND)，避免使用者輸入被解析為查詢語法
+                    fts_query = ' '.join('"' + term.replace('"', '""') + '"' for term in terms)
+                    cursor.execute(SQL_SEARCH_FTS, (fts_query,))
+                    rows = cursor.fetchall()
+                except sqlite3.OperationalError as e:
+                    log.warning(f"API: FTS5 搜尋索引無法使用，改用 LIKE 搜尋: {e}")
+            if rows is None:
+                # 使用 LIKE 進行簡單的子字串搜尋，未使用的佔位符以 '%' 補齊
+                params = [f"%{term}%" for term in terms] + ['%'] * (SEARCH_MAX_TERMS - len(terms))
+                cursor.execute(SQL_SEARCH_LIKE, params)
+                rows = cursor.fetchall()
         # 將查詢結果轉換為字典列表以便序列化為 JSON
         results = [{"id": row[0], "url": row[1], "created_at": row[2]} for row in rows]
         log.info(f"API: 搜尋到 {len(results)} 筆結果。")
-        return JSONResponse(content=results)
+        return ORJSONResponse(content=results)
     except Exception as e:
         log.error(f"API: 搜尋網址時發生錯誤: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="搜尋網址時發生伺服器內部錯誤。")
-    finally:
-        if conn:
-            conn.close()
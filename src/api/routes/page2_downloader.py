@@ -1,91 +1,155 @@
+import asyncio
+import hashlib
 import logging
-import sys
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-import requests
-import json
 
-from fastapi import APIRouter, HTTPException, Request, BackgroundTasks
-from fastapi.responses import HTMLResponse, JSONResponse
-from fastapi.templating import Jinja2Templates
+import orjson
+from fastapi import APIRouter, HTTPException, Request, Response
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 from typing import List
 
-# --- 路徑修正與模組匯入 ---
+# --- 模組匯入 ---
+# 本模組只會經由 api.api_server (或已設定 pythonpath 的測試) 匯入，src 目錄此時已在搜尋路徑中。
 SRC_DIR = Path(__file__).resolve().parent.parent.parent
-sys.path.insert(0, str(SRC_DIR))
 
-from db.database import get_db_connection
+from db.database import acquire_conn
+from db.writer import url_status_writer
+from tools.drive_downloader import download_file
 
 # --- 常數與設定 ---
 log = logging.getLogger(__name__)
-templates = Jinja2Templates(directory=str(SRC_DIR / "static"))
 router = APIRouter()
 
+# --- SQL 陳述式 ---
+# 以模組常數保存，每次執行都傳入相同的 SQL 文字，確保命中連線上的陳述式快取
+SQL_GET_PENDING = "SELECT id, url, author, message_date, message_time FROM extracted_urls WHERE status = 'pending' ORDER BY created_at DESC"
+SQL_GET_COMPLETED = "SELECT id, url, local_filename, created_at FROM extracted_urls WHERE status = 'completed' ORDER BY created_at DESC"
+
+# --- 列表回應快取 ---
+# 待處理/已完成列表會被前端頻繁輪詢，但只有在背景任務提交狀態時才會改變。
+# 將序列化後的 JSON 位元組保存一小段時間，期間內重複的輪詢不必再查詢與序列化；
+# 批次寫入器提交狀態更新、或 start_downloads 變更狀態時會立即清除快取。
+LIST_CACHE_TTL = 0.5
+_list_cache: dict[str, tuple[float, bytes, str]] = {}
+# 每次清除快取都會遞增；查詢期間若快取被清除，該次結果不寫回快取，避免存入過時的資料
+_list_cache_generation = 0
+
+def invalidate_list_cache():
+    """清除列表回應快取。"""
+    global _list_cache_generation
+    _list_cache_generation += 1
+    _list_cache.clear()
+
+url_status_writer.add_flush_listener(invalidate_list_cache)
+
+
+def _json_response(body: bytes, etag: str, request: Request) -> Response:
+    """回傳 JSON 位元組；若用戶端的 If-None-Match 與 ETag 相符則回傳 304。"""
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+
+def _get_cached_list(key: str, request: Request) -> Response | None:
+    """若快取仍在有效期限內，直接回傳快取的回應。"""
+    cached = _list_cache.get(key)
+    if cached and time.monotonic() - cached[0] < LIST_CACHE_TTL:
+        return _json_response(cached[1], cached[2], request)
+    return None
+
+
+def _cache_list(key: str, results: list, generation: int, request: Request) -> Response:
+    """序列化列表結果並存入快取 (查詢期間快取未被清除時)，再回傳回應。"""
+    body = orjson.dumps(results)
+    etag = '"' + hashlib.blake2b(body, digest_size=8).hexdigest() + '"'
+    if generation == _list_cache_generation:
+        _list_cache[key] = (time.monotonic(), body, etag)
+    return _json_response(body, etag, request)
+
+
+# --- 下載併發控制 ---
+# FastAPI 的 BackgroundTasks 會在回應送出後「依序」執行所有任務，多個下載只能一個接一個完成。
+# 改為每個 URL 建立一個 asyncio 任務，並將實際下載 (gdown 為同步函式庫) 提交到專用的
+# 有上限執行緒池：同時進行的下載數量固定，超出的項目在池中排隊，
+# 也不會佔用事件迴圈預設執行緒池 (asyncio.to_thread) 中其他工作所需的執行緒。
+DOWNLOAD_CONCURRENCY = int(os.getenv("DL_WORKERS", "5"))
+DOWNLOAD_EXECUTOR = ThreadPoolExecutor(max_workers=DOWNLOAD_CONCURRENCY, thread_name_prefix="dl")
+# 保存進行中任務的參考，避免 asyncio 任務在完成前被垃圾回收
+_download_tasks: set[asyncio.Task] = set()
+# 已提交但尚未完成的下載數量 (只在事件迴圈中增減)，供 /queue_status 計算排隊深度
+_downloads_in_flight = 0
+
+def shutdown_download_executor():
+    """取消尚未開始的下載並關閉下載執行緒池，應在應用程式關閉時呼叫。"""
+    DOWNLOAD_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+
 # --- API 端點 ---
 @router.get("/pending_urls")
-async def get_pending_urls():
+async def get_pending_urls(request: Request):
     """
     獲取所有狀態為 'pending' 的網址列表。
     現在也會獲取作者和訊息時間等欄位，以便在前端表格中顯示。
     """
     log.info("API: 收到獲取待處理網址列表的請求。")
-    conn = None
+    cached = _get_cached_list("pending", request)
+    if cached is not None:
+        return cached
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT id, url, author, message_date, message_time FROM extracted_urls WHERE status = 'pending' ORDER BY created_at DESC"
-        )
-        rows = cursor.fetchall()
+        generation = _list_cache_generation
+        async with acquire_conn(read_only=True) as conn:
+            cursor = conn.cursor()
+            # 熱門列表端點改以純 tuple 取值，省去 sqlite3.Row 逐欄位的名稱查找
+            cursor.row_factory = None
+            rows = cursor.execute(SQL_GET_PENDING).fetchall()
         results = [
-            {
-                "id": row['id'],
-                "url": row['url'],
-                "author": row['author'],
-                "message_date": row['message_date'],
-                "message_time": row['message_time'],
-            }
-            for row in rows
+            {"id": r[0], "url": r[1], "author": r[2], "message_date": r[3], "message_time": r[4]}
+            for r in rows
         ]
-        return JSONResponse(content=results)
+        return _cache_list("pending", results, generation, request)
     except Exception as e:
         log.error(f"API: 獲取待處理網址時發生錯誤: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="獲取待處理網址時發生伺服器內部錯誤。")
-    finally:
-        if conn:
-            conn.close()
 
 
 @router.get("/completed")
-async def get_completed_downloads():
+async def get_completed_downloads(request: Request):
     """
     獲取所有狀態為 'completed' (已下載完成) 的檔案列表。
     這是為了在頁面二顯示已完成的項目。
     """
     log.info("API: 收到獲取已完成下載列表的請求。")
-    conn = None
+    cached = _get_cached_list("completed", request)
+    if cached is not None:
+        return cached
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, url, local_path, created_at FROM extracted_urls WHERE status = 'completed' ORDER BY created_at DESC")
-        rows = cursor.fetchall()
-        # 從 local_path 提取檔名，並確保 local_path 存在
+        generation = _list_cache_generation
+        async with acquire_conn(read_only=True) as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            rows = cursor.execute(SQL_GET_COMPLETED).fetchall()
+        # 檔名由資料庫的 local_filename 欄位直接提供，並確保其存在 (欄位順序: id, url, local_filename, created_at)
         results = [
-            {
-                "id": row['id'],
-                "url": row['url'],
-                "filename": Path(row['local_path']).name,
-                "completed_at": row['created_at']
-            }
-            for row in rows if row['local_path']
+            {"id": r[0], "url": r[1], "filename": r[2], "completed_at": r[3]}
+            for r in rows if r[2]
         ]
-        return JSONResponse(content=results)
+        return _cache_list("completed", results, generation, request)
     except Exception as e:
         log.error(f"API: 獲取已完成下載列表時發生錯誤: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="獲取已完成下載列表時發生伺服器內部錯誤。")
-    finally:
-        if conn:
-            conn.close()
+
+
+@router.get("/queue_status")
+async def get_download_queue_status():
+    """回傳下載執行緒池的使用狀況，供監控排隊深度。"""
+    return {
+        "workers": DOWNLOAD_CONCURRENCY,
+        "active": min(_downloads_in_flight, DOWNLOAD_CONCURRENCY),
+        "queued": max(0, _downloads_in_flight - DOWNLOAD_CONCURRENCY),
+    }
 
 
 # --- Pydantic 模型 ---
@@ -93,33 +157,22 @@ class DownloadRequest(BaseModel):
     ids: List[int]
 
 # --- 背景任務函式 ---
-def run_download_task(url_id: int, port: int):
+def run_download_task(url_id: int, url_to_download: str, author: str | None, message_date: str | None, message_time: str | None) -> tuple[str, dict]:
     """
     這是在背景執行的單一檔案下載任務。
-    它會處理下載、更新資料庫狀態，並在最後呼叫內部 API 以觸發 WebSocket 通知。
+    它會處理下載與更新資料庫狀態，並回傳 (最終狀態, 結果內容) 供呼叫端發送 WebSocket 通知。
+    命名所需的網址資訊由 `start_downloads` 的 UPDATE ... RETURNING 一併取得後傳入，
+    任務本身不再查詢資料庫。
     """
     log.info(f"背景任務：開始處理下載 URL ID: {url_id}")
-    conn = None
     final_status = 'failed' # 預設為失敗
     result_payload = {}
+    status_written = None # 狀態更新交由批次寫入器，於通知前等待其提交
 
     try:
-        # 步驟 1: 獲取所有命名所需的資訊
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT url, author, message_date, message_time FROM extracted_urls WHERE id = ?", (url_id,))
-        row = cursor.fetchone()
-        if not row:
-            raise ValueError(f"在資料庫中找不到 ID 為 {url_id} 的 URL。")
-
-        url_to_download = row['url']
-        author = row['author']
-        message_date = row['message_date']
-        message_time = row['message_time']
         log.info(f"背景任務：準備從 {url_to_download} 下載 (ID: {url_id})...")
 
         # 步驟 2: 執行智慧化下載
-        from tools.drive_downloader import download_file
         download_dir = SRC_DIR.parent / "downloads"
 
         # 呼叫新的下載函式，傳入所有命名所需的資訊
@@ -132,65 +185,68 @@ def run_download_task(url_id: int, port: int):
             message_time=message_time
         )
 
-        # 步驟 3: 根據下載結果更新資料庫
+        # 步驟 3: 根據下載結果更新資料庫 (由批次寫入器與其他任務合併在同一個交易中提交)
         if downloaded_path:
             final_status = 'completed'
             result_payload = {"local_path": downloaded_path}
-            cursor.execute(
-                "UPDATE extracted_urls SET status = ?, local_path = ?, status_message = '下載成功' WHERE id = ?",
-                (final_status, downloaded_path, url_id)
-            )
+            status_written = url_status_writer.enqueue(url_id, final_status, downloaded_path, '下載成功')
             log.info(f"背景任務：URL ID {url_id} 下載成功，路徑: {downloaded_path}")
         else:
             final_status = 'download_failed' # 使用更具體的狀態
             result_payload = {"error": "下載失敗，請檢查日誌"}
-            cursor.execute(
-                "UPDATE extracted_urls SET status = ?, status_message = '下載失敗，請檢查日誌' WHERE id = ?",
-                (final_status, url_id)
-            )
+            status_written = url_status_writer.enqueue(url_id, final_status, None, '下載失敗，請檢查日誌')
             log.error(f"背景任務：URL ID {url_id} 下載失敗。")
 
-        conn.commit()
-
     except Exception as e:
         log.error(f"背景任務：處理 URL ID {url_id} 時發生嚴重錯誤: {e}", exc_info=True)
         final_status = 'failed'
         result_payload = {"error": str(e)}
-        if conn and url_id:
-            try:
-                cursor = conn.cursor()
-                cursor.execute(
-                    "UPDATE extracted_urls SET status = ?, status_message = ? WHERE id = ?",
-                    (final_status, str(e), url_id)
-                )
-                conn.commit()
-            except Exception as db_err:
-                log.error(f"背景任務：在錯誤處理中更新資料庫狀態時再次失敗: {db_err}")
+        if url_id:
+            status_written = url_status_writer.enqueue(url_id, final_status, None, str(e))
+    finally:
+        # 確保狀態已寫入資料庫後才通知前端，避免前端重新整理時讀到舊狀態
+        if status_written and not status_written.wait(timeout=5):
+            log.warning(f"背景任務：等待 URL ID {url_id} 的狀態寫入逾時。")
+
+    return final_status, result_payload
+
+
+async def _download_one(row, ws_manager):
+    """
+    在下載執行緒池中執行單一下載任務 (gdown 為同步函式庫)，
+    完成後直接在事件迴圈中透過 WebSocket 廣播結果，
+    不再繞經 HTTP 呼叫同一程序的 /api/internal/notify_task_update。
+    """
+    global _downloads_in_flight
+    url_id = row['id']
+    loop = asyncio.get_running_loop()
+    _downloads_in_flight += 1
+    try:
+        final_status, result_payload = await loop.run_in_executor(
+            DOWNLOAD_EXECUTOR, run_download_task,
+            url_id, row['url'], row['author'], row['message_date'], row['message_time']
+        )
     finally:
-        if conn:
-            conn.close()
+        _downloads_in_flight -= 1
 
-        # 步驟 4: 無論成功或失敗，都呼叫內部 API 來觸發 WebSocket 通知
-        try:
-            # 確保 task_id 在 payload 中是字串
-            notification_payload = {
+    # 步驟 4: 無論成功或失敗，都觸發 WebSocket 通知 (訊息格式與 notify_task_update 一致)
+    try:
+        await ws_manager.broadcast_json({
+            "type": "DOWNLOAD_COMPLETE",
+            "payload": {
                 "task_id": str(url_id),
                 "status": final_status,
-                "result": json.dumps(result_payload),
-                "task_type": "download" # 新增類型，幫助後端區分
+                "result": result_payload,
+                "task_type": "download"
             }
-            requests.post(
-                f"http://127.0.0.1:{port}/api/internal/notify_task_update",
-                json=notification_payload,
-                timeout=5
-            )
-            log.info(f"背景任務：已為 URL ID {url_id} 發送完成通知。")
-        except requests.exceptions.RequestException as e:
-            log.error(f"背景任務：為 URL ID {url_id} 發送完成通知時失敗: {e}")
+        })
+        log.info(f"背景任務：已為 URL ID {url_id} 發送完成通知。")
+    except Exception as e:
+        log.error(f"背景任務：為 URL ID {url_id} 發送完成通知時失敗: {e}")
 
 
 @router.post("/start_downloads")
-async def start_downloads(payload: DownloadRequest, background_tasks: BackgroundTasks, request: Request):
+async def start_downloads(payload: DownloadRequest, request: Request):
     """
     接收要下載的 URL ID 列表，並為每一個 ID 建立一個背景下載任務。
     """
@@ -200,32 +256,47 @@ async def start_downloads(payload: DownloadRequest, background_tasks: Background
 
     log.info(f"API: 收到 {len(url_ids)} 個項目的下載請求。")
 
-    # 從 app.state 獲取在應用程式啟動時捕獲的、可靠的伺服器埠號，
-    # 而不是使用 request.url.port，因為後者在反向代理後可能不正確。
-    port = request.app.state.server_port
+    # 完成通知直接透過應用程式的 WebSocket 管理器廣播
+    ws_manager = request.app.state.manager
 
-    conn = None
     try:
-        # 立即將所有請求的 URL 狀態更新為 'downloading'
-        conn = get_db_connection()
-        with conn:
-            cursor = conn.cursor()
-            # 使用 '?' 佔位符來安全地傳遞參數列表
-            placeholders = ','.join('?' for _ in url_ids)
-            sql = f"UPDATE extracted_urls SET status = 'downloading', status_message = '已加入下載佇列' WHERE id IN ({placeholders})"
-            cursor.execute(sql, url_ids)
-            log.info(f"API: 已將 {cursor.rowcount} 個 URL 的狀態更新為 'downloading'。")
-
-        # 為每個 URL 新增一個背景任務
-        for url_id in url_ids:
-            background_tasks.add_task(run_download_task, url_id, port)
-
-        return JSONResponse(
-            content={"message": f"已成功為 {len(url_ids)} 個項目建立背景下載任務。"}
+        # 立即將所有請求的 URL 狀態更新為 'downloading'，
+        # 並以 RETURNING 一次取回下載與命名所需的欄位，背景任務不必再逐筆查詢
+        async with acquire_conn() as conn:
+            with conn:
+                cursor = conn.cursor()
+                # 使用 '?' 佔位符來安全地傳遞參數列表
+                placeholders = ','.join('?' for _ in url_ids)
+                sql = (
+                    f"UPDATE extracted_urls SET status = 'downloading', status_message = '已加入下載佇列' WHERE id IN ({placeholders}) "
+                    "RETURNING id, url, author, message_date, message_time"
+                )
+                cursor.execute(sql, url_ids)
+                rows = cursor.fetchall()
+                log.info(f"API: 已將 {len(rows)} 個 URL 的狀態更新為 'downloading'。")
+        # 待處理列表已改變，清除列表快取
+        invalidate_list_cache()
+
+        if len(rows) != len(set(url_ids)):
+            found_ids = {row['id'] for row in rows}
+            log.warning(f"API: 資料庫中找不到以下 URL ID，將略過: {sorted(set(url_ids) - found_ids)}")
+
+        # 為每個 URL 建立一個背景任務，由下載執行緒池控制同時下載的數量
+        for row in rows:
+            task = asyncio.create_task(_download_one(row, ws_manager))
+            _download_tasks.add(task)
+            task.add_done_callback(_download_tasks.discard)
+
+        # 以單一訊息通知所有用戶端這批下載已開始，而非逐個 ID 廣播
+        if rows:
+            await ws_manager.broadcast_json({
+                "type": "DOWNLOAD_BATCH_STARTED",
+                "payload": {"task_ids": [str(row['id']) for row in rows]}
+            })
+
+        return ORJSONResponse(
+            content={"message": f"已成功為 {len(rows)} 個項目建立背景下載任務。"}
         )
     except Exception as e:
         log.error(f"API: 啟動下載任務時發生錯誤: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="啟動下載任務時發生伺服器內部錯誤。")
-    finally:
-        if conn:
-            conn.close()
@@ -1,81 +1,247 @@
+import asyncio
+import codecs
 import logging
-import sys
+import mmap
+import multiprocessing
+import os
+import threading
+import time
+from contextlib import ExitStack
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 import json
+import orjson
 import requests
 
-from fastapi import APIRouter, HTTPException, Request, BackgroundTasks
-from fastapi.responses import HTMLResponse, JSONResponse
-from fastapi.templating import Jinja2Templates
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
 from typing import List
 
-# --- 路徑修正與模組匯入 ---
+# --- 模組匯入 ---
+# 本模組只會經由 api.api_server (或已設定 pythonpath 的測試) 匯入，src 目錄此時已在搜尋路徑中。
 SRC_DIR = Path(__file__).resolve().parent.parent.parent
-sys.path.insert(0, str(SRC_DIR))
 
-from db.database import get_db_connection
-from tools.file_hasher import calculate_sha256
+from db.client import get_client
+from db.database import acquire_conn, pooled_connection
+from tools.content_extractor import extract_content
+from tools.file_hasher import calculate_sha256, calculate_sha256_of_buffer
 from tools.image_compressor import compress_image
 
 # --- 常數與設定 ---
 log = logging.getLogger(__name__)
-templates = Jinja2Templates(directory=str(SRC_DIR / "static"))
 router = APIRouter()
+# 與 page2_downloader 的下載目的地相同
+DOWNLOAD_DIR = SRC_DIR.parent / "downloads"
+
+# --- 列表分頁 ---
+# 列表端點以 LIMIT/OFFSET 分頁，回應大小與序列化成本只取決於頁面大小，不再隨資料表成長。
+# (status, created_at DESC) 複合索引讓 SQLite 依索引順序直接取出前 N 筆，不需要排序整張表。
+LIST_PAGE_SIZE = 500
+LIST_PAGE_MAX = 5000
+# 還有下一頁時，以此回應標頭告知下一頁的 offset (回應本體維持原本的 JSON 陣列)；沒有此標頭表示已是最後一頁
+NEXT_OFFSET_HEADER = "X-Next-Offset"
+SQL_LIST_COMPLETED = (
+    "SELECT id, url, local_filename FROM extracted_urls WHERE status = 'completed' "
+    "ORDER BY created_at DESC LIMIT ? OFFSET ?"
+)
+SQL_LIST_PROCESSED = (
+    "SELECT id, local_filename FROM extracted_urls WHERE status = 'processed' AND local_filename IS NOT NULL "
+    "ORDER BY created_at DESC LIMIT ? OFFSET ?"
+)
+
+# --- 處理程序池 ---
+# 雜湊計算與內容/圖片提取屬於 CPU 密集工作，放在執行緒中會彼此爭奪 GIL。
+# 改為提交到程序池，讓多個檔案能在多核心上真正平行處理。
+# 使用 spawn 啟動方式，避免在已有多條執行緒的伺服器程序中 fork。
+# spawn 的子程序會以 __mp_main__ 重新匯入主模組，因此伺服器經由輕量的 api.server_main 啟動
+# (不會在子程序中重建 FastAPI 應用)；子程序數量另設上限，多核心主機也不會一次啟動大量常駐程序。
+PROCESS_POOL_MAX_WORKERS = min(4, os.cpu_count() or 1)
+_process_pool: ProcessPoolExecutor | None = None
+_process_pool_lock = threading.Lock()
+
+def _init_processing_worker():
+    """
+    子程序啟動時執行一次的初始化。
+    子程序會常駐並處理多個檔案：本模組 (連同 content_extractor 匯入的 PyMuPDF、python-docx、
+    python-pptx 等重量級函式庫) 在反序列化第一個任務時匯入一次，之後的任務直接沿用。
+    這裡再預先建立該程序的 DBClient 單例，讓每個任務都共用同一個實例。
+    """
+    get_client()
+
+def _get_process_pool() -> ProcessPoolExecutor:
+    """延遲建立處理程序池，只有實際送出處理請求時才啟動子程序。"""
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = ProcessPoolExecutor(
+                max_workers=PROCESS_POOL_MAX_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_processing_worker
+            )
+        return _process_pool
+
+def shutdown_process_pool():
+    """關閉處理程序池，應在應用程式關閉時呼叫。"""
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is not None:
+            _process_pool.shutdown(wait=False, cancel_futures=True)
+            _process_pool = None
+
+# 雜湊計算與內容提取互不相依；hashlib 計算期間會釋放 GIL，
+# 因此在處理任務中先將雜湊提交到此執行緒池，與內容提取重疊執行。
+# (執行緒只會在實際提交工作時建立，主程序匯入本模組不會啟動任何執行緒)
+_HASH_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="hash")
+
+# 報告中的每張圖片可獨立壓縮，PIL 在解碼/縮放/編碼期間會釋放 GIL，
+# 以有上限的執行緒池平行處理，同時讓事件迴圈不被壓縮工作阻塞
+_IMAGE_POOL = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1), thread_name_prefix="image")
+
+# 完成通知都送往同一個本機端點；以長期存活的 Session 保持連線 (keep-alive)，
+# 同一個工作程序處理多個檔案時不必每次重新建立 TCP 連線
+_NOTIFY_SESSION = requests.Session()
+
+def _log_processing_failure(url_id: int, future: Future):
+    """程序池中的任務若異常結束 (例如子程序崩潰)，記錄錯誤以免靜默失敗。"""
+    if not future.cancelled() and future.exception():
+        log.error(f"背景任務：處理 URL ID {url_id} 的子程序異常結束: {future.exception()}")
 
 # --- Pydantic 模型 ---
 class ProcessRequest(BaseModel):
     ids: List[int]
 
+def _page_response(items: list, next_offset: int | None) -> ORJSONResponse:
+    """回傳一頁列表；還有下一頁時加上 NEXT_OFFSET_HEADER 標頭。"""
+    headers = {NEXT_OFFSET_HEADER: str(next_offset)} if next_offset is not None else None
+    return ORJSONResponse(content=items, headers=headers)
+
+def _list_download_dir() -> set[str]:
+    """以單次 os.scandir 列出下載目錄中的檔名；目錄不存在時回傳空集合。"""
+    try:
+        with os.scandir(DOWNLOAD_DIR) as entries:
+            return {entry.name for entry in entries if entry.is_file()}
+    except FileNotFoundError:
+        return set()
+
+def _list_existing_completed_files(limit: int, offset: int, existing: set[str]) -> tuple[list[dict], int | None]:
+    """
+    從 offset 起依建立時間新到舊掃描已下載完成的項目，略過檔案已不在下載目錄中的列，直到收集到 limit 筆。
+    :return: (該頁的項目, 下一頁的 offset；已掃描到最後一列時為 None)。下一頁從最後掃描過的列之後開始，
+             因此每一頁 (最後一頁除外) 都恰好有 limit 筆，不會因為中間有已刪除的檔案而提早結束。
+    """
+    with pooled_connection(read_only=True) as conn:
+        cursor = conn.cursor()
+        # 以純 tuple 取值，省去 sqlite3.Row 逐欄位的名稱查找
+        cursor.row_factory = None
+        # LIMIT -1 表示不限筆數：游標逐列讀取，收集滿一頁後即停止，只讀取實際需要的列
+        rows = cursor.execute(SQL_LIST_COMPLETED, (-1, offset))
+        results = []
+        for scanned, (url_id, url, filename) in enumerate(rows):
+            if len(results) == limit:
+                return results, offset + scanned
+            if filename in existing:
+                results.append({"id": url_id, "url": url, "filename": filename})
+    return results, None
+
 # --- API 端點 ---
 @router.get("/completed_files")
-async def get_completed_files():
-    """獲取所有狀態為 'completed' (已下載完成) 的檔案列表。"""
+async def get_completed_files(
+    limit: int = Query(LIST_PAGE_SIZE, ge=1, le=LIST_PAGE_MAX),
+    offset: int = Query(0, ge=0)
+):
+    """
+    獲取狀態為 'completed' (已下載完成) 的檔案列表 (依建立時間新到舊分頁，下一頁的 offset 見 NEXT_OFFSET_HEADER)。
+    檔案已從下載目錄刪除的項目無法處理，因此不會列出；offset 是資料表中的位置，
+    下一頁請使用回應標頭提供的 offset，而不是自行加上 limit。
+    """
     log.info("API: 收到獲取已下載檔案列表的請求。")
-    conn = None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, url, local_path FROM extracted_urls WHERE status = 'completed' ORDER BY created_at DESC")
-        rows = cursor.fetchall()
-        results = [{"id": row['id'], "url": row['url'], "filename": Path(row['local_path']).name} for row in rows if row['local_path']]
-        return JSONResponse(content=results)
+        # 一次列出下載目錄後在記憶體中比對，而非對每一列各自呼叫 stat 檢查檔案是否存在
+        existing = await asyncio.to_thread(_list_download_dir)
+        # 掃描可能跨過許多已刪除檔案的列，查詢在執行緒中進行，不阻塞事件迴圈
+        results, next_offset = await asyncio.to_thread(_list_existing_completed_files, limit, offset, existing)
+        return _page_response(results, next_offset)
     except Exception as e:
         log.error(f"API: 獲取已下載檔案時發生錯誤: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="獲取已下載檔案時發生伺服器內部錯誤。")
-    finally:
-        if conn:
-            conn.close()
 
 
 @router.get("/processed")
-async def get_processed_files():
+async def get_processed_files(
+    limit: int = Query(LIST_PAGE_SIZE, ge=1, le=LIST_PAGE_MAX),
+    offset: int = Query(0, ge=0)
+):
     """
-    獲取所有狀態為 'processed' (已處理完成) 的檔案列表。
+    獲取狀態為 'processed' (已處理完成) 的檔案列表 (依建立時間新到舊分頁，下一頁的 offset 見 NEXT_OFFSET_HEADER)。
     這是為了在頁面三顯示已處理的報告。
     """
     log.info("API: 收到獲取已處理報告列表的請求。")
-    conn = None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        # 選擇 file_hash 也是為了將來可能的用途
-        cursor.execute("SELECT id, local_path FROM extracted_urls WHERE status = 'processed' ORDER BY created_at DESC")
-        rows = cursor.fetchall()
-        results = [
-            {
-                "id": row['id'],
-                "filename": Path(row['local_path']).name
-            }
-            for row in rows if row['local_path']
-        ]
-        return JSONResponse(content=results)
+        async with acquire_conn(read_only=True) as conn:
+            cursor = conn.cursor()
+            # 以純 tuple 取值；檔名已由 SQL 直接提供並在 SQL 中篩除空值，Python 端只需組出 JSON 物件
+            cursor.row_factory = None
+            # 多取一筆，用來判斷是否還有下一頁
+            rows = cursor.execute(SQL_LIST_PROCESSED, (limit + 1, offset)).fetchall()
+        next_offset = offset + limit if len(rows) > limit else None
+        return _page_response([{"id": file_id, "filename": filename} for file_id, filename in rows[:limit]], next_offset)
     except Exception as e:
         log.error(f"API: 獲取已處理報告列表時發生錯誤: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="獲取已處理報告列表時發生伺服器內部錯誤。")
-    finally:
-        if conn:
-            conn.close()
+
+
+# 報告文字以增量 blob 讀取時每次讀取的位元組數
+REPORT_TEXT_CHUNK_SIZE = 64 * 1024
+NO_TEXT_CONTENT = "沒有可用的文字內容。"
+
+SQL_REPORT_ROW = (
+    "SELECT extracted_text IS NOT NULL AND extracted_text <> '' AS has_text, extracted_image_paths "
+    "FROM extracted_urls WHERE id = ? AND status = 'processed'"
+)
+
+def _open_report_snapshot(file_id: int):
+    """
+    借出一條唯讀連線並開啟讀取交易，在同一個快照中查詢報告列並開啟文字的 blob。
+    WAL 模式下讀取交易期間看不到其他連線的寫入：回應送出後才重新處理或刪除此列，
+    串流讀到的仍是查詢當下的完整文字，不會輸出截斷的 JSON。
+    :return: (resources, row, blob)。resources 持有連線與 blob，串流結束後必須關閉；
+             找不到報告時 row 為 None (此時 resources 已關閉)，沒有文字內容時 blob 為 None。
+    """
+    resources = ExitStack()
+    try:
+        conn = resources.enter_context(pooled_connection(read_only=True))
+        conn.execute("BEGIN")  # 連線歸還時會 rollback 結束此讀取交易
+        row = conn.execute(SQL_REPORT_ROW, (file_id,)).fetchone()
+        blob = None
+        if row is not None and row["has_text"]:
+            blob = resources.enter_context(conn.blobopen("extracted_urls", "extracted_text", file_id, readonly=True))
+    except BaseException:
+        resources.close()
+        raise
+    if row is None:
+        resources.close()
+    return resources, row, blob
+
+def _stream_report_json(resources: ExitStack, blob, image_paths: list[str]):
+    """
+    以 JSON 格式串流輸出報告內容 (格式與原本的 {"text_content", "image_paths"} 相同)。
+    extracted_text 可能長達數 MB，透過 SQLite 的增量 blob API 分塊讀取並逐塊跳脫輸出，
+    不必先把整段文字載入成 Python 字串再整體序列化。blob 已在回應開始前開啟 (見 _open_report_snapshot)。
+    """
+    with resources:
+        yield b'{"text_content":"'
+        if blob is not None:
+            # 分塊邊界可能切在多位元組字元中間，以增量解碼器保留不完整的位元組到下一塊
+            decoder = codecs.getincrementaldecoder("utf-8")()
+            while chunk := blob.read(REPORT_TEXT_CHUNK_SIZE):
+                # orjson 序列化字串後去掉前後引號，即為該段文字的 JSON 跳脫結果
+                yield orjson.dumps(decoder.decode(chunk))[1:-1]
+            yield orjson.dumps(decoder.decode(b"", final=True))[1:-1]
+        else:
+            yield orjson.dumps(NO_TEXT_CONTENT)[1:-1]
+        yield b'","image_paths":' + orjson.dumps(image_paths) + b'}'
 
 
 @router.get("/report/{file_id}")
@@ -84,21 +250,13 @@ async def get_report_content(file_id: int):
     獲取單一已處理報告的詳細內容，包括文字和壓縮後的圖片路徑。
     """
     log.info(f"API: 收到對檔案 ID {file_id} 的報告內容請求。")
-    conn = None
+    resources = None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT extracted_text, extracted_image_paths FROM extracted_urls WHERE id = ? AND status = 'processed'",
-            (file_id,)
-        )
-        row = cursor.fetchone()
+        # 查詢與開啟 blob 都在送出回應狀態之前完成，任何失敗都會回傳 404/500，而不是寫到一半的內容
+        resources, row, blob = await asyncio.to_thread(_open_report_snapshot, file_id)
         if not row:
             raise HTTPException(status_code=404, detail="找不到指定 ID 的已處理報告。")
 
-        # 從資料庫獲取真實的文字內容
-        text_content = row['extracted_text'] or "沒有可用的文字內容。"
-
         # 處理圖片
         compressed_image_paths = []
         original_image_paths_json = row['extracted_image_paths']
@@ -108,38 +266,76 @@ async def get_report_content(file_id: int):
             # 定義壓縮圖片的儲存目錄
             compressed_output_dir = SRC_DIR.parent / "downloads" / "compressed_images"
 
-            for img_path in original_image_paths:
-                compressed_path = compress_image(img_path, str(compressed_output_dir))
+            # 所有圖片同時提交到圖片執行緒池壓縮 (gather 會保持原本的圖片順序)
+            loop = asyncio.get_running_loop()
+            compressed_paths = await asyncio.gather(*(
+                loop.run_in_executor(_IMAGE_POOL, compress_image, img_path, str(compressed_output_dir))
+                for img_path in original_image_paths
+            ))
+            for compressed_path in compressed_paths:
                 if compressed_path:
                     # 我們需要回傳一個可從前端訪問的相對 URL 路徑
                     web_path = Path(compressed_path).relative_to(SRC_DIR.parent).as_posix()
                     compressed_image_paths.append(web_path)
 
-        return JSONResponse(content={
-            "text_content": text_content,
-            "image_paths": compressed_image_paths
-        })
+        response = StreamingResponse(
+            _stream_report_json(resources, blob, compressed_image_paths),
+            media_type="application/json",
+            # 串流未開始就中斷 (例如用戶端提早離線) 時，產生器不會執行，改由背景任務關閉連線 (重複關閉無妨)
+            background=BackgroundTask(resources.close)
+        )
+        resources = None  # 之後由串流負責關閉
+        return response
 
+    except HTTPException:
+        raise
     except Exception as e:
         log.error(f"API: 獲取報告 ID {file_id} 的內容時發生錯誤: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="獲取報告內容時發生伺服器內部錯誤。")
     finally:
-        if conn:
-            conn.close()
+        if resources is not None:
+            resources.close()
 
 
 # --- 背景任務函式 ---
-import time
+def _wait_for_stable_file(file_path: Path, timeout: float = 1.0, interval: float = 0.02):
+    """
+    等待檔案大小穩定 (連續兩次 stat 結果相同且不為 0)，最多等待 timeout 秒。
+    用來避開下載端仍在寫入檔案的競爭條件；已寫完的檔案約 interval 秒即可返回。
+    """
+    deadline = time.monotonic() + timeout
+    last_size = -1
+    while time.monotonic() < deadline:
+        size = file_path.stat().st_size
+        if size == last_size and size > 0:
+            return
+        last_size = size
+        time.sleep(interval)
+
+def _hash_and_extract(file_path: Path, image_output_dir: Path) -> tuple[dict | None, str | None]:
+    """
+    計算檔案雜湊並提取內容，回傳 (提取結果, 雜湊值)。
+    兩者互不相依，雜湊在 _HASH_POOL 中與內容提取重疊執行。
+    PDF 會先 mmap 映射一次，雜湊與 PyMuPDF 解析共用同一份映射，整個檔案只讀取一次；
+    其他格式 (DOCX/PPTX 為 zip，只會讀取需要的部分) 維持各自以路徑讀取。
+    """
+    if file_path.suffix.lower() == '.pdf' and file_path.stat().st_size > 0:
+        with open(file_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            with memoryview(mapped) as data:
+                hash_future = _HASH_POOL.submit(calculate_sha256_of_buffer, data)
+                try:
+                    content_data = extract_content(str(file_path), str(image_output_dir), data=data)
+                finally:
+                    # 映射關閉前必須確保雜湊已完成，不再使用 data
+                    file_hash = hash_future.result()
+        return content_data, file_hash
+
+    hash_future = _HASH_POOL.submit(calculate_sha256, file_path)
+    content_data = extract_content(str(file_path), str(image_output_dir))
+    return content_data, hash_future.result()
 
 def run_processing_task(url_id: int, port: int):
     """這是在背景執行的單一檔案處理任務。"""
-    # --- 延遲導入 (Lazy Import) ---
-    from tools.content_extractor import extract_content
-    from db.client import get_client
-
-    # 為解決檔案系統競爭條件，在開始時增加一個短暫的延遲
-    time.sleep(1)
-
     log.info(f"背景任務：開始處理檔案 URL ID: {url_id}")
     db_client = get_client()
     final_status = 'processing_failed' # 預設為失敗
@@ -155,20 +351,21 @@ def run_processing_task(url_id: int, port: int):
         file_path = Path(url_record['local_path'])
         if not file_path.is_file():
             raise FileNotFoundError(f"檔案系統中找不到檔案: {file_path}")
+        # 為解決檔案系統競爭條件，確認檔案已寫入完成 (取代原本固定延遲 1 秒)
+        _wait_for_stable_file(file_path)
 
         log.info(f"背景任務：準備處理檔案: {file_path}")
 
-        file_hash = calculate_sha256(file_path)
-
         image_output_dir = file_path.parent / "extracted_images"
-        content_data = extract_content(str(file_path), str(image_output_dir))
+        content_data, file_hash = _hash_and_extract(file_path, image_output_dir)
 
         # 從提取結果中獲取文字和圖片路徑
         text_content = content_data.get("text", "") if content_data else ""
-        image_paths_json = json.dumps(content_data.get("image_paths", [])) if content_data else "[]"
+        image_paths = content_data.get("image_paths", []) if content_data else []
+        image_paths_json = orjson.dumps(image_paths).decode()
 
         # 檢查內容提取是否成功，並設定對應的狀態
-        if not text_content and not json.loads(image_paths_json):
+        if not text_content and not image_paths:
             # 如果文字和圖片都為空，標記為不支援或空檔案
             status = 'processed_unsupported'
             status_message = '不支援的檔案類型或檔案為空，無法提取任何內容。'
@@ -218,14 +415,14 @@ def run_processing_task(url_id: int, port: int):
             notification_payload = {
                 "task_id": str(url_id),
                 "status": final_status,
-                "result": json.dumps(result_payload),
+                "result": orjson.dumps(result_payload).decode(),
                 "task_type": "processing"
             }
             # 將檔名加入 payload，以便前端顯示更清晰的日誌
             if file_path:
                 notification_payload["filename"] = file_path.name
 
-            requests.post(
+            _NOTIFY_SESSION.post(
                 f"http://127.0.0.1:{port}/api/internal/notify_task_update",
                 json=notification_payload,
                 timeout=5
@@ -235,7 +432,7 @@ def run_processing_task(url_id: int, port: int):
             log.error(f"背景任務：為 URL ID {url_id} 發送處理完成通知時失敗: {e}")
 
 @router.post("/start_processing")
-async def start_processing(payload: ProcessRequest, background_tasks: BackgroundTasks, request: Request):
+async def start_processing(payload: ProcessRequest, request: Request):
     """接收要處理的檔案 ID 列表，並為每一個 ID 建立一個背景處理任務。"""
     url_ids = payload.ids
     if not url_ids:
@@ -247,25 +444,24 @@ async def start_processing(payload: ProcessRequest, background_tasks: Background
     # 而不是使用 request.url.port，因為後者在反向代理後可能不正確。
     port = request.app.state.server_port
 
-    conn = None
     try:
-        conn = get_db_connection()
-        with conn:
-            placeholders = ','.join('?' for _ in url_ids)
-            sql = f"UPDATE extracted_urls SET status = 'processing', status_message = '已加入處理佇列' WHERE id IN ({placeholders})"
-            cursor = conn.cursor()
-            cursor.execute(sql, url_ids)
-            log.info(f"API: 已將 {cursor.rowcount} 個檔案的狀態更新為 'processing'。")
-
+        async with acquire_conn() as conn:
+            with conn:
+                placeholders = ','.join('?' for _ in url_ids)
+                sql = f"UPDATE extracted_urls SET status = 'processing', status_message = '已加入處理佇列' WHERE id IN ({placeholders})"
+                cursor = conn.cursor()
+                cursor.execute(sql, url_ids)
+                log.info(f"API: 已將 {cursor.rowcount} 個檔案的狀態更新為 'processing'。")
+
+        # 每個檔案提交到程序池平行處理；結果由子程序自行寫回資料庫並發送通知
+        pool = _get_process_pool()
         for url_id in url_ids:
-            background_tasks.add_task(run_processing_task, url_id, port)
+            future = pool.submit(run_processing_task, url_id, port)
+            future.add_done_callback(lambda f, url_id=url_id: _log_processing_failure(url_id, f))
 
-        return JSONResponse(
+        return ORJSONResponse(
             content={"message": f"已成功為 {len(url_ids)} 個項目建立背景處理任務。"}
         )
     except Exception as e:
         log.error(f"API: 啟動處理任務時發生錯誤: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="啟動處理任務時發生伺服器內部錯誤。")
-    finally:
-        if conn:
-            conn.close()
@@ -1,25 +1,29 @@
 # --- 檔案: src/api/routes/page4_analyzer.py ---
 # --- 說明: 此檔案已於 2025-09-12 重構，以支援兩階段 AI 分析流程。---
 
+import functools
+import itertools
 import logging
-import sys
-import json
-import uuid
-import requests
+import os
+import string
+import time
+from concurrent.futures import ThreadPoolExecutor
+import orjson
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple
 
-from fastapi import APIRouter, HTTPException, Request, BackgroundTasks, Depends
+from fastapi import APIRouter, HTTPException, Request, Depends, Query
+from fastapi.responses import FileResponse, ORJSONResponse, Response
 from pydantic import BaseModel
 
-# --- 路徑修正與模듈匯入 ---
+# --- 模組匯入 ---
+# 本模組只會經由 api.api_server (或已設定 pythonpath 的測試) 匯入，src 目錄此時已在搜尋路徑中。
 SRC_DIR = Path(__file__).resolve().parent.parent.parent
-sys.path.insert(0, str(SRC_DIR))
 
 # --- 核心模組匯入 ---
 from db.client import get_client
-from db.database import get_db_connection
-from core import key_manager, prompt_manager
+from db.database import acquire_conn, pooled_connection
+from core import analysis_cache, key_manager, prompt_manager
 from tools.gemini_manager import GeminiManager
 
 # --- 常數與設定 ---
@@ -29,50 +33,188 @@ DB_CLIENT = get_client()
 TEMP_JSON_DIR = SRC_DIR.parent / "temp_json"
 REPORTS_DIR = SRC_DIR.parent / "reports"
 
+# 可供分析的檔案列表與分析任務列表以 LIMIT/OFFSET 分頁 (與 page3_processor 的列表端點相同)
+LIST_PAGE_SIZE = 500
+LIST_PAGE_MAX = 5000
+# 還有下一頁時，以此回應標頭告知下一頁的 offset；沒有此標頭表示已是最後一頁
+NEXT_OFFSET_HEADER = "X-Next-Offset"
+SQL_LIST_ANALYZABLE = (
+    "SELECT id, local_filename, status, status_message FROM extracted_urls "
+    "WHERE (status LIKE 'processed%' OR status = 'analyzed') AND local_filename IS NOT NULL "
+    "ORDER BY created_at DESC LIMIT ? OFFSET ?"
+)
+
 # 確保暫存和報告目錄存在
 TEMP_JSON_DIR.mkdir(exist_ok=True)
 REPORTS_DIR.mkdir(exist_ok=True)
 
+# 產出檔名以「任務 ID + 遞增序號」區分同一任務的多次執行，取代每個任務都讀取一次系統亂數的 uuid4。
+# 序號的起點在程序啟動時隨機決定一次，伺服器重新啟動後重跑同一任務也不會覆寫先前的產出。
+_FILE_COUNTER = itertools.count(int.from_bytes(os.urandom(4), "big"))
+
+def _next_file_suffix() -> str:
+    """回傳產出檔名使用的 8 位十六進位序號。"""
+    return f"{next(_FILE_COUNTER) & 0xFFFFFFFF:08x}"
+
 import asyncio
 
 # --- Pydantic 模型 ---
+# force 為 True 時略過分析快取，重新呼叫 AI 並以新結果取代快取項目 (例如使用者對先前的結果不滿意)
 class Stage1Request(BaseModel):
     file_ids: List[int]
     model_name: str
+    force: bool = False
 
 class Stage2Request(BaseModel):
     task_ids: List[int]
     model_name: str
+    force: bool = False
+
+# --- 提示詞與金鑰快取 ---
+# 每個分析任務都需要提示詞與有效金鑰，兩者都是讀取並解析 JSON 檔案，且在一批任務之間幾乎不會改變。
+# 以「目前的分鐘數 + 檔案修改時間」作為快取鍵：快取最多存活一分鐘，
+# 而透過 page6 / page7 修改金鑰或提示詞時會更新檔案修改時間，使快取立即失效。
+CONFIG_CACHE_TTL = 60
+
+def _config_version(path: Path) -> tuple:
+    """回傳目前時間區段與檔案修改時間組成的快取版本標記。"""
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        mtime = None
+    return int(time.time() // CONFIG_CACHE_TTL), mtime
+
+@functools.lru_cache(maxsize=1)
+def _cached_prompts(version_tag: tuple) -> Dict[str, Any]:
+    return prompt_manager.get_all_prompts()
+
+@functools.lru_cache(maxsize=1)
+def _cached_valid_keys(version_tag: tuple) -> List[Dict[str, str]]:
+    return key_manager.get_all_valid_keys_for_manager()
+
+def _get_prompts() -> Dict[str, Any]:
+    """取得所有提示詞 (快取版本)。"""
+    return _cached_prompts(_config_version(prompt_manager.PROMPTS_FILE))
+
+def _get_valid_keys() -> List[Dict[str, str]]:
+    """取得所有有效金鑰 (快取版本)。"""
+    return _cached_valid_keys(_config_version(key_manager.KEYS_FILE))
+
+# --- 提示詞範本 ---
+# 每個任務都以 str.format 套用範本，每次都要重新掃描整份範本尋找佔位符。
+# 改為在第一次使用時把範本拆成佔位符前後兩段 (依範本字串快取，修改提示詞後自然使用新的結果)，
+# 之後每個任務只需把兩段與內容串接起來。
+@functools.lru_cache(maxsize=8)
+def _split_prompt_template(template: str, field_name: str) -> Tuple[str, str]:
+    """
+    將範本拆成佔位符 {field_name} 前後的文字 (與 str.format 相同，{{ 與 }} 會還原為單一大括號)。
+    範本必須恰好包含一個不帶格式設定的該佔位符，否則立即拋出 ValueError。
+    """
+    parts = list(string.Formatter().parse(template))
+    fields = [i for i, (_, name, _, _) in enumerate(parts) if name is not None]
+    if len(fields) != 1 or parts[fields[0]][1] != field_name or parts[fields[0]][2] or parts[fields[0]][3]:
+        raise ValueError(f"提示詞範本必須恰好包含一個 {{{field_name}}} 佔位符。")
+    index = fields[0]
+    prefix = "".join(literal for literal, _, _, _ in parts[:index + 1])
+    suffix = "".join(literal for literal, _, _, _ in parts[index + 1:])
+    return prefix, suffix
+
+def _fill_prompt(template: str, field_name: str, value: str) -> str:
+    """以預先拆好的前後文字組出提示詞，結果與 template.format(**{field_name: value}) 相同。"""
+    prefix, suffix = _split_prompt_template(template, field_name)
+    return "".join((prefix, value, suffix))
+
+# 第一階段批次分析的提示詞由使用者的第一階段提示詞衍生 (頁面 7 編輯的就是它)：
+# 單篇文章的指示原樣保留，前後加上「逐篇套用並回傳 JSON 陣列」的說明，文章陣列放在最後。
+# 因此同一份文件不論是否與其他文件合併分析，擷取的欄位與格式都相同。
+STAGE1_BATCH_HEADER = (
+    "以下是針對「單篇文章」的分析指示。本次在文末以 JSON 陣列提供多篇文章，每篇都有 \"id\" 與 \"text\"。\n"
+    "請把指示逐篇套用到每篇文章的 text，並回傳一個 JSON 陣列：每篇文章一個物件，內容就是該篇依指示應回傳的 JSON 物件，"
+    "再加上 \"id\" 欄位原樣帶回該篇的 id。不要有任何多餘的文字或解釋。\n\n"
+    "=== 單篇文章的分析指示 ===\n"
+)
+STAGE1_BATCH_DOCUMENT_PLACEHOLDER = "(各篇文章的內容見文末文章列表中的 text 欄位)"
+STAGE1_BATCH_FOOTER = "\n=== 指示結束 ===\n\n文章列表：\n---\n"
+STAGE1_BATCH_TRAILER = "\n---"
+
+@functools.lru_cache(maxsize=8)
+def _stage1_batch_prompt_prefix(stage1_template: str) -> str:
+    """回傳批次提示詞中文章列表之前的靜態部分 (範本缺少 {document_text} 時拋出 ValueError)。"""
+    instructions = _fill_prompt(stage1_template, "document_text", STAGE1_BATCH_DOCUMENT_PLACEHOLDER)
+    return STAGE1_BATCH_HEADER + instructions + STAGE1_BATCH_FOOTER
+
+# --- Gemini 管理器快取 ---
+# GeminiManager 的金鑰輪換順序與冷卻狀態都保存在實例中；每個任務各自建立新實例時，
+# 剛遭遇配額錯誤的金鑰會在下一個任務中立即被再次使用。以金鑰組合作為快取鍵，
+# 讓所有任務共用同一個管理器 (其內部以鎖保護，可供多個分析執行緒同時使用)；
+# 金鑰組合改變 (新增、刪除或輪替金鑰) 時，快取鍵不同，會建立新的管理器並淘汰舊的。
+@functools.lru_cache(maxsize=1)
+def _cached_gemini_manager(key_set: tuple) -> GeminiManager:
+    return GeminiManager(api_keys=[{"name": name, "value": value} for name, value in key_set])
+
+def _get_gemini_manager(valid_keys: List[Dict[str, str]]) -> GeminiManager:
+    """取得使用指定金鑰組合的 GeminiManager (跨任務共用的快取實例)。"""
+    return _cached_gemini_manager(tuple((k["name"], k["value"]) for k in valid_keys))
 
 # --- WebSocket 通知輔助函式 ---
+# 分析任務會頻繁發送「處理中 / 完成」通知；共用一個 Session 重複使用本機的 keep-alive 連線。
+# requests 只在發送通知時才需要，延後到第一次發送時才匯入並建立 Session，縮短本模組的匯入時間。
+# 通知只由單一的通知執行緒發送，建立 Session 不需要加鎖。
+_NOTIFY_SESSION = None
+
 def _send_websocket_notification(server_port: int, message: Dict):
     """向主伺服器的內部端點發送通知。"""
+    global _NOTIFY_SESSION
+    import requests
+    if _NOTIFY_SESSION is None:
+        _NOTIFY_SESSION = requests.Session()
     try:
         # 修正：使用在 api_server.py 中註冊的正確端點
         url = f"http://127.0.0.1:{server_port}/api/internal/notify_task_update"
         # 讓 payload 自身包含足夠的類型資訊
-        response = requests.post(url, json=message, timeout=5)
+        response = _NOTIFY_SESSION.post(url, json=message, timeout=5)
         response.raise_for_status()
     except requests.RequestException as e:
         log.error(f"無法發送 WebSocket 通知: {e}")
 
+# run_analysis_task_wrapper 在事件迴圈上執行，若直接同步 POST 到本機伺服器，會在等待回應期間
+# 阻塞事件迴圈，而處理該請求的正是同一個事件迴圈，只能等到逾時才會繼續。
+# 改為交給專用的單一執行緒發送：呼叫端立即返回，單一執行緒也確保通知依排入順序送出
+# (同一任務的「處理中」一定早於最終狀態)。
+_NOTIFY_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="notify")
+
+def _queue_websocket_notification(server_port: int, message: Dict):
+    """將通知排入背景執行緒發送，不等待回應。"""
+    _NOTIFY_EXECUTOR.submit(_send_websocket_notification, server_port, message)
+
+def _write_atomically(path: Path, data: bytes):
+    """
+    以單次寫入把整份內容寫到暫存檔，再以 os.replace 原子性地換成目標檔名。
+    讀取端 (第二階段、結果端點、分析快取) 只會看到完整的檔案，不會讀到寫到一半的內容。
+    """
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, path)
+
 # --- 重構後的背景任務函式 (同步阻塞部分) ---
-def _run_stage1_blocking_task(task_id: int, file_id: int, model_name: str, server_port: int):
+def _run_stage1_blocking_task(task_id: int, file_id: int, model_name: str, server_port: int, force: bool = False) -> Dict[str, Any]:
     """
     執行第一階段 AI 分析的同步阻塞部分。
+    :param force: 為 True 時略過分析快取，一定重新呼叫 API。
+    :return: 寫入資料庫的最終狀態欄位，供包裝函式直接作為通知內容，不需再讀回整筆任務。
     """
     log.info(f"第一階段任務實際執行開始：task_id={task_id}, file_id={file_id}, model={model_name}")
     try:
-        # 1. 初始化 Gemini Manager
-        all_prompts = prompt_manager.get_all_prompts()
+        # 1. 取得提示詞與 Gemini Manager
+        all_prompts = _get_prompts()
         prompt_template = all_prompts.get("stage_1_extraction_prompt")
         if not prompt_template:
             raise ValueError("在提示詞庫中找不到 'stage_1_extraction_prompt'。")
 
-        valid_keys = key_manager.get_all_valid_keys_for_manager()
+        valid_keys = _get_valid_keys()
         if not valid_keys:
             raise ValueError("在金鑰池中找不到任何有效的 API 金鑰。")
-        gemini = GeminiManager(api_keys=valid_keys)
+        gemini = _get_gemini_manager(valid_keys)
 
         # 2. 從資料庫獲取檔案內容
         analysis_task_data = DB_CLIENT.get_analysis_task(task_id=task_id)
@@ -80,30 +222,142 @@ def _run_stage1_blocking_task(task_id: int, file_id: int, model_name: str, serve
             raise ValueError(f"分析任務 {task_id} 中找不到可供分析的檔案內容 (file_content_for_analysis)。")
         text_content = analysis_task_data['file_content_for_analysis']
 
-        # 3. 執行 AI 資料提取
-        prompt = prompt_template.format(document_text=text_content)
-        structured_data, error, used_key = gemini.prompt_for_json(prompt=prompt, model_name=model_name)
-        if error:
-            raise error
-
-        # 4. 儲存 JSON 結果到檔案
-        json_filename = f"stage1_{task_id}_{uuid.uuid4().hex[:8]}.json"
+        # 3. 執行 AI 資料提取 (相同模型與提示詞已分析過時，直接從快取還原結果)
+        prompt = _fill_prompt(prompt_template, "document_text", text_content)
+        json_filename = f"stage1_{task_id}_{_next_file_suffix()}.json"
         json_path = TEMP_JSON_DIR / json_filename
-        with open(json_path, "w", encoding="utf-8") as f:
-            json.dump(structured_data, f, ensure_ascii=False, indent=2)
+        cache_key = analysis_cache.make_key(model_name, prompt)
+        if not force and analysis_cache.restore(cache_key, json_path):
+            log.info(f"第一階段任務命中分析快取：task_id={task_id}，略過 API 呼叫。")
+        else:
+            structured_data, error, used_key = gemini.prompt_for_json(prompt=prompt, model_name=model_name)
+            if error:
+                raise error
+
+            # 4. 儲存 JSON 結果到檔案
+            # orjson 以 C 擴充一次序列化為 UTF-8 位元組 (效果等同 ensure_ascii=False)；
+            # OPT_NON_STR_KEYS 讓模型回傳的非字串鍵也能如 json.dumps 般輸出。
+            # 此檔案只供第二階段作為提示詞使用，不加縮排：縮排的空白也會計入提示詞的 token
+            _write_atomically(json_path, orjson.dumps(structured_data, option=orjson.OPT_NON_STR_KEYS))
+            analysis_cache.store(cache_key, json_path, overwrite=force)
 
         # 5. 更新任務狀態為「完成」
-        DB_CLIENT.update_analysis_task(task_id=task_id, updates={"stage1_status": "completed", "stage1_json_path": str(json_path)})
+        updates = {"stage1_status": "completed", "stage1_json_path": str(json_path)}
+        DB_CLIENT.update_analysis_task(task_id=task_id, updates=updates)
         log.info(f"第一階段任務成功：task_id={task_id}，JSON 已儲存至 {json_path}")
 
     except Exception as e:
         error_message = f"錯誤: {type(e).__name__}: {str(e)}"
         log.error(f"第一階段任務失敗：task_id={task_id}，{error_message}", exc_info=True)
-        DB_CLIENT.update_analysis_task(task_id=task_id, updates={"stage1_status": "failed", "stage1_error_log": error_message})
+        updates = {"stage1_status": "failed", "stage1_error_log": error_message}
+        DB_CLIENT.update_analysis_task(task_id=task_id, updates=updates)
+    return {"id": task_id, **updates}
+
+def _run_stage1_batch_blocking_task(task_ids: List[int], file_ids: List[int], model_name: str, server_port: int, force: bool = False) -> Dict[int, Dict[str, Any]]:
+    """
+    以一次 Gemini 呼叫完成多份小型文件的第一階段分析，再把回應的 JSON 陣列拆回各任務的 JSON 檔。
+    提示詞庫中沒有第一階段提示詞時，退回逐一執行單檔流程 (由單檔流程記錄各任務的錯誤)。
+    :param force: 為 True 時略過分析快取，整批文件都重新送出分析。
+    :return: 以任務 ID 為鍵，各任務寫入資料庫的最終狀態欄位。
+    """
+    prompt_template = _get_prompts().get("stage_1_extraction_prompt")
+    if not prompt_template:
+        log.warning("在提示詞庫中找不到 'stage_1_extraction_prompt'，改為逐一執行第一階段分析。")
+        return {
+            task_id: _run_stage1_blocking_task(task_id=task_id, file_id=file_id, model_name=model_name, server_port=server_port, force=force)
+            for task_id, file_id in zip(task_ids, file_ids)
+        }
+
+    log.info(f"第一階段批次任務實際執行開始：task_ids={task_ids}, model={model_name}")
+    updates_by_id = _analyze_stage1_batch(task_ids, model_name, prompt_template, force)
+    # 整批任務的最終狀態以一次請求、在同一個交易中寫入，取代逐個任務各自提交
+    if updates_by_id:
+        DB_CLIENT.update_analysis_tasks(items=[[task_id, updates] for task_id, updates in updates_by_id.items()])
+    return {task_id: {"id": task_id, **updates} for task_id, updates in updates_by_id.items()}
+
+def _analyze_stage1_batch(task_ids: List[int], model_name: str, prompt_template: str, force: bool = False) -> Dict[int, Dict[str, Any]]:
+    """
+    執行第一階段批次分析並寫出各任務的 JSON 檔，但不寫入資料庫。
+    :param prompt_template: 使用者的第一階段 (單篇文章) 提示詞範本，批次提示詞由它衍生。
+    :param force: 為 True 時略過分析快取，並以新結果取代各文件的快取項目。
+    :return: 以任務 ID 為鍵，各任務應寫入資料庫的最終狀態欄位。
+    """
+    documents, final_states = [], {}
+    # 尚未命中快取、需要送出分析的文件：任務 ID -> (輸出路徑, 單份文件的快取鍵)
+    outputs: Dict[int, tuple] = {}
 
-def _run_stage2_blocking_task(task_id: int, model_name: str, server_port: int):
+    def finish(task_id: int, updates: Dict[str, Any]):
+        final_states[task_id] = updates
+    try:
+        prompt_prefix = _stage1_batch_prompt_prefix(prompt_template)
+        # 整批文件的內容以一次 DBClient 請求取回，合併後的 API 呼叫之前不再有逐份文件的往返
+        content_by_id = dict(DB_CLIENT.get_analysis_task_contents(task_ids=task_ids) or [])
+        for task_id in task_ids:
+            text_content = content_by_id.get(task_id)
+            if not text_content:
+                finish(task_id, {
+                    "stage1_status": "failed",
+                    "stage1_error_log": f"錯誤: ValueError: 分析任務 {task_id} 中找不到可供分析的檔案內容 (file_content_for_analysis)。"
+                })
+                continue
+            # 整批的提示詞取決於分組方式，無法作為快取鍵；改以「範本 + 單份文件內容」逐份快取，
+            # 同一份文件重新分析 (不論與哪些文件同批) 時直接還原先前的結果
+            json_path = TEMP_JSON_DIR / f"stage1_{task_id}_{_next_file_suffix()}.json"
+            cache_key = analysis_cache.make_document_key(model_name, prompt_prefix, text_content)
+            if not force and analysis_cache.restore(cache_key, json_path):
+                finish(task_id, {"stage1_status": "completed", "stage1_json_path": str(json_path)})
+                continue
+            documents.append({"id": task_id, "text": text_content})
+            outputs[task_id] = (json_path, cache_key)
+        if not documents:
+            log.info(f"第一階段批次任務全部命中分析快取或缺少內容：task_ids={task_ids}，略過 API 呼叫。")
+            return final_states
+
+        valid_keys = _get_valid_keys()
+        if not valid_keys:
+            raise ValueError("在金鑰池中找不到任何有效的 API 金鑰。")
+        gemini = _get_gemini_manager(valid_keys)
+
+        # 所有文件以 JSON 陣列放在提示詞結尾，靜態指示仍是逐字相同的前綴
+        prompt = "".join((prompt_prefix, orjson.dumps(documents).decode(), STAGE1_BATCH_TRAILER))
+        results, error, used_key = gemini.prompt_for_json(prompt=prompt, model_name=model_name)
+        if error:
+            raise error
+        if not isinstance(results, list):
+            raise ValueError("批次分析的回應不是 JSON 陣列。")
+    except Exception as e:
+        error_message = f"錯誤: {type(e).__name__}: {str(e)}"
+        log.error(f"第一階段批次任務失敗：task_ids={task_ids}，{error_message}", exc_info=True)
+        # 尚未有結果的任務 (包含範本無效或讀取內容失敗時的整批任務) 都標記為失敗
+        for task_id in task_ids:
+            if task_id not in final_states:
+                finish(task_id, {"stage1_status": "failed", "stage1_error_log": error_message})
+        return final_states
+
+    # 模型常把 id 以字串帶回 (例如 "12")，兩邊都以字串比對，避免整批因型別不同而全部對不上
+    result_by_id = {str(item.get("id")): item for item in results if isinstance(item, dict)}
+    completed = 0
+    for document in documents:
+        task_id = document["id"]
+        item = result_by_id.get(str(task_id))
+        if item is None:
+            finish(task_id, {"stage1_status": "failed", "stage1_error_log": "錯誤: 批次分析的回應中缺少此文件的結果。"})
+            continue
+        structured_data = {key: value for key, value in item.items() if key != "id"}
+        json_path, cache_key = outputs[task_id]
+        # 以內容去除重複，不同文件得到相同結果時只建立硬連結
+        analysis_cache.write_deduplicated(json_path, orjson.dumps(structured_data, option=orjson.OPT_NON_STR_KEYS))
+        analysis_cache.store(cache_key, json_path, overwrite=force)
+        finish(task_id, {"stage1_status": "completed", "stage1_json_path": str(json_path)})
+        completed += 1
+    log.info(f"第一階段批次任務結束：task_ids={task_ids}，送出分析的 {len(documents)} 份中成功 {completed} 份。")
+    return final_states
+
+def _run_stage2_blocking_task(task_id: int, model_name: str, server_port: int, force: bool = False) -> Dict[str, Any]:
     """
     執行第二階段 AI 分析的同步阻塞部分。
+    :param force: 為 True 時略過分析快取，一定重新呼叫 API。
+    :return: 寫入資料庫的最終狀態欄位，供包裝函式直接作為通知內容，不需再讀回整筆任務。
     """
     log.info(f"第二階段任務實際執行開始：task_id={task_id}, model={model_name}")
     try:
@@ -114,42 +368,84 @@ def _run_stage2_blocking_task(task_id: int, model_name: str, server_port: int):
         json_path = Path(task_data["stage1_json_path"])
         if not json_path.exists():
             raise FileNotFoundError(f"第一階段的 JSON 檔案不存在於路徑：{json_path}")
-        with open(json_path, "r", encoding="utf-8") as f:
-            structured_data = json.load(f)
+        # 第一階段已以 ensure_ascii=False 的緊湊格式寫出 JSON，檔案文字即為提示詞所需的內容，
+        # 直接讀取即可，不需要先解析成 dict 再重新序列化
+        data_package_text = json_path.read_text(encoding="utf-8")
 
-        # 2. 初始化 Gemini Manager
-        all_prompts = prompt_manager.get_all_prompts()
+        # 2. 取得提示詞與 Gemini Manager
+        all_prompts = _get_prompts()
         prompt_template = all_prompts.get("stage_2_generation_prompt")
         if not prompt_template:
             raise ValueError("在提示詞庫中找不到 'stage_2_generation_prompt'。")
-        valid_keys = key_manager.get_all_valid_keys_for_manager()
+        valid_keys = _get_valid_keys()
         if not valid_keys:
             raise ValueError("在金鑰池中找不到任何有效的 API 金鑰。")
-        gemini = GeminiManager(api_keys=valid_keys)
-
-        # 3. 執行 AI 報告生成
-        prompt = prompt_template.format(data_package=json.dumps(structured_data, ensure_ascii=False, indent=2))
-        report_html, error, used_key = gemini.prompt_for_text(prompt=prompt, model_name=model_name)
-        if error:
-            raise error
+        gemini = _get_gemini_manager(valid_keys)
 
-        # 4. 儲存報告
-        report_filename = f"report_{task_id}_{uuid.uuid4().hex[:8]}.html"
+        # 3. 執行 AI 報告生成 (相同模型與提示詞已生成過時，直接從快取還原報告)
+        prompt = _fill_prompt(prompt_template, "data_package", data_package_text)
+        report_filename = f"report_{task_id}_{_next_file_suffix()}.html"
         report_path = REPORTS_DIR / report_filename
-        with open(report_path, "w", encoding="utf-8") as f:
-            f.write(report_html)
+        cache_key = analysis_cache.make_key(model_name, prompt)
+        if not force and analysis_cache.restore(cache_key, report_path):
+            log.info(f"第二階段任務命中分析快取：task_id={task_id}，略過 API 呼叫。")
+        else:
+            report_html, error, used_key = gemini.prompt_for_text(prompt=prompt, model_name=model_name)
+            if error:
+                raise error
+
+            # 4. 儲存報告
+            _write_atomically(report_path, report_html.encode("utf-8"))
+            analysis_cache.store(cache_key, report_path, overwrite=force)
 
         # 5. 更新任務狀態為「完成」
-        DB_CLIENT.update_analysis_task(task_id=task_id, updates={"stage2_status": "completed", "stage2_report_path": str(report_path)})
+        updates = {"stage2_status": "completed", "stage2_report_path": str(report_path)}
+        DB_CLIENT.update_analysis_task(task_id=task_id, updates=updates)
         log.info(f"第二階段任務成功：task_id={task_id}，報告已儲存至 {report_path}")
 
     except Exception as e:
         error_message = f"錯誤: {type(e).__name__}: {str(e)}"
         log.error(f"第二階段任務失敗：task_id={task_id}，{error_message}", exc_info=True)
-        DB_CLIENT.update_analysis_task(task_id=task_id, updates={"stage2_status": "failed", "stage2_error_log": error_message})
-
+        updates = {"stage2_status": "failed", "stage2_error_log": error_message}
+        DB_CLIENT.update_analysis_task(task_id=task_id, updates=updates)
+    return {"id": task_id, **updates}
+
+
+# --- 分析執行緒池 ---
+# 分析任務的阻塞部分 (Gemini 呼叫) 動輒數十秒，若放在預設執行器中，會與應用程式其他的
+# 短暫阻塞呼叫 (檔案、資料庫) 搶用同一批執行緒。改用專屬的執行緒池，大小與
+# app.state.analysis_semaphore 的併發上限相同，持有信號量的任務一定有執行緒可用。
+ANALYSIS_CONCURRENCY = 3
+ANALYSIS_EXECUTOR = ThreadPoolExecutor(max_workers=ANALYSIS_CONCURRENCY, thread_name_prefix="ai-analysis")
+
+# FastAPI 的 BackgroundTasks 會在回應送出後「依序」等待每個背景任務，同一請求排入的分析任務
+# 因此只能一個接一個執行，信號量的併發上限形同虛設。改為各自建立 asyncio 任務，
+# 由信號量與分析執行緒池共同限制同時進行的 Gemini 呼叫數量。
+# 保存進行中任務的參考，避免 asyncio 任務在完成前被垃圾回收
+_analysis_tasks: set[asyncio.Task] = set()
+# 已排入 (包含仍在等待信號量) 或正在執行的分析任務 ID。啟動端點略過其中的任務，避免同一任務被重複排入。
+# 只記錄在記憶體中：伺服器重新啟動或工作意外中止後不會殘留，不像資料庫中的 'processing' 狀態可能永遠無法清除。
+_in_flight_task_ids: set[int] = set()
+
+def _spawn_analysis_task(coro, task_ids: List[int]):
+    """在目前的事件迴圈上建立分析任務並保存其參考，不等待其完成；任務結束 (含取消) 前 task_ids 視為進行中。"""
+    task = asyncio.create_task(coro)
+    _analysis_tasks.add(task)
+    _in_flight_task_ids.update(task_ids)
+
+    def on_done(finished: asyncio.Task):
+        _analysis_tasks.discard(finished)
+        _in_flight_task_ids.difference_update(task_ids)
+    task.add_done_callback(on_done)
+
+def shutdown_analysis_executor():
+    """取消尚未開始的分析並關閉分析執行緒池，應在應用程式關閉時呼叫。"""
+    ANALYSIS_EXECUTOR.shutdown(wait=False, cancel_futures=True)
 
 # --- 新的非同步包裝函式 (用於併發控制) ---
+# 各階段記錄所用模型的欄位 (兩個階段的欄位命名不一致，不能以 f"stage{stage}_model" 組出)
+STAGE_MODEL_COLUMNS = {1: "stage1_model", 2: "stage2_model_used"}
+
 async def run_analysis_task_wrapper(task_id: int, server_port: int, semaphore: asyncio.Semaphore, blocking_func, **kwargs):
     """
     一個通用的非同步包裝函式，用於控制併發並執行阻塞的分析任務。
@@ -157,27 +453,88 @@ async def run_analysis_task_wrapper(task_id: int, server_port: int, semaphore: a
     async with semaphore:
         log.info(f"任務 {task_id} 已取得信號量，準備執行...")
         # 更新任務狀態為「處理中」
-        stage = kwargs.get("stage", 1)
-        DB_CLIENT.update_analysis_task(task_id=task_id, updates={f"stage{stage}_status": "processing", f"stage{stage}_model": kwargs.get("model_name")})
-        _send_websocket_notification(server_port, {"type": "analysis_update", "task_id": task_id, "status": "processing", "stage": stage})
+        # stage 只供包裝函式使用，阻塞函式本身不接受此參數
+        stage = kwargs.pop("stage", 1)
+        # DBClient 是同步的 socket 呼叫，移到執行緒中等待 (與 run_stage1_batch_wrapper 相同)，避免阻塞事件迴圈
+        await asyncio.to_thread(
+            DB_CLIENT.update_analysis_task,
+            task_id=task_id, updates={f"stage{stage}_status": "processing", STAGE_MODEL_COLUMNS[stage]: kwargs.get("model_name")}
+        )
+        _queue_websocket_notification(server_port, {"type": "analysis_update", "task_id": task_id, "status": "processing", "stage": stage})
 
         loop = asyncio.get_running_loop()
+        final_task_state = None
         try:
-            # 在執行器中運行阻塞函式
-            await loop.run_in_executor(None, blocking_func, task_id=task_id, server_port=server_port, **kwargs)
+            # 在專屬的分析執行緒池中運行阻塞函式 (run_in_executor 不接受關鍵字參數，以 partial 綁定)
+            final_task_state = await loop.run_in_executor(
+                ANALYSIS_EXECUTOR, functools.partial(blocking_func, task_id=task_id, server_port=server_port, **kwargs)
+            )
         except Exception as e:
              # 這裡的錯誤應該已經在阻塞函式內部處理過了，但為了保險起見
             log.error(f"包裝函式捕獲到未預期的錯誤 (任務 {task_id}): {e}", exc_info=True)
         finally:
             log.info(f"任務 {task_id} 執行完畢，釋放信號量。")
-            # 總是在最後發送最終狀態的通知
-            final_task_state = DB_CLIENT.get_analysis_task(task_id)
-            _send_websocket_notification(server_port, {"type": "analysis_update", f"task_type": f"analysis_stage_{stage}", "task_id": task_id, "status": final_task_state.get(f'stage{stage}_status'), "result": final_task_state})
+            # 總是在最後發送最終狀態的通知。阻塞函式會回傳它寫入的最終狀態；
+            # 只有在它未能回傳 (例如執行前就拋出例外) 時，才從資料庫讀回
+            if final_task_state is None:
+                final_task_state = await asyncio.to_thread(DB_CLIENT.get_analysis_task, task_id)
+            _queue_websocket_notification(server_port, {"type": "analysis_update", f"task_type": f"analysis_stage_{stage}", "task_id": task_id, "status": final_task_state.get(f'stage{stage}_status'), "result": final_task_state})
+
+# --- 第一階段批次分析 ---
+# 小型文件合併成一次 Gemini 呼叫，分攤每次請求的往返成本與重複的靜態指示前綴。
+# 合併後的文件總字元數與份數都有上限，超過上限的單份大型文件仍走單檔流程。
+STAGE1_BATCH_MAX_CHARS = 30_000
+STAGE1_BATCH_MAX_DOCS = 8
+
+def _plan_stage1_batches(text_lengths: List[int]) -> List[List[int]]:
+    """
+    依輸入順序把文件分組，回傳每組文件在輸入中的索引。
+    每組的文字總長度不超過 STAGE1_BATCH_MAX_CHARS、份數不超過 STAGE1_BATCH_MAX_DOCS。
+    """
+    batches, current, current_chars = [], [], 0
+    for index, length in enumerate(text_lengths):
+        if current and (current_chars + length > STAGE1_BATCH_MAX_CHARS or len(current) >= STAGE1_BATCH_MAX_DOCS):
+            batches.append(current)
+            current, current_chars = [], 0
+        current.append(index)
+        current_chars += length
+    if current:
+        batches.append(current)
+    return batches
+
+async def run_stage1_batch_wrapper(task_ids: List[int], file_ids: List[int], server_port: int, semaphore: asyncio.Semaphore, model_name: str, force: bool = False):
+    """與 run_analysis_task_wrapper 相同，但一次佔用一個併發名額執行整批第一階段任務。"""
+    async with semaphore:
+        log.info(f"批次任務 {task_ids} 已取得信號量，準備執行...")
+        # 整批任務以一次請求、在同一個交易中標記為處理中
+        await asyncio.to_thread(
+            DB_CLIENT.update_analysis_tasks,
+            items=[[task_id, {"stage1_status": "processing", "stage1_model": model_name}] for task_id in task_ids]
+        )
+        for task_id in task_ids:
+            _queue_websocket_notification(server_port, {"type": "analysis_update", "task_id": task_id, "status": "processing", "stage": 1})
+
+        loop = asyncio.get_running_loop()
+        final_states = {}
+        try:
+            final_states = await loop.run_in_executor(
+                ANALYSIS_EXECUTOR,
+                functools.partial(_run_stage1_batch_blocking_task, task_ids=task_ids, file_ids=file_ids, model_name=model_name, server_port=server_port, force=force)
+            )
+        except Exception as e:
+            log.error(f"批次包裝函式捕獲到未預期的錯誤 (任務 {task_ids}): {e}", exc_info=True)
+        finally:
+            log.info(f"批次任務 {task_ids} 執行完畢，釋放信號量。")
+            for task_id in task_ids:
+                final_task_state = final_states.get(task_id)
+                if final_task_state is None:
+                    final_task_state = await asyncio.to_thread(DB_CLIENT.get_analysis_task, task_id)
+                _queue_websocket_notification(server_port, {"type": "analysis_update", "task_type": "analysis_stage_1", "task_id": task_id, "status": final_task_state.get('stage1_status'), "result": final_task_state})
 
 # --- 新的 API 端點 ---
 
 @router.post("/start_stage1_analysis")
-async def start_stage1_analysis(request: Request, payload: Stage1Request, background_tasks: BackgroundTasks):
+async def start_stage1_analysis(request: Request, payload: Stage1Request):
     """啟動第一階段：JSON 提取"""
     if not payload.file_ids:
         raise HTTPException(status_code=400, detail="檔案 ID 列表不可為空。")
@@ -187,37 +544,64 @@ async def start_stage1_analysis(request: Request, payload: Stage1Request, backgr
     if not server_port or not semaphore:
         raise HTTPException(status_code=500, detail="伺服器狀態未完全初始化（缺少埠號或信號量）。")
 
+    # 以單一查詢取回所有檔案的檔名與文字長度 (供批次分組)，取代逐個 ID 的 SELECT
+    requested_ids = list(dict.fromkeys(payload.file_ids))
+    async with acquire_conn(read_only=True) as conn:
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        placeholders = ','.join('?' for _ in requested_ids)
+        rows = cursor.execute(
+            f"SELECT id, local_filename, length(extracted_text) FROM extracted_urls WHERE id IN ({placeholders})", requested_ids
+        ).fetchall()
+        # 分析任務已排入或仍在進行中的檔案不再排入：重設狀態後再分析一次只會重複呼叫 API，且兩個任務會互相覆寫結果。
+        # 檔案對應的任務與 prepare_stage1_analysis_tasks 相同，取最早建立的那一筆
+        busy = set()
+        if _in_flight_task_ids:
+            busy = {file_id for file_id, task_id in cursor.execute(
+                f"SELECT file_id, MIN(id) FROM analysis_tasks WHERE file_id IN ({placeholders}) GROUP BY file_id", requested_ids
+            ) if task_id in _in_flight_task_ids}
+    name_by_id = {r[0]: r[1] for r in rows if r[1]}
+    length_by_id = {r[0]: r[2] or 0 for r in rows}
+    if busy:
+        log.warning(f"跳過檔案 ID {sorted(busy)} 的第一階段分析，因為其分析任務仍在進行中。")
+    file_ids = [file_id for file_id in requested_ids if file_id not in busy]
+    if not file_ids:
+        return {"message": "所選檔案的分析皆仍在進行中，未排入新的第一階段分析。"}
+
+    # 一次請求在同一個交易中建立 (或取得) 所有分析任務並重設狀態，取代逐個檔案的兩次往返
+    files = [[file_id, name_by_id.get(file_id, f"未知檔案_{file_id}")] for file_id in file_ids]
+    # DBClient 是同步的 socket 呼叫，移到執行緒中等待，避免阻塞事件迴圈
+    task_ids = await asyncio.to_thread(DB_CLIENT.prepare_stage1_analysis_tasks, files) or []
+
+    file_ids = file_ids[:len(task_ids)]
     tasks_created = []
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    for file_id in payload.file_ids:
-        cursor.execute("SELECT local_path FROM extracted_urls WHERE id = ?", (file_id,))
-        file_data = cursor.fetchone()
-        filename = Path(file_data['local_path']).name if file_data else f"未知檔案_{file_id}"
-
-        task = DB_CLIENT.create_or_get_analysis_task(file_id=file_id, filename=filename)
-        if task:
-            DB_CLIENT.update_analysis_task(task_id=task['id'], updates={
-                "stage1_status": "pending", "stage1_error_log": None, "stage1_json_path": None,
-                "stage2_status": "pending", "stage2_error_log": None, "stage2_report_path": None
-            })
-            background_tasks.add_task(
-                run_analysis_task_wrapper,
-                task_id=task['id'],
+    for batch in _plan_stage1_batches([length_by_id.get(file_id, 0) for file_id in file_ids]):
+        if len(batch) == 1:
+            _spawn_analysis_task(run_analysis_task_wrapper(
+                task_id=task_ids[batch[0]],
                 server_port=server_port,
                 semaphore=semaphore,
                 blocking_func=_run_stage1_blocking_task,
-                file_id=file_id,
+                file_id=file_ids[batch[0]],
                 model_name=payload.model_name,
+                force=payload.force,
                 stage=1
-            )
-            tasks_created.append(task['id'])
-    conn.close()
+            ), [task_ids[batch[0]]])
+        else:
+            _spawn_analysis_task(run_stage1_batch_wrapper(
+                task_ids=[task_ids[i] for i in batch],
+                file_ids=[file_ids[i] for i in batch],
+                server_port=server_port,
+                semaphore=semaphore,
+                model_name=payload.model_name,
+                force=payload.force
+            ), [task_ids[i] for i in batch])
+        tasks_created.extend(task_ids[i] for i in batch)
 
     return {"message": f"已成功為 {len(tasks_created)} 個檔案排入第一階段分析佇列。"}
 
 @router.post("/start_stage2_analysis")
-async def start_stage2_analysis(request: Request, payload: Stage2Request, background_tasks: BackgroundTasks):
+async def start_stage2_analysis(request: Request, payload: Stage2Request):
     """啟動第二階段：報告生成"""
     if not payload.task_ids:
         raise HTTPException(status_code=400, detail="任務 ID 列表不可為空。")
@@ -227,32 +611,54 @@ async def start_stage2_analysis(request: Request, payload: Stage2Request, backgr
     if not server_port or not semaphore:
         raise HTTPException(status_code=500, detail="無法確定伺服器埠號或信號量。")
 
-    for task_id in payload.task_ids:
-        task_data = DB_CLIENT.get_analysis_task(task_id=task_id)
-        if task_data and task_data['stage1_status'] == 'completed':
-            background_tasks.add_task(
-                run_analysis_task_wrapper,
-                task_id=task_id,
-                server_port=server_port,
-                semaphore=semaphore,
-                blocking_func=_run_stage2_blocking_task,
-                model_name=payload.model_name,
-                stage=2
-            )
-        else:
-            log.warning(f"跳過任務 ID {task_id} 的第二階段分析，因為其第一階段未完成。")
-
-    return {"message": f"已為 {len(payload.task_ids)} 個符合條件的任務啟動第二階段分析。"}
+    # 以單一查詢篩選出第一階段已完成的任務，取代逐個任務透過 DBClient 讀取整筆資料
+    async with acquire_conn(read_only=True) as conn:
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        placeholders = ','.join('?' for _ in payload.task_ids)
+        eligible = {r[0] for r in cursor.execute(
+            f"SELECT id FROM analysis_tasks WHERE id IN ({placeholders}) AND stage1_status = 'completed'", payload.task_ids
+        )}
+
+    scheduled, skipped = [], []
+    for task_id in dict.fromkeys(payload.task_ids):
+        # 已排入或仍在進行中的任務不重複排入
+        if task_id not in eligible or task_id in _in_flight_task_ids:
+            skipped.append(task_id)
+            continue
+        _spawn_analysis_task(run_analysis_task_wrapper(
+            task_id=task_id,
+            server_port=server_port,
+            semaphore=semaphore,
+            blocking_func=_run_stage2_blocking_task,
+            model_name=payload.model_name,
+            force=payload.force,
+            stage=2
+        ), [task_id])
+        scheduled.append(task_id)
+    if skipped:
+        log.warning(f"跳過任務 ID {skipped} 的第二階段分析，因為其第一階段未完成或第二階段仍在進行中。")
+
+    return {"message": f"已為 {len(scheduled)} 個符合條件的任務啟動第二階段分析。"}
 
 @router.get("/analysis_status")
-async def get_analysis_status():
-    """獲取所有分析任務的最新狀態"""
-    tasks = DB_CLIENT.get_all_analysis_tasks()
-    return tasks
+async def get_analysis_status(
+    limit: int = Query(LIST_PAGE_SIZE, ge=1, le=LIST_PAGE_MAX),
+    offset: int = Query(0, ge=0)
+):
+    """獲取分析任務的最新狀態 (依建立時間新到舊分頁，下一頁的 offset 見 NEXT_OFFSET_HEADER)"""
+    # DBClient 是同步的 socket 呼叫，移到執行緒中等待，查詢期間事件迴圈仍可處理其他請求
+    # 多取一筆，用來判斷是否還有下一頁
+    tasks = await asyncio.to_thread(DB_CLIENT.get_all_analysis_tasks, limit=limit + 1, offset=offset) or []
+    next_offset = offset + limit if len(tasks) > limit else None
+    return ORJSONResponse(
+        content=tasks[:limit],
+        headers={NEXT_OFFSET_HEADER: str(next_offset)} if next_offset is not None else None
+    )
 
 @router.get("/stage1_result/{task_id}")
-async def get_stage1_result(task_id: int):
-    """獲取指定任務第一階段產出的 JSON 內容"""
+async def get_stage1_result(task_id: int, pretty: bool = Query(False)):
+    """獲取指定任務第一階段產出的 JSON 內容 (pretty=true 時加上縮排，供人工除錯閱讀)"""
     task = DB_CLIENT.get_analysis_task(task_id=task_id)
     if not task or not task.get("stage1_json_path"):
         raise HTTPException(status_code=404, detail="找不到任務或其第一階段的 JSON 產出。")
@@ -261,33 +667,44 @@ async def get_stage1_result(task_id: int):
     if not json_path.exists():
         raise HTTPException(status_code=404, detail=f"JSON 檔案遺失於路徑：{json_path}")
 
-    with open(json_path, "r", encoding="utf-8") as f:
-        return json.load(f)
+    if pretty:
+        return Response(
+            content=orjson.dumps(orjson.loads(json_path.read_bytes()), option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS),
+            media_type="application/json"
+        )
+    # 檔案內容本身就是 JSON，直接串流回傳，不必先解析再重新序列化
+    return FileResponse(json_path, media_type="application/json")
 
 # --- 保留但可選用的端點 ---
 
+def _list_analyzable_files(limit: int, offset: int) -> list[tuple]:
+    """從唯讀連線池借用連線，以 tuple 取回一頁可供分析的檔案 (欄位順序: id, local_filename, status, status_message)。"""
+    with pooled_connection(read_only=True) as conn:
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        return cursor.execute(SQL_LIST_ANALYZABLE, (limit, offset)).fetchall()
+
 @router.get("/processed_files")
-async def get_processed_files():
+async def get_processed_files(
+    limit: int = Query(LIST_PAGE_SIZE, ge=1, le=LIST_PAGE_MAX),
+    offset: int = Query(0, ge=0)
+):
     """
-    獲取所有已處理、可供分析的檔案列表。
+    獲取已處理、可供分析的檔案列表 (依建立時間新到舊分頁，下一頁的 offset 見 NEXT_OFFSET_HEADER)。
     現在會回傳狀態，以便前端可以禁用不合格的檔案。
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    # 選擇性地獲取所有相關狀態的檔案
-    cursor.execute("SELECT id, local_path, status, status_message FROM extracted_urls WHERE status LIKE 'processed%' OR status = 'analyzed' ORDER BY created_at DESC")
-    rows = cursor.fetchall()
-    conn.close()
-    results = []
-    for row in rows:
-        if row['local_path']:
-            results.append({
-                "id": row['id'],
-                "filename": Path(row['local_path']).name,
-                "status": row['status'],
-                "status_message": row['status_message']
-            })
-    return results
+    # 查詢與取回結果都在執行緒中進行，大型資料表的查詢不會阻塞事件迴圈上的其他請求
+    # 多取一筆，用來判斷是否還有下一頁
+    rows = await asyncio.to_thread(_list_analyzable_files, limit + 1, offset)
+    next_offset = offset + limit if len(rows) > limit else None
+    # 直接回傳 ORJSONResponse，略過 FastAPI 對回傳值逐筆執行的 jsonable_encoder
+    return ORJSONResponse(
+        content=[
+            {"id": file_id, "filename": filename, "status": status, "status_message": status_message}
+            for file_id, filename, status, status_message in rows[:limit]
+        ],
+        headers={NEXT_OFFSET_HEADER: str(next_offset)} if next_offset is not None else None
+    )
 
 # --- 已棄用的舊版分析流程 ---
 
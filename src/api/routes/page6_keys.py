@@ -1,15 +1,12 @@
 # src/api/routes/page6_keys.py
 import logging
-import sys
-from pathlib import Path
 from typing import Optional
 
 from fastapi import APIRouter, HTTPException, Body
 from pydantic import BaseModel, Field
 
-# --- 路徑修正與模組匯入 ---
-SRC_DIR = Path(__file__).resolve().parent.parent.parent
-sys.path.insert(0, str(SRC_DIR))
+# --- 模組匯入 ---
+# 本模組只會經由 api.api_server (或已設定 pythonpath 的測試) 匯入，src 目錄此時已在搜尋路徑中。
 
 from core import key_manager
 from tools.gemini_manager import GeminiManager
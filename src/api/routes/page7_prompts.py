@@ -1,14 +1,11 @@
 # src/api/routes/page7_prompts.py
 import logging
-import sys
-from pathlib import Path
 from typing import Dict, Any
 
 from fastapi import APIRouter, HTTPException, Request
 
-# --- 路徑修正與模組匯入 ---
-SRC_DIR = Path(__file__).resolve().parent.parent.parent
-sys.path.insert(0, str(SRC_DIR))
+# --- 模組匯入 ---
+# 本模組只會經由 api.api_server (或已設定 pythonpath 的測試) 匯入，src 目錄此時已在搜尋路徑中。
 
 from core import prompt_manager
 
@@ -2,7 +2,6 @@
 # --- 說明: 提供檔案總覽頁面所需的後端 API ---
 
 import logging
-import sys
 import json
 from pathlib import Path
 from typing import List, Dict, Any
@@ -10,9 +9,9 @@ from typing import List, Dict, Any
 from fastapi import APIRouter, HTTPException, Request, Query
 from pydantic import BaseModel
 
-# --- 路徑修正與模듈匯入 ---
+# --- 模組匯入 ---
+# 本模組只會經由 api.api_server (或已設定 pythonpath 的測試) 匯入，src 目錄此時已在搜尋路徑中。
 SRC_DIR = Path(__file__).resolve().parent.parent.parent
-sys.path.insert(0, str(SRC_DIR))
 
 # --- 核心模組匯入 ---
 from db.client import get_client
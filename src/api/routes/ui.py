@@ -1,11 +1,10 @@
 from fastapi import APIRouter, Request
 from fastapi.responses import HTMLResponse
-from fastapi.templating import Jinja2Templates
-from pathlib import Path
 
-# --- 路徑與樣板設定 ---
-SRC_DIR = Path(__file__).resolve().parent.parent.parent
-templates = Jinja2Templates(directory=str(SRC_DIR / "static"))
+# --- 樣板設定 ---
+# 使用 core.rendering 中全應用程式共用的樣板引擎
+from core.rendering import templates
+
 router = APIRouter()
 
 # --- UI 頁面路由 ---
@@ -0,0 +1,13 @@
+# --- 檔案: src/api/server_main.py ---
+"""
+API 伺服器的啟動入口 (python -m api.server_main --port <埠號>)。
+
+頁面三的處理程序池以 spawn 啟動子程序，子程序會以 __mp_main__ 的名稱重新匯入主模組。
+若直接以 python -m api.api_server 啟動，每個子程序都會在匯入時建立整個 FastAPI 應用、
+所有路由、執行緒池並建立上傳/報告/下載目錄，只為了執行單純的檔案處理函式。
+本模組只在真正作為主程式執行時才匯入 api_server，子程序重新匯入它時沒有任何副作用。
+"""
+
+if __name__ == "__main__":
+    from api.api_server import main
+    main()
@@ -0,0 +1,175 @@
+# src/core/analysis_cache.py
+"""
+AI 分析結果的內容定址快取。
+
+第一、二階段分析都是一次耗時數秒到數分鐘、且會消耗 API 配額的 Gemini 呼叫。
+同一份文件 (或同一份第一階段結果) 以相同模型與提示詞重新分析時，輸出理應相同，
+因此以「模型名稱 + 完整提示詞」的 SHA256 作為鍵，把產出的檔案保存在快取目錄中，
+命中時直接以硬連結還原成新的輸出檔，略過 API 呼叫。
+
+批次分析的提示詞取決於分組方式，無法作為鍵；其拆出的各文件結果改以
+「模型名稱 + 提示詞範本 + 單份文件內容」逐份快取，並以輸出內容本身的 SHA256
+去除重複：相同內容只寫入一次，之後的輸出檔都是指向同一份資料的硬連結。
+
+快取有上限：應用程式啟動時以 prune 刪除超過保存期限或超出數量上限的項目
+(命中時會更新項目的修改時間，因此最先淘汰的是最久未使用的項目)。
+使用者需要重新呼叫 AI 時 (例如對結果不滿意)，分析端點以 force 略過 restore，
+新的結果會以 store(..., overwrite=True) 取代舊的快取項目。
+"""
+import hashlib
+import logging
+import os
+import shutil
+import time
+import uuid
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+# --- 常數 ---
+SRC_DIR = Path(__file__).resolve().parent.parent
+CACHE_DIR = SRC_DIR.parent / "temp_json" / "analysis_cache"
+BY_HASH_DIR_NAME = "by_hash"
+# 快取項目的保存期限與數量上限 (超過者由 prune 刪除)
+MAX_AGE_SECONDS = 30 * 24 * 60 * 60
+MAX_ENTRIES = 2000
+
+def make_key(model_name: str, prompt: str) -> str:
+    """以模型名稱與完整提示詞計算快取鍵 (十六進位 SHA256)。"""
+    digest = hashlib.sha256(model_name.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(prompt.encode("utf-8"))
+    return digest.hexdigest()
+
+def make_document_key(model_name: str, template: str, text: str) -> str:
+    """以模型名稱、提示詞範本與單份文件內容計算快取鍵，供一次分析多份文件的批次結果逐份快取。"""
+    digest = hashlib.sha256(model_name.encode("utf-8"))
+    for part in (template, text):
+        digest.update(b"\0")
+        digest.update(part.encode("utf-8"))
+    return digest.hexdigest()
+
+def _entry_path(key: str, suffix: str) -> Path:
+    return CACHE_DIR / f"{key}{suffix}"
+
+def _link_or_copy(src: Path, dest: Path):
+    """優先建立硬連結 (不複製資料)；跨檔案系統或不支援硬連結時改為複製。"""
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+
+def restore(key: str, dest: Path) -> bool:
+    """
+    若快取中有此鍵的結果，將其還原到 dest。
+    :return: 命中快取並成功還原時回傳 True。
+    """
+    entry = _entry_path(key, dest.suffix)
+    if not entry.is_file():
+        return False
+    try:
+        _link_or_copy(entry, dest)
+    except OSError as e:
+        log.warning(f"還原分析快取 {entry.name} 失敗，改為重新分析: {e}")
+        return False
+    try:
+        # 以修改時間記錄最近一次使用，prune 依此淘汰最久未使用的項目
+        os.utime(entry)
+    except OSError:
+        pass
+    return True
+
+def store(key: str, src: Path, overwrite: bool = False):
+    """
+    將剛產出的結果檔加入快取。失敗只記錄警告，不影響分析流程。
+    (輸出檔與快取共用同一份資料，輸出檔寫出後不應再原地修改)
+    :param overwrite: 為 True 時取代既有的項目 (略過快取重新分析後使用)，否則保留既有項目。
+    """
+    entry = _entry_path(key, src.suffix)
+    if entry.exists() and not overwrite:
+        return
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        # 先寫到暫存名稱再原子性地改名，避免並行的任務讀到不完整的快取項目
+        tmp_path = entry.with_name(f"{entry.name}.{uuid.uuid4().hex[:8]}.tmp")
+        _link_or_copy(src, tmp_path)
+        os.replace(tmp_path, entry)
+    except OSError as e:
+        log.warning(f"寫入分析快取 {entry.name} 失敗: {e}")
+
+def write_deduplicated(dest: Path, data: bytes):
+    """
+    將 data 寫成 dest。內容相同的資料先前已寫過時，直接建立指向既有資料的硬連結，不再重寫檔案。
+    去除重複失敗時 (例如快取目錄無法寫入) 退回一般寫入。
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    entry = CACHE_DIR / BY_HASH_DIR_NAME / digest[:2] / f"{digest}{dest.suffix}"
+    try:
+        if not entry.is_file():
+            entry.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = entry.with_name(f"{entry.name}.{uuid.uuid4().hex[:8]}.tmp")
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, entry)
+        _link_or_copy(entry, dest)
+        return
+    except OSError as e:
+        log.warning(f"以內容雜湊去除重複寫入 {dest.name} 失敗，改為直接寫入: {e}")
+    tmp_path = dest.with_name(f"{dest.name}.tmp")
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, dest)
+
+def prune(max_entries: int = MAX_ENTRIES, max_age_seconds: float = MAX_AGE_SECONDS) -> int:
+    """
+    刪除超過保存期限的快取項目，剩餘項目超過 max_entries 時再從最久未使用的開始刪除；
+    之後清除已沒有任何檔案連結的去除重複資料與中斷留下的暫存檔。
+    :return: 刪除的檔案數量。
+    """
+    if not CACHE_DIR.is_dir():
+        return 0
+    now = time.time()
+    removed = 0
+
+    def unlink(path: Path):
+        nonlocal removed
+        try:
+            path.unlink()
+            removed += 1
+        except OSError as e:
+            log.warning(f"刪除分析快取 {path.name} 失敗: {e}")
+
+    entries = []
+    for path in CACHE_DIR.iterdir():
+        try:
+            if not path.is_file():
+                continue
+            mtime = path.stat().st_mtime
+        except OSError:
+            continue
+        if path.suffix == ".tmp" or now - mtime > max_age_seconds:
+            unlink(path)
+        else:
+            entries.append((mtime, path))
+    entries.sort(reverse=True)
+    for _, path in entries[max_entries:]:
+        unlink(path)
+
+    # 去除重複的資料只剩自身一個連結時，已沒有任何輸出檔或快取項目使用它
+    by_hash_dir = CACHE_DIR / BY_HASH_DIR_NAME
+    if by_hash_dir.is_dir():
+        for bucket in by_hash_dir.iterdir():
+            if not bucket.is_dir():
+                continue
+            for path in bucket.iterdir():
+                try:
+                    if path.suffix == ".tmp" or path.stat().st_nlink <= 1:
+                        unlink(path)
+                except OSError:
+                    continue
+            try:
+                bucket.rmdir()  # 只有空目錄才會成功
+            except OSError:
+                pass
+
+    if removed:
+        log.info(f"已清理 {removed} 個分析快取檔案。")
+    return removed
@@ -10,7 +10,8 @@ from datetime import datetime
 
 # --- 路徑修正 ---
 SRC_DIR = Path(__file__).resolve().parent.parent
-sys.path.insert(0, str(SRC_DIR))
+if str(SRC_DIR) not in sys.path:
+    sys.path.insert(0, str(SRC_DIR))
 
 # --- 常數 ---
 SECRETS_DIR = SRC_DIR / "db" / "secrets"
@@ -15,7 +15,8 @@ from pathlib import Path
 # 將 src 目錄新增到 Python 的搜尋路徑中
 # 這樣可以確保無論從哪裡執行，都能正確找到 db, api 等模組
 SRC_DIR = Path(__file__).resolve().parent.parent
-sys.path.insert(0, str(SRC_DIR))
+if str(SRC_DIR) not in sys.path:
+    sys.path.insert(0, str(SRC_DIR))
 ROOT_DIR = SRC_DIR.parent
 
 # --- 現在可以安全地導入專案內部模組了 ---
@@ -120,7 +121,9 @@ def main():
         # 3. 啟動 API 伺服器
         log.info("🔧 正在啟動 API 伺服器...")
         api_port = args.port if args.port else find_free_port()
-        api_server_cmd = [sys.executable, "-m", "api.api_server", "--port", str(api_port)]
+        # 經由輕量的入口模組啟動：頁面三的處理程序池以 spawn 啟動子程序時會重新匯入主模組，
+        # 入口模組只在真正作為主程式時才匯入 api_server，子程序不會重建整個應用程式
+        api_server_cmd = [sys.executable, "-m", "api.server_main", "--port", str(api_port)]
         if args.mock:
             api_server_cmd.append("--mock")
 
@@ -6,7 +6,8 @@ from typing import Dict, Any
 
 # --- 路徑修正 ---
 SRC_DIR = Path(__file__).resolve().parent.parent
-sys.path.insert(0, str(SRC_DIR))
+if str(SRC_DIR) not in sys.path:
+    sys.path.insert(0, str(SRC_DIR))
 
 # --- 常數 ---
 PROMPTS_FILE = SRC_DIR / "prompts" / "default_prompts.json"
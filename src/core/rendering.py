@@ -6,20 +6,65 @@ from fastapi.templating import Jinja2Templates
 from pathlib import Path
 import logging
 
+import jinja2
+
 log = logging.getLogger(__name__)
 
+# 應用程式實際使用的頁面樣板，啟動時會預先編譯
+PAGE_TEMPLATES = (
+    "page1_ingestion.html",
+    "page2_downloader.html",
+    "page3_processor.html",
+    "page4_analyzer.html",
+    "page5_backup.html",
+    "page6_keys.html",
+    "page7_prompts.html",
+    "prompts.html",
+    "history.html",
+    "report_viewer.html",
+    "_processed_file_item.html",
+)
+
 try:
     # --- 路徑與樣板設定 ---
     # 假設此檔案位於 src/core/rendering.py
     # 樣板目錄位於 src/static/
+    # 這是整個應用程式共用的唯一樣板引擎，各路由模組應從此處匯入 `templates`，
+    # 讓已編譯的樣板快取只存在一份。
     SRC_DIR = Path(__file__).resolve().parent.parent
-    templates = Jinja2Templates(directory=str(SRC_DIR / "static"))
+    # auto_reload=False: 樣板在執行期間不會變動，省去每次渲染前檢查檔案 mtime 的 stat 呼叫
+    _env = jinja2.Environment(
+        loader=jinja2.FileSystemLoader(str(SRC_DIR / "static")),
+        autoescape=True,
+        auto_reload=False,
+    )
+    templates = Jinja2Templates(env=_env)
     log.info("渲染模組的 Jinja2 樣板引擎初始化成功。")
 except Exception as e:
     log.error(f"渲染模組初始化失敗: {e}", exc_info=True)
     # 提供一個備用的空樣板物件，避免整個應用程式啟動失敗
     templates = None
 
+def preload_templates(names=PAGE_TEMPLATES) -> int:
+    """
+    預先載入並編譯指定的樣板，讓第一個請求不必承擔編譯成本。
+    個別樣板載入失敗只會記錄警告，不會中斷啟動流程。
+
+    Returns:
+        int: 成功編譯的樣板數量。
+    """
+    if not templates:
+        return 0
+    loaded = 0
+    for name in names:
+        try:
+            templates.get_template(name)
+            loaded += 1
+        except jinja2.TemplateError as e:
+            log.warning(f"預先編譯樣板 {name} 失敗: {e}")
+    log.info(f"已預先編譯 {loaded}/{len(names)} 個樣板。")
+    return loaded
+
 def render_processed_file_item(file_data: dict) -> str:
     """
     使用 Jinja2 樣板，渲染單個已處理檔案的 HTML 項目。
@@ -127,11 +127,11 @@ class DBClient:
     def get_all_tasks(self) -> list[dict]:
         return self._send_request("get_all_tasks")
 
-    def get_all_analysis_tasks(self) -> list[dict]:
+    def get_all_analysis_tasks(self, limit: int = -1, offset: int = 0) -> list[dict]:
         """
-        獲取所有 AI 分析任務的列表。
+        獲取 AI 分析任務的列表 (依建立時間新到舊分頁，limit 為 -1 表示不限制)。
         """
-        return self._send_request("get_all_analysis_tasks")
+        return self._send_request("get_all_analysis_tasks", {"limit": limit, "offset": offset})
 
     def create_or_get_analysis_task(self, file_id: int, filename: str) -> dict:
         """
@@ -145,12 +145,31 @@ class DBClient:
         """
         return self._send_request("update_analysis_task", {"task_id": task_id, "updates": updates})
 
+    def update_analysis_tasks(self, items: list[list]) -> bool:
+        """
+        以一次請求批次更新多個分析任務，items 為 [task_id, updates] 配對的列表 (在同一個交易中提交)。
+        """
+        return self._send_request("update_analysis_tasks", {"items": items})
+
+    def prepare_stage1_analysis_tasks(self, files: list[list]) -> list[int]:
+        """
+        為多個 [file_id, filename] 批次建立或取得分析任務並重設其狀態，
+        回傳與輸入順序對應的任務 ID 列表。
+        """
+        return self._send_request("prepare_stage1_analysis_tasks", {"files": files})
+
     def get_analysis_task(self, task_id: int) -> dict | None:
         """
         根據 ID 獲取單一分析任務的詳細資訊。
         """
         return self._send_request("get_analysis_task", {"task_id": task_id})
 
+    def get_analysis_task_contents(self, task_ids: list[int]) -> list[list]:
+        """
+        以一次請求取得多個分析任務的待分析文字，回傳 [task_id, file_content_for_analysis] 配對的列表。
+        """
+        return self._send_request("get_analysis_task_contents", {"task_ids": task_ids})
+
     def get_urls_by_hash(self, file_hash: str) -> list[dict]:
         """根據檔案雜湊值獲取所有相關的 URL 紀錄。"""
         return self._send_request("get_urls_by_hash", {"file_hash": file_hash})
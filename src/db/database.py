@@ -12,6 +12,21 @@ log = logging.getLogger(__name__)
 DB_FILE = Path(__file__).parent / "tasks.db"
 
 import os
+import queue
+import threading
+from contextlib import contextmanager, asynccontextmanager
+
+# --- 連線池設定 ---
+# 高頻端點 (例如打字即搜尋) 若每次請求都重新開啟連線，會重複支付
+# sqlite3_open 與 schema 載入的成本。連線池中的連線可跨執行緒共用，
+# 並且 sqlite3 模組會在每條連線上快取已編譯的 SQL 陳述式。
+POOL_SIZE = 4
+# 唯讀連線另成一池：列表與搜尋等 GET 端點只需讀取，在 WAL 模式下可與寫入同時進行；
+# 與寫入共用同一池時，讀取請求會與寫入搶用有限的連線。唯讀池的大小與 CPU 核心數相同。
+READ_POOL_SIZE = os.cpu_count() or 4
+_pools: dict[bool, queue.LifoQueue] = {}  # read_only -> 連線池
+_pool_db_path = None
+_pool_lock = threading.Lock()
 
 def get_db_connection():
     """
@@ -28,11 +43,178 @@ def get_db_connection():
         # 啟用 WAL (Write-Ahead Logging) 模式以提高併發性
         if db_path != ":memory:": # WAL 模式不完全支援記憶體資料庫
             conn.execute("PRAGMA journal_mode=WAL")
+        # WAL 模式下 NORMAL 只在檢查點時 fsync，批次寫入只需一次提交成本
+        conn.execute("PRAGMA synchronous=NORMAL")
         return conn
     except sqlite3.Error as e:
         log.error(f"資料庫連線失敗: {e}")
         return None
 
+def _open_pooled_connection(db_path, read_only: bool = False) -> sqlite3.Connection:
+    """建立一條供連線池使用、可跨執行緒共用的連線；read_only 時以 query_only 拒絕任何寫入。"""
+    # 池中連線長期存活，放大 sqlite3 模組以 SQL 文字為鍵的陳述式快取 (預設 128)，
+    # 讓各端點重複執行的查詢不必重新解析與規劃
+    conn = sqlite3.connect(db_path, timeout=10, check_same_thread=False, cached_statements=256)
+    conn.row_factory = sqlite3.Row
+    if db_path != ":memory:":
+        conn.execute("PRAGMA journal_mode=WAL")
+    # WAL 模式下 NORMAL 已足以保證資料庫一致性，並可減少 fsync 次數
+    conn.execute("PRAGMA synchronous=NORMAL")
+    # 長期存活的連線值得多一點設定：暫存表放在記憶體，並以 mmap 讀取資料庫檔案 (256 MiB)
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
+    # 頁面快取約 20 MB (負值單位為 KiB)
+    conn.execute("PRAGMA cache_size=-20000")
+    if read_only:
+        # 唯讀連線永遠不會取得寫入鎖，也就不會與寫入交易發生 SQLITE_BUSY
+        conn.execute("PRAGMA query_only=ON")
+    return conn
+
+def _drain_pool(pool: queue.LifoQueue):
+    """關閉並移除池中所有閒置連線。"""
+    while True:
+        try:
+            pool.get_nowait().close()
+        except queue.Empty:
+            break
+
+def _get_pool(read_only: bool = False) -> tuple[queue.LifoQueue, str | Path]:
+    """
+    取得目前資料庫路徑對應的讀寫或唯讀連線池。
+    若資料庫路徑改變 (例如測試切換了 TEST_DB_PATH)，會關閉所有舊池並建立新池。
+    """
+    global _pool_db_path
+    db_path = os.environ.get("TEST_DB_PATH") or DB_FILE
+    with _pool_lock:
+        if _pool_db_path != db_path:
+            for old_pool in _pools.values():
+                _drain_pool(old_pool)
+            _pools.clear()
+            _pool_db_path = db_path
+        pool = _pools.get(read_only)
+        if pool is None:
+            pool = _pools[read_only] = queue.LifoQueue(maxsize=READ_POOL_SIZE if read_only else POOL_SIZE)
+        return pool, db_path
+
+@contextmanager
+def pooled_connection(read_only: bool = False):
+    """
+    從連線池借出一條連線，結束時歸還。
+    池中沒有閒置連線時會直接開啟一條新連線 (永不阻塞)，
+    歸還時若池已滿則關閉它。
+    :param read_only: 為 True 時從唯讀池借出連線 (任何寫入都會拋出 sqlite3.OperationalError)。
+    """
+    pool, db_path = _get_pool(read_only)
+    try:
+        conn = pool.get_nowait()
+    except queue.Empty:
+        conn = _open_pooled_connection(db_path, read_only)
+    try:
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        # 資料庫路徑已切換時，舊連線不再歸還
+        if pool is _pools.get(read_only):
+            try:
+                pool.put_nowait(conn)
+                conn = None
+            except queue.Full:
+                pass
+        if conn is not None:
+            conn.close()
+
+@asynccontextmanager
+async def acquire_conn(read_only: bool = False):
+    """
+    `pooled_connection` 的非同步版本，供 FastAPI 的 async 端點使用：
+    `async with acquire_conn() as conn: ...` (只讀取的端點傳入 read_only=True)
+    """
+    with pooled_connection(read_only) as conn:
+        yield conn
+
+def close_connection_pool():
+    """關閉讀寫與唯讀連線池中的所有連線，應在應用程式關閉時呼叫。"""
+    global _pool_db_path
+    with _pool_lock:
+        for pool in _pools.values():
+            _drain_pool(pool)
+        _pools.clear()
+        _pool_db_path = None
+    log.info("資料庫連線池已關閉。")
+
+def _create_url_search_index(cursor: sqlite3.Cursor):
+    """
+    建立 `extracted_urls_fts` 虛擬表與同步觸發器。
+    如果 SQLite 未編譯 FTS5 (或不支援 trigram 分詞器)，則記錄警告並略過，
+    搜尋端點會自動退回使用 LIKE 查詢。
+    """
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'extracted_urls_fts'")
+    if cursor.fetchone():
+        return  # 索引已存在
+
+    try:
+        cursor.execute("""
+            CREATE VIRTUAL TABLE extracted_urls_fts USING fts5(
+                url, content='extracted_urls', content_rowid='id', tokenize='trigram'
+            )
+        """)
+    except sqlite3.OperationalError as e:
+        log.warning(f"無法建立 FTS5 搜尋索引，網址搜尋將退回使用 LIKE: {e}")
+        return
+
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS extracted_urls_fts_ai AFTER INSERT ON extracted_urls BEGIN
+            INSERT INTO extracted_urls_fts (rowid, url) VALUES (new.id, new.url);
+        END;
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS extracted_urls_fts_ad AFTER DELETE ON extracted_urls BEGIN
+            INSERT INTO extracted_urls_fts (extracted_urls_fts, rowid, url) VALUES ('delete', old.id, old.url);
+        END;
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS extracted_urls_fts_au AFTER UPDATE OF url ON extracted_urls BEGIN
+            INSERT INTO extracted_urls_fts (extracted_urls_fts, rowid, url) VALUES ('delete', old.id, old.url);
+            INSERT INTO extracted_urls_fts (rowid, url) VALUES (new.id, new.url);
+        END;
+    """)
+    # 為既有資料建立索引
+    cursor.execute("INSERT INTO extracted_urls_fts (extracted_urls_fts) VALUES ('rebuild')")
+    log.info("已建立 `extracted_urls_fts` 全文檢索索引。")
+
+def _basename_sql(path_expr: str) -> str:
+    """
+    回傳一段計算路徑檔名部分的 SQL 運算式 (同時支援 '/' 與 '\\' 分隔符)。
+    rtrim 會移除尾端所有「非斜線」字元而得到目錄前綴，再將前綴替換為空字串。
+    """
+    p = f"replace({path_expr}, '\\', '/')"
+    return f"replace({p}, rtrim({p}, replace({p}, '/', '')), '')"
+
+def _create_local_filename_triggers(cursor: sqlite3.Cursor):
+    """
+    以觸發器在寫入 local_path 時同步維護 local_filename 欄位，
+    讓列表端點直接讀取檔名，不必在 Python 中逐列建立 Path 物件。
+    所有寫入 local_path 的路徑 (批次寫入器、update_url 等) 都會自動涵蓋。
+    """
+    basename = _basename_sql("NEW.local_path")
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS extracted_urls_local_filename_ai AFTER INSERT ON extracted_urls
+        WHEN NEW.local_path IS NOT NULL BEGIN
+            UPDATE extracted_urls SET local_filename = {basename} WHERE id = NEW.id;
+        END;
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS extracted_urls_local_filename_au AFTER UPDATE OF local_path ON extracted_urls BEGIN
+            UPDATE extracted_urls SET local_filename = {basename} WHERE id = NEW.id;
+        END;
+    """)
+    # 回填既有資料
+    cursor.execute(
+        f"UPDATE extracted_urls SET local_filename = {_basename_sql('local_path')} "
+        "WHERE local_path IS NOT NULL AND local_filename IS NULL"
+    )
+
 def initialize_database(conn: sqlite3.Connection = None):
     """
     初始化資料庫。如果資料表不存在，就建立它們。
@@ -147,6 +329,14 @@ def initialize_database(conn: sqlite3.Connection = None):
             )
             ''')
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_url ON extracted_urls (url)")
+            # 各列表端點皆以 status 篩選並依 created_at DESC 排序，
+            # 複合索引讓查詢變為索引範圍掃描，且不需額外的排序步驟
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_urls_status_created ON extracted_urls (status, created_at DESC, id)")
+
+            # --- 為網址搜尋建立 FTS5 全文檢索索引 ---
+            # LIKE '%q%' 的前置萬用字元會讓索引失效並導致全表掃描，
+            # 改用 trigram 分詞的 FTS5 外部內容表，以支援子字串比對。
+            _create_url_search_index(cursor)
 
             # --- 新增 AI 分析報告歷史紀錄資料表 ---
             cursor.execute('''
@@ -181,6 +371,8 @@ def initialize_database(conn: sqlite3.Connection = None):
             )
             ''')
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_analysis_file_id ON analysis_tasks (file_id)")
+            # 分析任務列表依建立時間新到舊分頁，由索引提供順序即可避免每次查詢都排序整張表
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_analysis_created ON analysis_tasks (created_at DESC, id DESC)")
             cursor.execute("""
                 CREATE TRIGGER IF NOT EXISTS update_analysis_tasks_updated_at
                 AFTER UPDATE ON analysis_tasks
@@ -203,7 +395,8 @@ def initialize_database(conn: sqlite3.Connection = None):
                 "extracted_image_paths": "TEXT",
                 "extracted_text": "TEXT",
                 "retry_count": "INTEGER DEFAULT 0", # 為重試機制新增
-                "last_error_details": "TEXT" # 為重試機制新增
+                "last_error_details": "TEXT", # 為重試機制新增
+                "local_filename": "TEXT" # local_path 的檔名部分，由觸發器維護
             }
             for col, col_type in url_migrations.items():
                 try:
@@ -216,6 +409,8 @@ def initialize_database(conn: sqlite3.Connection = None):
                     else:
                         raise # 對於其他錯誤，則重新引發
 
+            _create_local_filename_triggers(cursor)
+
             # --- 為 reports 表格新增 structured_data 欄位 ---
             try:
                 cursor.execute("ALTER TABLE reports ADD COLUMN structured_data TEXT")
@@ -512,37 +707,32 @@ def create_or_get_analysis_task(file_id: int, filename: str) -> dict | None:
     :param filename: 檔案名稱。
     :return: 包含任務資訊的字典，或失敗時回傳 None。
     """
-    conn = get_db_connection()
-    if not conn: return None
-
     try:
-        with conn:
-            cursor = conn.cursor()
-            # 檢查是否已存在
-            cursor.execute("SELECT * FROM analysis_tasks WHERE file_id = ?", (file_id,))
-            existing_task = cursor.fetchone()
-
-            if existing_task:
-                log.info(f"分析任務 for file_id {file_id} 已存在，直接回傳。")
-                return dict(existing_task)
-
-            # 不存在，則建立新的
-            sql = "INSERT INTO analysis_tasks (file_id, filename) VALUES (?, ?)"
-            cursor.execute(sql, (file_id, filename))
-            new_task_id = cursor.lastrowid
-            log.info(f"✅ 已為 file_id {file_id} 建立新的分析任務，ID: {new_task_id}。")
-
-            # 取得並回傳剛建立的任務
-            cursor.execute("SELECT * FROM analysis_tasks WHERE id = ?", (new_task_id,))
-            new_task = cursor.fetchone()
-            return dict(new_task) if new_task else None
+        with pooled_connection() as conn:
+            with conn:
+                cursor = conn.cursor()
+                # 檢查是否已存在
+                cursor.execute("SELECT * FROM analysis_tasks WHERE file_id = ?", (file_id,))
+                existing_task = cursor.fetchone()
+
+                if existing_task:
+                    log.info(f"分析任務 for file_id {file_id} 已存在，直接回傳。")
+                    return dict(existing_task)
+
+                # 不存在，則建立新的
+                sql = "INSERT INTO analysis_tasks (file_id, filename) VALUES (?, ?)"
+                cursor.execute(sql, (file_id, filename))
+                new_task_id = cursor.lastrowid
+                log.info(f"✅ 已為 file_id {file_id} 建立新的分析任務，ID: {new_task_id}。")
+
+                # 取得並回傳剛建立的任務
+                cursor.execute("SELECT * FROM analysis_tasks WHERE id = ?", (new_task_id,))
+                new_task = cursor.fetchone()
+                return dict(new_task) if new_task else None
 
     except sqlite3.Error as e:
         log.error(f"❌ 建立或取得分析任務 for file_id {file_id} 時發生錯誤: {e}", exc_info=True)
         return None
-    finally:
-        if conn:
-            conn.close()
 
 def update_analysis_task(task_id: int, updates: dict) -> bool:
     """
@@ -555,9 +745,6 @@ def update_analysis_task(task_id: int, updates: dict) -> bool:
         log.warning("呼叫 update_analysis_task 時沒有提供任何更新內容。")
         return False
 
-    conn = get_db_connection()
-    if not conn: return False
-
     set_clause = ", ".join([f"{key} = ?" for key in updates.keys()])
     params = list(updates.values())
     params.append(task_id)
@@ -565,26 +752,98 @@ def update_analysis_task(task_id: int, updates: dict) -> bool:
     sql = f"UPDATE analysis_tasks SET {set_clause} WHERE id = ?"
 
     try:
-        with conn:
-            conn.execute(sql, params)
-        log.info(f"✅ 分析任務 {task_id} 已更新: {updates}")
-        return True
+        with pooled_connection() as conn:
+            with conn:
+                conn.execute(sql, params)
+            log.info(f"✅ 分析任務 {task_id} 已更新: {updates}")
+            return True
     except sqlite3.Error as e:
         log.error(f"❌ 更新分析任務 {task_id} 時出錯: {e}", exc_info=True)
         return False
-    finally:
-        if conn:
-            conn.close()
 
-def get_all_analysis_tasks() -> list[dict]:
+def update_analysis_tasks(items: list[list]) -> bool:
+    """
+    批次更新多個分析任務，等同對每一筆呼叫 update_analysis_task，但所有更新在同一個交易中完成，整批只需提交一次。
+    :param items: [task_id, updates] 配對的列表，updates 的格式與 update_analysis_task 相同。
+    :return: 成功則回傳 True，否則 False。
+    """
+    items = [(task_id, updates) for task_id, updates in items if updates]
+    if not items:
+        log.warning("呼叫 update_analysis_tasks 時沒有提供任何更新內容。")
+        return False
+
+    try:
+        with pooled_connection() as conn:
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                for task_id, updates in items:
+                    set_clause = ", ".join([f"{key} = ?" for key in updates.keys()])
+                    conn.execute(f"UPDATE analysis_tasks SET {set_clause} WHERE id = ?", [*updates.values(), task_id])
+            log.info(f"✅ 已批次更新 {len(items)} 個分析任務。")
+            return True
+    except sqlite3.Error as e:
+        log.error(f"❌ 批次更新分析任務時出錯: {e}", exc_info=True)
+        return False
+
+def prepare_stage1_analysis_tasks(files: list[list]) -> list[int]:
+    """
+    為多個檔案批次建立或取得分析任務，並將兩個階段的狀態重設為待處理。
+    等同對每個檔案呼叫 create_or_get_analysis_task 與 update_analysis_task，
+    但所有查詢與寫入都在同一個交易中完成，整批只需提交一次。
+    :param files: [file_id, filename] 配對的列表。
+    :return: 與輸入順序對應的分析任務 ID 列表，失敗時回傳空列表。
+    """
+    if not files:
+        return []
+
+    try:
+        with pooled_connection() as conn:
+            with conn:
+                # 以 BEGIN IMMEDIATE 在查詢前就取得寫入鎖，避免讀取後升級為寫入交易時才發生鎖定衝突
+                conn.execute("BEGIN IMMEDIATE")
+                cursor = conn.cursor()
+                file_ids = [file_id for file_id, _ in files]
+                placeholders = ','.join('?' for _ in file_ids)
+                # 沿用 create_or_get_analysis_task 的行為：同一檔案已有任務時取最早建立的那一筆
+                cursor.execute(
+                    f"SELECT file_id, MIN(id) FROM analysis_tasks WHERE file_id IN ({placeholders}) GROUP BY file_id",
+                    file_ids
+                )
+                task_id_by_file = {row[0]: row[1] for row in cursor.fetchall()}
+
+                for file_id, filename in files:
+                    if file_id not in task_id_by_file:
+                        cursor.execute("INSERT INTO analysis_tasks (file_id, filename) VALUES (?, ?)", (file_id, filename))
+                        task_id_by_file[file_id] = cursor.lastrowid
+
+                task_ids = [task_id_by_file[file_id] for file_id in file_ids]
+                cursor.executemany(
+                    "UPDATE analysis_tasks SET stage1_status = 'pending', stage1_error_log = NULL, stage1_json_path = NULL, "
+                    "stage2_status = 'pending', stage2_error_log = NULL, stage2_report_path = NULL WHERE id = ?",
+                    [(task_id,) for task_id in dict.fromkeys(task_ids)]
+                )
+            log.info(f"✅ 已為 {len(task_ids)} 個檔案準備第一階段分析任務。")
+            return task_ids
+    except sqlite3.Error as e:
+        log.error(f"❌ 批次準備第一階段分析任務時發生錯誤: {e}", exc_info=True)
+        return []
+
+def get_all_analysis_tasks(limit: int = -1, offset: int = 0) -> list[dict]:
     """
-    獲取所有 AI 分析任務的列表，並連帶查詢關聯的 file_hash 和 author。
-    :return: 一個包含所有分析任務字典的列表。
+    獲取 AI 分析任務的列表 (依建立時間新到舊)，並連帶查詢關聯的 file_hash 和 author。
+    不回傳 file_content_for_analysis：它是整份文件的文字，列表用不到，卻會讓每次輪詢的回應隨文件大小膨脹。
+    :param limit: 最多回傳的筆數，-1 表示不限制。
+    :param offset: 略過的筆數。
+    :return: 一個包含分析任務字典的列表。
     """
     # 2025-09-13: Jules 修改了 SQL 查詢，以 JOIN extracted_urls 來獲取 file_hash 和 author
+    # ORDER BY 由 idx_analysis_created 索引提供順序，LIMIT 只需讀取一頁的資料列，不必排序整張表
     sql = """
         SELECT
-            at.*,
+            at.id, at.file_id, at.filename,
+            at.stage1_status, at.stage1_model, at.stage1_json_path, at.stage1_error_log,
+            at.stage2_status, at.stage2_model_used, at.stage2_report_path, at.stage2_error_log,
+            at.created_at, at.updated_at,
             eu.file_hash,
             eu.author
         FROM
@@ -592,21 +851,18 @@ def get_all_analysis_tasks() -> list[dict]:
         LEFT JOIN
             extracted_urls eu ON at.file_id = eu.id
         ORDER BY
-            at.created_at DESC
+            at.created_at DESC, at.id DESC
+        LIMIT ? OFFSET ?
     """
-    conn = get_db_connection()
-    if not conn: return []
     try:
-        cursor = conn.cursor()
-        cursor.execute(sql)
-        tasks = cursor.fetchall()
-        return [dict(task) for task in tasks]
+        with pooled_connection(read_only=True) as conn:
+            cursor = conn.cursor()
+            cursor.execute(sql, (limit, offset))
+            tasks = cursor.fetchall()
+            return [dict(task) for task in tasks]
     except sqlite3.Error as e:
         log.error(f"❌ 獲取所有分析任務時發生錯誤: {e}", exc_info=True)
         return []
-    finally:
-        if conn:
-            conn.close()
 
 def get_analysis_task(task_id: int) -> dict | None:
     """
@@ -615,19 +871,35 @@ def get_analysis_task(task_id: int) -> dict | None:
     :return: 包含任務資訊的字典，或如果找不到則回傳 None。
     """
     sql = "SELECT * FROM analysis_tasks WHERE id = ?"
-    conn = get_db_connection()
-    if not conn: return None
     try:
-        cursor = conn.cursor()
-        cursor.execute(sql, (task_id,))
-        task = cursor.fetchone()
-        return dict(task) if task else None
+        with pooled_connection(read_only=True) as conn:
+            cursor = conn.cursor()
+            cursor.execute(sql, (task_id,))
+            task = cursor.fetchone()
+            return dict(task) if task else None
     except sqlite3.Error as e:
         log.error(f"❌ 查詢分析任務 {task_id} 時發生錯誤: {e}", exc_info=True)
         return None
-    finally:
-        if conn:
-            conn.close()
+
+def get_analysis_task_contents(task_ids: list[int]) -> list[list]:
+    """
+    以單一查詢取得多個分析任務的待分析文字，取代逐一呼叫 get_analysis_task 讀取整筆資料。
+    :param task_ids: 任務的主鍵 ID 列表。
+    :return: [task_id, file_content_for_analysis] 配對的列表 (找不到的任務不會出現在結果中)。
+    """
+    if not task_ids:
+        return []
+
+    placeholders = ','.join('?' for _ in task_ids)
+    sql = f"SELECT id, file_content_for_analysis FROM analysis_tasks WHERE id IN ({placeholders})"
+    try:
+        with pooled_connection(read_only=True) as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            return [list(row) for row in cursor.execute(sql, task_ids)]
+    except sqlite3.Error as e:
+        log.error(f"❌ 批次查詢分析任務內容時發生錯誤: {e}", exc_info=True)
+        return []
 
 # --- 結束：AI 分析任務專用函式 ---
 
@@ -703,19 +975,15 @@ def get_urls_by_hash(file_hash: str) -> list[dict]:
 def get_analysis_task_by_file_id(file_id: int) -> dict | None:
     """根據 file_id 獲取單一分析任務。"""
     sql = "SELECT * FROM analysis_tasks WHERE file_id = ?"
-    conn = get_db_connection()
-    if not conn: return None
     try:
-        cursor = conn.cursor()
-        cursor.execute(sql, (file_id,))
-        task = cursor.fetchone()
-        return dict(task) if task else None
+        with pooled_connection(read_only=True) as conn:
+            cursor = conn.cursor()
+            cursor.execute(sql, (file_id,))
+            task = cursor.fetchone()
+            return dict(task) if task else None
     except sqlite3.Error as e:
         log.error(f"❌ 根據 file_id {file_id} 查詢分析任務時發生錯誤: {e}", exc_info=True)
         return None
-    finally:
-        if conn:
-            conn.close()
 
 # --- 結束 ---
 
@@ -31,7 +31,9 @@ from pathlib import Path
 
 # 讓此腳本可以存取上層目錄的 db.database 模組
 import sys
-sys.path.append(str(Path(__file__).resolve().parent.parent))
+_SRC_DIR = str(Path(__file__).resolve().parent.parent)
+if _SRC_DIR not in sys.path:
+    sys.path.append(_SRC_DIR)
 
 from db import database
 
@@ -67,8 +69,11 @@ ACTION_MAP = {
     # --- AI 分析任務 (Analysis Tasks) Actions ---
     "create_or_get_analysis_task": database.create_or_get_analysis_task,
     "update_analysis_task": database.update_analysis_task,
+    "update_analysis_tasks": database.update_analysis_tasks,
+    "prepare_stage1_analysis_tasks": database.prepare_stage1_analysis_tasks,
     "get_all_analysis_tasks": database.get_all_analysis_tasks,
     "get_analysis_task": database.get_analysis_task,
+    "get_analysis_task_contents": database.get_analysis_task_contents,
     "get_urls_by_hash": database.get_urls_by_hash,
     "get_analysis_task_by_file_id": database.get_analysis_task_by_file_id,
 
@@ -0,0 +1,109 @@
+# db/writer.py
+"""
+`extracted_urls` 狀態更新的批次寫入器。
+
+大量下載同時完成時，若每個背景任務都各自開啟連線、執行一次 UPDATE 並提交，
+每次提交的 fsync 成本會主導整體的資料庫寫入時間。此模組將狀態更新放入佇列，
+由單一寫入執行緒以 `executemany` 在同一個交易中批次寫入。
+"""
+import logging
+import sqlite3
+import threading
+import time
+from queue import Queue, Empty
+
+from db.database import pooled_connection
+
+log = logging.getLogger(__name__)
+
+# local_path 使用 COALESCE：失敗的更新不會清除先前已存在的路徑
+SQL_UPDATE_URL_STATUS = (
+    "UPDATE extracted_urls SET status = ?, local_path = COALESCE(?, local_path), status_message = ? WHERE id = ?"
+)
+
+class UrlStatusWriter:
+    """在背景執行緒中批次寫入 `extracted_urls` 的狀態更新。"""
+
+    def __init__(self, batch_size: int = 500, flush_interval: float = 0.05):
+        """
+        :param batch_size: 單一交易最多寫入的更新筆數。
+        :param flush_interval: 收到第一筆更新後，最多再等待多久 (秒) 以湊成一批。
+        """
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = Queue(-1)
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._flush_listeners = []
+
+    def add_flush_listener(self, callback):
+        """
+        註冊一個在每批更新提交後呼叫的函式 (於寫入執行緒中執行，且早於通知等待者)。
+        供依賴 `extracted_urls` 狀態的快取在資料變更時失效。
+        """
+        self._flush_listeners.append(callback)
+
+    def enqueue(self, url_id: int, status: str, local_path: str | None = None, status_message: str | None = None) -> threading.Event:
+        """
+        將一筆狀態更新放入佇列。
+
+        :return: 一個 threading.Event，在該筆更新所屬的交易提交 (或放棄) 後被設定。
+                 呼叫端若需要確保寫入完成後才發送通知，可以對它呼叫 `wait()`。
+        """
+        self._ensure_started()
+        done = threading.Event()
+        self._queue.put(((status, local_path, status_message, url_id), done))
+        return done
+
+    def _ensure_started(self):
+        if self._thread and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if not (self._thread and self._thread.is_alive()):
+                self._thread = threading.Thread(target=self._writer_loop, name="UrlStatusWriterThread", daemon=True)
+                self._thread.start()
+
+    def _writer_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                except Empty:
+                    break
+
+            try:
+                self._write_batch([params for params, _ in batch])
+                for callback in self._flush_listeners:
+                    callback()
+            except Exception as e:
+                log.error(f"批次寫入 {len(batch)} 筆網址狀態時發生錯誤: {e}", exc_info=True)
+            finally:
+                for _, done in batch:
+                    done.set()
+
+    def _write_batch(self, params: list[tuple]):
+        for attempt in range(5):
+            try:
+                with pooled_connection() as conn:
+                    # 明確以 BEGIN IMMEDIATE 開始交易：在執行前就取得寫入鎖，鎖定衝突只會發生在
+                    # BEGIN 本身 (可直接重試)，不會在批次中途由讀取交易升級為寫入時才失敗。
+                    # 交易已開啟時，sqlite3 模組不會再於 executemany 前隱式插入 BEGIN；
+                    # 發生錯誤時，未提交的交易由 pooled_connection 在歸還連線時回滾。
+                    conn.execute("BEGIN IMMEDIATE")
+                    conn.executemany(SQL_UPDATE_URL_STATUS, params)
+                    conn.commit()
+                log.debug(f"已在單一交易中寫入 {len(params)} 筆網址狀態更新。")
+                return
+            except sqlite3.OperationalError as e:
+                if "database is locked" in str(e):
+                    log.warning(f"資料庫鎖定，正在重試批次寫入 (嘗試 {attempt + 1}/5)...")
+                    time.sleep(0.2)
+                    continue
+                raise
+        log.error(f"在多次重試後資料庫依然鎖定，{len(params)} 筆網址狀態更新遺失。")
+
+# 全應用程式共用的寫入器
+url_status_writer = UrlStatusWriter()
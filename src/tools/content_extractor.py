@@ -8,27 +8,34 @@ from PIL import Image
 
 log = logging.getLogger(__name__)
 
-def extract_from_pdf(file_path: Path, output_dir: Path) -> dict:
-    """從 PDF 檔案中提取所有文字和圖片。"""
+def extract_from_pdf(file_path: Path, output_dir: Path, data=None) -> dict:
+    """
+    從 PDF 檔案中提取所有文字和圖片。
+
+    :param data: 可選，檔案內容的 bytes 或 memoryview (例如 mmap 映射)。
+                 提供時 PyMuPDF 直接從記憶體解析，不再自行讀取檔案。
+    """
     text_content = ""
     image_paths = []
     try:
-        pdf_document = fitz.open(file_path)
-        for page_num in range(len(pdf_document)):
-            page = pdf_document.load_page(page_num)
-            text_content += page.get_text() + "\n"
+        source = fitz.open(stream=data, filetype="pdf") if data is not None else fitz.open(file_path)
+        # 以 with 確保文件在返回前關閉，釋放對 data 緩衝區的參照
+        with source as pdf_document:
+            for page_num in range(len(pdf_document)):
+                page = pdf_document.load_page(page_num)
+                text_content += page.get_text() + "\n"
 
-            image_list = page.get_images(full=True)
-            for img_index, img in enumerate(image_list):
-                xref = img[0]
-                base_image = pdf_document.extract_image(xref)
-                image_bytes = base_image["image"]
-                image_ext = base_image["ext"]
+                image_list = page.get_images(full=True)
+                for img_index, img in enumerate(image_list):
+                    xref = img[0]
+                    base_image = pdf_document.extract_image(xref)
+                    image_bytes = base_image["image"]
+                    image_ext = base_image["ext"]
 
-                image_filename = output_dir / f"{file_path.stem}_page{page_num+1}_img{img_index}.{image_ext}"
-                with open(image_filename, "wb") as img_file:
-                    img_file.write(image_bytes)
-                image_paths.append(image_filename)
+                    image_filename = output_dir / f"{file_path.stem}_page{page_num+1}_img{img_index}.{image_ext}"
+                    with open(image_filename, "wb") as img_file:
+                        img_file.write(image_bytes)
+                    image_paths.append(image_filename)
         log.info(f"從 PDF '{file_path.name}' 中成功提取 {len(image_paths)} 張圖片和 {len(text_content)} 字元。")
     except Exception as e:
         log.error(f"從 PDF '{file_path.name}' 提取內容時發生錯誤: {e}", exc_info=True)
@@ -88,13 +95,15 @@ def extract_from_pptx(file_path: Path, output_dir: Path) -> dict:
         log.error(f"從 PPTX '{file_path.name}' 提取內容時發生錯誤: {e}", exc_info=True)
     return {"text": text_content.strip(), "image_paths": image_paths}
 
-def extract_content(file_path_str: str, image_output_dir_str: str) -> dict | None:
+def extract_content(file_path_str: str, image_output_dir_str: str, data=None) -> dict | None:
     """
     一個主函式，根據副檔名分派任務給對應的提取器。
     現在會同時提取文字與圖片。
 
     :param file_path_str: 來源檔案的完整路徑字串。
     :param image_output_dir_str: 儲存提取出的圖片的目錄路徑字串。
+    :param data: 可選，呼叫端已讀取或映射的檔案內容；目前由 PDF 提取器使用，
+                 讓呼叫端能以同一份映射同時計算雜湊與解析內容。
     :return: 一個包含 'text' 和 'image_paths' 的字典，或在失敗時回傳 None。
     """
     file_path = Path(file_path_str)
@@ -109,7 +118,7 @@ def extract_content(file_path_str: str, image_output_dir_str: str) -> dict | Non
     content_data = {"text": "", "image_paths": []}
 
     if ext == '.pdf':
-        content_data = extract_from_pdf(file_path, output_dir)
+        content_data = extract_from_pdf(file_path, output_dir, data)
     elif ext == '.docx':
         content_data = extract_from_docx(file_path, output_dir)
     elif ext == '.pptx':
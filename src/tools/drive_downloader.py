@@ -9,7 +9,8 @@ import sys
 
 # --- 路徑修正 ---
 SRC_DIR = Path(__file__).resolve().parent.parent
-sys.path.insert(0, str(SRC_DIR))
+if str(SRC_DIR) not in sys.path:
+    sys.path.insert(0, str(SRC_DIR))
 
 from core.time_utils import format_iso_for_filename
 from core.filename_utils import sanitize_for_filename
@@ -1,9 +1,13 @@
 import hashlib
 import logging
+import mmap
 from pathlib import Path
 
 log = logging.getLogger(__name__)
 
+# 超過此大小的檔案改以 mmap 映射後一次交給 OpenSSL 計算，省去 Python 層級的分塊迴圈
+MMAP_THRESHOLD = 64 * 1024 * 1024
+
 def calculate_sha256(file_path: Path) -> str | None:
     """
     計算給定檔案的 SHA256 雜湊值。
@@ -15,16 +19,36 @@ def calculate_sha256(file_path: Path) -> str | None:
         log.error(f"計算雜湊值失敗：檔案不存在於 {file_path}")
         return None
 
-    sha256_hash = hashlib.sha256()
     try:
-        with open(file_path, "rb") as f:
-            # 為了處理大檔案，一次讀取一個區塊
-            for byte_block in iter(lambda: f.read(4096), b""):
-                sha256_hash.update(byte_block)
+        # buffering=0：直接使用原始檔案物件，file_digest 以 readinto 將資料讀入自己的緩衝區，
+        # 不再經過 BufferedReader 多複製一次
+        with open(file_path, "rb", buffering=0) as f:
+            if file_path.stat().st_size >= MMAP_THRESHOLD:
+                # 大檔案：映射整個檔案，單次 update() 即可 (OpenSSL 計算期間會釋放 GIL)
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    hex_digest = hashlib.sha256(mapped).hexdigest()
+            elif hasattr(hashlib, "file_digest"):
+                # Python 3.11+：由 C 層以大型緩衝區讀取並計算，不經過 Python 迴圈
+                hex_digest = hashlib.file_digest(f, "sha256").hexdigest()
+            else:
+                sha256_hash = hashlib.sha256()
+                # 為了處理大檔案，一次讀取一個區塊
+                for byte_block in iter(lambda: f.read(1024 * 1024), b""):
+                    sha256_hash.update(byte_block)
+                hex_digest = sha256_hash.hexdigest()
 
-        hex_digest = sha256_hash.hexdigest()
         log.info(f"檔案 {file_path.name} 的 SHA256 雜湊值為: {hex_digest}")
         return hex_digest
     except Exception as e:
         log.error(f"計算檔案 {file_path} 的雜湊值時發生錯誤: {e}", exc_info=True)
         return None
+
+def calculate_sha256_of_buffer(data) -> str:
+    """
+    計算已在記憶體中 (或已 mmap 映射) 的檔案內容的 SHA256 雜湊值。
+
+    :param data: bytes、memoryview 或 mmap 物件。
+    :return: 十六進位格式的 SHA256 字串。
+    """
+    # 單次 update() 即可，OpenSSL 計算期間會釋放 GIL
+    return hashlib.sha256(data).hexdigest()
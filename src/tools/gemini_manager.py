@@ -1,19 +1,63 @@
 import logging
-import json
+import orjson
+import re
 import time
 import threading
 from collections import deque
-from typing import List, Optional, Dict, Any
-
-try:
-    import google.generativeai as genai
-    from google.generativeai.types import GenerationConfig
-    from PIL import Image
-except ImportError:
-    logging.warning("google-generativeai or pillow not found. AI analysis will be disabled.")
-    genai = None
-    Image = None
-    GenerationConfig = None
+from typing import List, Optional, Dict, Any, Tuple
+
+# google.generativeai (連同 grpc、protobuf) 與 Pillow 的匯入成本很高，但只有實際建立 GeminiManager 時才需要。
+# 延後到第一次建立管理器時才匯入，匯入本模組的 API 伺服器、工作程序與測試收集都不必先付出這個成本。
+# 尚未載入時為 _NOT_LOADED；載入後為對應的模組或類別，未安裝時為 None。
+_NOT_LOADED = object()
+genai = _NOT_LOADED
+GenerationConfig = _NOT_LOADED
+Image = _NOT_LOADED
+_load_lock = threading.Lock()
+
+def _load_genai():
+    """匯入 genai SDK 與 Pillow 並填入模組變數；已載入 (或已由測試替換) 的變數維持不變。"""
+    global genai, GenerationConfig, Image
+    with _load_lock:
+        if _NOT_LOADED not in (genai, GenerationConfig, Image):
+            return
+        try:
+            import google.generativeai as genai_module
+            from google.generativeai.types import GenerationConfig as generation_config_class
+            from PIL import Image as image_module
+        except ImportError:
+            logging.warning("google-generativeai or pillow not found. AI analysis will be disabled.")
+            genai_module = generation_config_class = image_module = None
+        if genai is _NOT_LOADED:
+            genai = genai_module
+        if GenerationConfig is _NOT_LOADED:
+            GenerationConfig = generation_config_class
+        if Image is _NOT_LOADED:
+            Image = image_module
+
+# genai.configure 會重設 SDK 內部快取的服務客戶端，下一次請求時連同底層連線一起重新建立
+# (重新進行 TCP 與 TLS 交握)。每個請求都重新設定金鑰，等於每個請求都要重新建立連線。
+# 記錄目前生效的金鑰，只有實際換用其他金鑰時才重新設定，讓同一金鑰的連續請求沿用已建立的連線。
+_configured_api_key: Optional[str] = None
+_configure_lock = threading.Lock()
+
+def _configure_api_key(api_key: str):
+    """設定 genai 使用的金鑰；與目前生效的金鑰相同時不做任何事。"""
+    global _configured_api_key
+    with _configure_lock:
+        if _configured_api_key != api_key:
+            genai.configure(api_key=api_key)
+            _configured_api_key = api_key
+
+# 模型有時會把整個回應包在 Markdown 程式碼區塊中 (```json ... ``` 或 ```html ... ```)。
+# 以預先編譯的正規表示式一次比對並取出區塊內容，不必反覆 strip 與切片產生中間字串；
+# 結尾的圍欄必須位於字串最後，回應內文中的其他程式碼區塊不受影響
+_CODE_FENCE_RE = re.compile(r"\s*```[A-Za-z]*[ \t]*\n?(.*?)\s*```\s*", re.DOTALL)
+
+def _strip_code_fence(text: str) -> str:
+    """若回應整個包在程式碼區塊中，回傳區塊內容；否則原樣回傳。"""
+    match = _CODE_FENCE_RE.fullmatch(text)
+    return match.group(1) if match else text
 
 class ApiKey:
     """一個簡單的類別，用於儲存 API 金鑰及其名稱。"""
@@ -27,6 +71,7 @@ class GeminiManager:
     支援多金鑰輪換、冷卻機制和自動重試機制。
     """
     def __init__(self, api_keys: List[Dict[str, str]], timeout: int = 180, max_retries: int = 3, cooldown_seconds: int = 60):
+        _load_genai()
         if not genai:
             raise ImportError("GeminiManager 無法初始化，因為 google.generativeai 模組未安裝。")
         if not api_keys:
@@ -73,7 +118,7 @@ class GeminiManager:
 
         logging.info(f"正在使用金鑰 '{api_key.name}' 查詢可用的模型...")
         try:
-            genai.configure(api_key=api_key.key)
+            _configure_api_key(api_key.key)
             available_models = []
             for m in genai.list_models():
                 if 'generateContent' in m.supported_generation_methods:
@@ -104,7 +149,7 @@ class GeminiManager:
             logging.info(f"[{tag}] 準備使用金鑰 #{i+1}/{len(keys_to_try)} 執行 API 請求...")
 
             try:
-                genai.configure(api_key=api_key.key)
+                _configure_api_key(api_key.key)
             except Exception as e:
                 logging.error(f"[{tag}] 設定金鑰時發生錯誤: {e}，跳過此金鑰。")
                 last_error = e
@@ -131,15 +176,11 @@ class GeminiManager:
                             self.key_pool.append(api_key)
 
                     logging.info(f"[{tag}] API 請求成功。")
+                    raw_text = _strip_code_fence(raw_text)
                     if output_format == 'json':
-                        if raw_text.strip().startswith("```json"):
-                            raw_text = raw_text.strip()[7:-3].strip()
-                        return json.loads(raw_text), None, api_key.name
+                        # 以 orjson (C 擴充) 解析回應，長篇結構化輸出的解析時間與暫存配置都明顯少於標準函式庫
+                        return orjson.loads(raw_text), None, api_key.name
                     else:
-                        if raw_text.strip().startswith("```html"):
-                            raw_text = raw_text.strip()[7:-3].strip()
-                        elif raw_text.strip().startswith("```"):
-                            raw_text = raw_text.strip()[3:-3].strip()
                         return raw_text, None, api_key.name
 
                 except Exception as e:
@@ -172,36 +213,37 @@ class GeminiManager:
         logging.error(f"[{task_name}] 在嘗試了 {len(keys_to_try)} 組金鑰後，API 請求最終失敗。最後一個錯誤: {last_error}")
         return None, last_error, "all_keys_failed"
 
-    def prompt_for_json(self, prompt: str, model_name: str = "gemini-2.0-flash") -> Optional[Dict]:
+    def prompt_for_json(self, prompt: str, model_name: str = "gemini-2.0-flash") -> Tuple[Optional[Any], Optional[Exception], str]:
         """
         使用自訂提示詞執行請求，並期望回傳一個 JSON 物件。
         適用於第一階段的結構化資料提取。
+        :return: (解析後的 JSON, 錯誤, 使用的金鑰名稱)，呼叫端需要錯誤內容才能記錄失敗原因。
         """
-        result, _, _ = self._api_call_wrapper(
+        return self._api_call_wrapper(
             task_name="PromptForJson",
             model_name=model_name,
             prompt_content=[prompt],
             output_format='json'
         )
-        return result
 
-    def prompt_for_text(self, prompt: str, model_name: str = "gemini-1.5-pro-latest") -> Optional[str]:
+    def prompt_for_text(self, prompt: str, model_name: str = "gemini-1.5-pro-latest") -> Tuple[Optional[str], Optional[Exception], str]:
         """
         使用自訂提示詞執行請求，並期望回傳純文字 (例如 HTML)。
         適用於第二階段的報告生成。
+        :return: (回應文字, 錯誤, 使用的金鑰名稱)。
         """
-        result, _, _ = self._api_call_wrapper(
+        return self._api_call_wrapper(
             task_name="PromptForText",
             model_name=model_name,
             prompt_content=[prompt],
             output_format='text'
         )
-        return result
 
     def analyze_text(self, text_content: str, model_name: str = "gemini-1.5-flash-latest") -> Optional[Dict]:
         """【舊版，可選刪除】分析文字並回傳摘要和關鍵字。"""
         prompt = f"你是一位專業的內容分析師。請閱讀以下文章，並以 JSON 格式回傳包含以下兩個鍵的物件：1. `summary` (string): 對文章內容的簡短摘要。2. `keywords` (list of strings): 從文章中提取的 3-5 個核心關鍵字。\\n\\n文章內容如下：\\n---\\n{text_content}\\n---\\n請直接回傳 JSON 物件，不要包含任何額外的解釋或 Markdown 標記。"
-        return self.prompt_for_json(prompt, model_name)
+        result, _, _ = self.prompt_for_json(prompt, model_name)
+        return result
 
     def describe_image(self, image_path: str, model_name: str = "gemini-1.5-flash-latest") -> Optional[Dict]:
         """【舊版，可選刪除】描述圖片內容。"""
@@ -70,6 +70,11 @@ def get_error_message_from_response(response):
 
 # --- 核心 Gemini 處理函式 ---
 
+# 以執行緒對 SDK 呼叫強制加上外部超時。共用同一個執行緒池，不必每次呼叫都建立並銷毀執行緒；
+# 且逾時後呼叫端可以立即返回 (以 with 區塊建立的執行緒池在離開時會等待卡住的執行緒結束，
+# 使外部超時形同虛設)，卡住的呼叫留在背景執行緒中自行結束。
+_CALL_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="gemini-call")
+
 def list_models():
     """列出可用的 Gemini 模型並以 JSON 格式輸出，帶有強制超時。"""
     def list_models_task():
@@ -83,23 +88,22 @@ def list_models():
                  models_list.append({"id": m.name, "name": m.display_name})
         return models_list
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
-        try:
-            future = executor.submit(list_models_task)
-            models_list = future.result(timeout=30)
-            print(json.dumps(models_list), flush=True)
-        except ValueError as e:
-            log.critical(f"🔴 列出模型失敗: {e}")
-            print(f"Error listing models: {e}", file=sys.stderr, flush=True)
-            sys.exit(1)
-        except concurrent.futures.TimeoutError:
-            log.critical(f"🔴 列出模型超時！操作在 30 秒內未能完成。")
-            print("Error listing models: Timeout after 30 seconds.", file=sys.stderr, flush=True)
-            sys.exit(1)
-        except Exception as e:
-            log.critical(f"🔴 Failed to list models: {e}", exc_info=True)
-            print(f"Error listing models: {e}", file=sys.stderr, flush=True)
-            sys.exit(1)
+    try:
+        future = _CALL_EXECUTOR.submit(list_models_task)
+        models_list = future.result(timeout=30)
+        print(json.dumps(models_list), flush=True)
+    except ValueError as e:
+        log.critical(f"🔴 列出模型失敗: {e}")
+        print(f"Error listing models: {e}", file=sys.stderr, flush=True)
+        sys.exit(1)
+    except concurrent.futures.TimeoutError:
+        log.critical(f"🔴 列出模型超時！操作在 30 秒內未能完成。")
+        print("Error listing models: Timeout after 30 seconds.", file=sys.stderr, flush=True)
+        sys.exit(1)
+    except Exception as e:
+        log.critical(f"🔴 Failed to list models: {e}", exc_info=True)
+        print(f"Error listing models: {e}", file=sys.stderr, flush=True)
+        sys.exit(1)
 
 def validate_key():
     """僅驗證 API 金鑰的有效性。"""
@@ -129,18 +133,17 @@ def generate_content_with_timeout(model, prompt_parts: list, log_message: str, i
         except Exception as e:
             log.error(f"generate_content 執行緒內部發生錯誤 ({log_message}): {e}", exc_info=True)
             raise
-    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
-        try:
-            future = executor.submit(generation_task)
-            response = future.result(timeout=external_timeout)
-            log.info(f"model.generate_content ({log_message}) 呼叫成功返回。")
-            return response
-        except concurrent.futures.TimeoutError:
-            log.critical(f"🔴 model.generate_content ({log_message}) 超時！操作在 {external_timeout} 秒內未能完成。")
-            raise RuntimeError(f"AI 內容生成操作 '{log_message}' 超時。")
-        except Exception as e:
-            log.critical(f"🔴 model.generate_content ({log_message}) 發生未預期的錯誤: {e}", exc_info=True)
-            raise
+    try:
+        future = _CALL_EXECUTOR.submit(generation_task)
+        response = future.result(timeout=external_timeout)
+        log.info(f"model.generate_content ({log_message}) 呼叫成功返回。")
+        return response
+    except concurrent.futures.TimeoutError:
+        log.critical(f"🔴 model.generate_content ({log_message}) 超時！操作在 {external_timeout} 秒內未能完成。")
+        raise RuntimeError(f"AI 內容生成操作 '{log_message}' 超時。")
+    except Exception as e:
+        log.critical(f"🔴 model.generate_content ({log_message}) 發生未預期的錯誤: {e}", exc_info=True)
+        raise
 
 def upload_to_gemini(genai_module, audio_path: Path, display_filename: str):
     log.info(f"☁️ Uploading '{display_filename}' to Gemini Files API with a hard timeout...")
@@ -159,19 +162,18 @@ def upload_to_gemini(genai_module, audio_path: Path, display_filename: str):
         except Exception as e:
             log.error(f"檔案上傳執行緒內部發生錯誤: {e}", exc_info=True)
             raise
-    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
-        try:
-            future = executor.submit(upload_task)
-            audio_file_resource = future.result(timeout=110)
-            log.info(f"✅ Upload successful. Gemini File URI: {audio_file_resource.uri}")
-            print_progress("upload_complete", "音訊上傳成功。")
-            return audio_file_resource
-        except concurrent.futures.TimeoutError:
-            log.critical("🔴 檔案上傳超時！操作在 110 秒內未能完成。")
-            raise RuntimeError("檔案上傳操作超時，程序被強制終止。")
-        except Exception as e:
-            log.critical(f"🔴 Failed to upload file to Gemini: {e}", exc_info=True)
-            raise
+    try:
+        future = _CALL_EXECUTOR.submit(upload_task)
+        audio_file_resource = future.result(timeout=110)
+        log.info(f"✅ Upload successful. Gemini File URI: {audio_file_resource.uri}")
+        print_progress("upload_complete", "音訊上傳成功。")
+        return audio_file_resource
+    except concurrent.futures.TimeoutError:
+        log.critical("🔴 檔案上傳超時！操作在 110 秒內未能完成。")
+        raise RuntimeError("檔案上傳操作超時，程序被強制終止。")
+    except Exception as e:
+        log.critical(f"🔴 Failed to upload file to Gemini: {e}", exc_info=True)
+        raise
 
 def get_summary_and_transcript(gemini_file_resource, model, video_title: str, original_filename: str):
     log.info(f"🤖 Requesting summary and transcript from model '{model.model_name}'...")
@@ -257,14 +259,15 @@ def process_audio_file(audio_path: Path, model_name: str, video_title: str, outp
             if error_msg: raise ValueError(error_msg)
             total_tokens_used += get_token_count(response)
             output_path = output_dir / f"{final_filename_base}.html"
-            with open(output_path, "w", encoding="utf-8") as f: f.write(html_content)
+            # 先編碼一次再以單次寫入存檔，不經文字模式的緩衝層
+            output_path.write_bytes(html_content.encode("utf-8"))
             html_report_path = str(output_path)
         else: # Handle 'txt' format
             summary_text = results.get('summary', '無摘要。')
             transcript_text = results.get('transcript', '無逐字稿。')
             full_text_content = f"# {video_title}\n\n## 重點摘要\n\n{summary_text}\n\n---\n\n## 詳細逐字稿\n\n{transcript_text}"
             output_path = output_dir / f"{final_filename_base}.txt"
-            with open(output_path, "w", encoding="utf-8") as f: f.write(full_text_content)
+            output_path.write_bytes(full_text_content.encode("utf-8"))
             txt_report_path = str(output_path)
 
         final_result = {
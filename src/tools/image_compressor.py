@@ -1,18 +1,20 @@
+import hashlib
+import io
 import logging
+import os
+import threading
 from pathlib import Path
 from PIL import Image
 
 log = logging.getLogger(__name__)
 
-import io
-import shutil
-
 def compress_image(image_path_str: str, output_dir_str: str, target_width: int = 800, quality: int = 85) -> str | None:
     """
     智慧地壓縮指定的圖片。
     - 如果圖片寬度大於目標寬度，則進行縮放。
     - 將圖片儲存為 JPEG 格式。
     - 如果處理後的檔案大小沒有變小，則直接複製原始檔案到目標路徑。
+    - 輸出檔名由來源內容的雜湊值與壓縮參數決定；相同內容的圖片已壓縮過時直接回傳既有結果。
 
     :param image_path_str: 來源圖片的路徑字串。
     :param output_dir_str: 儲存壓縮圖片的目錄路徑字串。
@@ -30,15 +32,29 @@ def compress_image(image_path_str: str, output_dir_str: str, target_width: int =
 
         output_dir.mkdir(parents=True, exist_ok=True)
 
-        original_size = image_path.stat().st_size
-        img = Image.open(image_path)
+        # --- 內容定址快取 ---
+        # 壓縮結果只取決於來源內容與壓縮參數，以兩者作為輸出檔名：
+        # 重複開啟報告、或不同報告共用相同圖片時，直接沿用已壓縮的檔案
+        source_bytes = image_path.read_bytes()
+        content_hash = hashlib.sha256(source_bytes).hexdigest()[:16]
+        output_filename = output_dir / f"{content_hash}_w{target_width}_q{quality}.jpg"
+        if output_filename.is_file():
+            log.debug(f"圖片 {image_path.name} 已壓縮過，直接使用 {output_filename}")
+            return str(output_filename)
+
+        original_size = len(source_bytes)
+        img = Image.open(io.BytesIO(source_bytes))
 
         # --- 智慧縮放 ---
         # 只有當圖片寬度大於目標寬度時才進行縮放
         if img.width > target_width:
             aspect_ratio = img.height / img.width
             new_height = int(target_width * aspect_ratio)
-            img = img.resize((target_width, new_height), Image.Resampling.LANCZOS)
+            # JPEG 來源可在解碼時直接以 DCT 縮小 (1/2、1/4、1/8，且不小於目標尺寸)，
+            # 大幅減少需要解碼與重新取樣的像素；其他格式呼叫 draft 不會有任何效果
+            img.draft("RGB", (target_width, new_height))
+            # reducing_gap 先以整數倍快速縮小，再以 LANCZOS 完成剩餘縮放，畫質差異肉眼難辨
+            img = img.resize((target_width, new_height), Image.Resampling.LANCZOS, reducing_gap=3.0)
 
         # 轉換為 RGB 以避免儲存為 JPEG 時的透明度問題
         if img.mode in ("RGBA", "P"):
@@ -46,21 +62,24 @@ def compress_image(image_path_str: str, output_dir_str: str, target_width: int =
 
         # --- 嘗試在記憶體中壓縮 ---
         buffer = io.BytesIO()
-        img.save(buffer, format='JPEG', quality=quality, optimize=True)
+        # optimize=True 會為了省下數個百分比的檔案大小而多做一次霍夫曼表最佳化，
+        # 對編碼時間的影響遠大於對大小的影響，因此關閉
+        img.save(buffer, format='JPEG', quality=quality, optimize=False)
         compressed_size = buffer.tell()
 
         # --- 智慧儲存 ---
-        # 統一輸出檔名格式
-        output_filename = output_dir / f"{image_path.stem}_compressed.jpg"
+        # 先寫入暫存檔再原子性地更名，避免同時壓縮同一張圖片的請求讀到寫到一半的快取檔案
+        temp_filename = output_filename.with_name(f"{output_filename.name}.{os.getpid()}.{threading.get_ident()}.tmp")
 
         # 只有當壓縮後的檔案比原始檔案小時，才儲存壓縮版本
         if compressed_size < original_size:
-            with open(output_filename, 'wb') as f:
-                f.write(buffer.getvalue())
+            temp_filename.write_bytes(buffer.getvalue())
+            os.replace(temp_filename, output_filename)
             log.info(f"成功將圖片 {image_path.name} 壓縮並儲存至 {output_filename} (大小從 {original_size} -> {compressed_size} 位元組)")
         else:
-            # 否則，直接將原始檔案複製到目標路徑
-            shutil.copy(image_path, output_filename)
+            # 否則，直接將原始檔案內容寫入目標路徑
+            temp_filename.write_bytes(source_bytes)
+            os.replace(temp_filename, output_filename)
             log.warning(f"圖片 {image_path.name} 壓縮後大小未減小 ({original_size} -> {compressed_size} 位元組)，已直接複製原始檔案至 {output_filename}。")
 
         return str(output_filename)
@@ -19,7 +19,8 @@ from typing import Optional
 # --- 路徑修正 ---
 # 將專案的 src 目錄新增到 Python 的搜尋路徑中，以便找到 db 模組
 SRC_DIR = Path(__file__).resolve().parent.parent
-sys.path.insert(0, str(SRC_DIR))
+if str(SRC_DIR) not in sys.path:
+    sys.path.insert(0, str(SRC_DIR))
 
 # --- 本地匯入 ---
 # 在路徑修正後，我們可以從 db 和 core 模組匯入
@@ -35,6 +36,23 @@ except ImportError as e:
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 log = logging.getLogger('url_extractor')
 
+# --- 正規表示式 (模組載入時只編譯一次) ---
+# 偵測 LINE 聊天紀錄中的關鍵模式
+# 1. 日期行: e.g., "2025/5/6（週二）"
+DATE_PATTERN = re.compile(r'(\d{4}/\d{1,2}/\d{1,2})（週.）')
+# 2. 發言行: e.g., "13:30\t579-0740320Jack" (後面可能還有文字)
+#    - \t 是定位字元 (tab)
+#    - 捕捉時間 (HH:MM) 和作者 (直到下一個 \t 或行尾)
+MESSAGE_PATTERN = re.compile(r'^(\d{2}:\d{2})\t([^\t]+)')
+# 3. 網址: 匹配 http/https 開頭的 URL
+#    若有安裝 google-re2 (保證線性時間的 DFA 引擎)，大量貼上文字時會優先使用它；
+#    否則退回 Python 內建的 re。
+try:
+    import re2
+    URL_PATTERN = re2.compile(r'https?://\S+')
+except ImportError:
+    URL_PATTERN = re.compile(r'https?://\S+')
+
 def parse_chat_log(text: str) -> list[dict]:
     """
     從給定的 LINE 聊天紀錄文字中，解析出日期、時間、作者和連結。
@@ -43,16 +61,6 @@ def parse_chat_log(text: str) -> list[dict]:
     :param text: 包含 LINE 聊天紀錄的來源文字。
     :return: 一個字典列表，每個字典包含 'date', 'time', 'author', 'url'。
     """
-    # 偵測 LINE 聊天紀錄中的關鍵模式
-    # 1. 日期行: e.g., "2025/5/6（週二）"
-    date_pattern = re.compile(r'(\d{4}/\d{1,2}/\d{1,2})（週.）')
-    # 2. 發言行: e.g., "13:30\t579-0740320Jack" (後面可能還有文字)
-    #    - \t 是定位字元 (tab)
-    #    - 捕捉時間 (HH:MM) 和作者 (直到下一個 \t 或行尾)
-    message_pattern = re.compile(r'^(\d{2}:\d{2})\t([^\t]+)')
-    # 3. 網址: 匹配 http/https 開頭的 URL
-    url_pattern = re.compile(r'https?://\S+')
-
     results = []
     current_date = None
     last_message_info = None
@@ -64,7 +72,7 @@ def parse_chat_log(text: str) -> list[dict]:
         if not line:
             continue
 
-        date_match = date_pattern.match(line)
+        date_match = DATE_PATTERN.match(line)
         if date_match:
             # 將 YYYY/M/D 或 YYYY/MM/DD 格式標準化為 YYYY-MM-DD
             date_parts = date_match.group(1).split('/')
@@ -72,7 +80,7 @@ def parse_chat_log(text: str) -> list[dict]:
             last_message_info = None # 新的一天，重置作者資訊
             continue
 
-        message_match = message_pattern.match(line)
+        message_match = MESSAGE_PATTERN.match(line)
         if message_match:
             time = message_match.group(1)
             author = message_match.group(2).strip().split('\t')[0] # 再一次確保只取作者名
@@ -86,7 +94,7 @@ def parse_chat_log(text: str) -> list[dict]:
             last_message_info = {'time': time, 'author': author}
 
             # 檢查發言的同一行是否包含網址
-            url_match_in_line = url_pattern.search(line)
+            url_match_in_line = URL_PATTERN.search(line)
             if url_match_in_line:
                 url = url_match_in_line.group(0)
                 results.append({
@@ -101,7 +109,7 @@ def parse_chat_log(text: str) -> list[dict]:
         # 如果這行不是日期也不是發言，檢查它是否只包含一個網址
         # 並且緊跟在一個有效的發言者之後
         # 使用 fullmatch 確保整行就是一個網址，避免誤判包含網址的普通句子
-        url_match = url_pattern.fullmatch(line)
+        url_match = URL_PATTERN.fullmatch(line)
         if url_match and last_message_info:
             url = url_match.group(0)
             results.append({
@@ -158,7 +166,8 @@ def save_urls_to_db(parsed_data: list[dict], source_text: str, conn: Optional[sq
                 for item in parsed_data
             ]
 
-            # 使用 executemany 來高效地插入多筆記錄
+            # 使用 executemany 在同一個交易中插入多筆記錄，
+            # 讓整批資料只需一次提交 (WAL 下只寫入一次 commit 紀錄)
             cursor.executemany(
                 "INSERT INTO extracted_urls (url, author, message_date, message_time, source_text, created_at, status) VALUES (?, ?, ?, ?, ?, ?, 'pending')",
                 data_to_insert
@@ -0,0 +1,640 @@
+import asyncio
+import orjson
+import os
+import pytest
+import threading
+import sys
+from pathlib import Path
+from unittest.mock import AsyncMock, MagicMock
+from fastapi.testclient import TestClient
+
+# --- 測試環境路徑設定 ---
+SRC_DIR = Path(__file__).resolve().parent.parent / "src"
+if str(SRC_DIR) not in sys.path:
+    sys.path.insert(0, str(SRC_DIR))
+
+from api.api_server import app
+from api.routes import page4_analyzer
+
+
+@pytest.fixture(autouse=True)
+def clear_gemini_manager_cache():
+    """GeminiManager 實例會跨任務快取；每個測試前後清空，避免沿用其他測試替換進來的假物件。"""
+    page4_analyzer._cached_gemini_manager.cache_clear()
+    yield
+    page4_analyzer._cached_gemini_manager.cache_clear()
+
+
+def test_start_stage1_analysis_fetches_filenames_in_one_query(db_conn, monkeypatch):
+    """驗證第一階段分析以單一查詢取得所有檔名 (找不到的 ID 使用預設名稱)，以一次批次請求建立任務，並將小型文件合併分析。"""
+    with db_conn:
+        db_conn.executemany(
+            "INSERT INTO extracted_urls (url, local_path, extracted_text) VALUES (?, ?, ?)",
+            [("https://a.example", "/downloads/1_a.pdf", "abc"), ("https://b.example", "/downloads/2_b.docx", "x" * 20)]
+        )
+
+    db_client = MagicMock()
+    db_client.prepare_stage1_analysis_tasks.side_effect = lambda files: [file_id * 10 for file_id, _ in files]
+    monkeypatch.setattr(page4_analyzer, "DB_CLIENT", db_client)
+    monkeypatch.setattr(page4_analyzer, "run_analysis_task_wrapper", AsyncMock())
+    monkeypatch.setattr(page4_analyzer, "run_stage1_batch_wrapper", AsyncMock())
+    monkeypatch.setattr(page4_analyzer, "STAGE1_BATCH_MAX_CHARS", 10)
+    monkeypatch.setattr(app.state, "server_port", 8000, raising=False)
+
+    client = TestClient(app)
+    response = client.post("/api/analyzer/start_stage1_analysis", json={"file_ids": [2, 1, 99], "model_name": "m", "force": True})
+    assert response.status_code == 200
+
+    # 所有檔案只經由一次批次請求建立分析任務
+    db_client.prepare_stage1_analysis_tasks.assert_called_once_with(
+        [[2, "2_b.docx"], [1, "1_a.pdf"], [99, "未知檔案_99"]]
+    )
+    # 超過批次字元上限的文件單獨分析，其餘小型文件合併為一批
+    started = [call.kwargs["task_id"] for call in page4_analyzer.run_analysis_task_wrapper.call_args_list]
+    assert started == [20]
+    batch_call = page4_analyzer.run_stage1_batch_wrapper.call_args
+    assert batch_call.kwargs["task_ids"] == [10, 990]
+    assert batch_call.kwargs["file_ids"] == [1, 99]
+    # 單檔與批次流程都收到略過快取的要求
+    assert page4_analyzer.run_analysis_task_wrapper.call_args.kwargs["force"] is True
+    assert batch_call.kwargs["force"] is True
+
+
+def test_start_stage1_analysis_skips_in_flight_and_duplicate_files(db_conn, monkeypatch):
+    """驗證第一階段分析不會重複排入同一檔案，也不會重設仍在排隊或分析中的任務；
+    資料庫中殘留的 'processing' 狀態 (例如伺服器中途當機) 不會阻擋重新分析，任務結束後即可再次排入。"""
+    from types import SimpleNamespace
+    from db import database
+
+    with db_conn:
+        db_conn.executemany(
+            "INSERT INTO extracted_urls (url, local_path, extracted_text) VALUES (?, ?, ?)",
+            [("https://a.example", "/downloads/1_a.pdf", "abc"), ("https://b.example", "/downloads/2_b.pdf", "def")]
+        )
+        db_conn.execute("INSERT INTO analysis_tasks (file_id, filename, stage1_status) VALUES (2, '2_b.pdf', 'processing')")
+
+    db_client = MagicMock()
+    db_client.prepare_stage1_analysis_tasks.side_effect = database.prepare_stage1_analysis_tasks
+    monkeypatch.setattr(page4_analyzer, "DB_CLIENT", db_client)
+    monkeypatch.setattr(page4_analyzer, "STAGE1_BATCH_MAX_DOCS", 1)
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def held_wrapper(**kwargs):
+            await release.wait()
+        monkeypatch.setattr(page4_analyzer, "run_analysis_task_wrapper", held_wrapper)
+
+        request = SimpleNamespace(app=SimpleNamespace(state=SimpleNamespace(server_port=8000, analysis_semaphore=asyncio.Semaphore(1))))
+        start = lambda file_ids: page4_analyzer.start_stage1_analysis(request, page4_analyzer.Stage1Request(file_ids=file_ids, model_name="m"))
+
+        await start([1, 2, 1])
+        assert db_client.prepare_stage1_analysis_tasks.call_args.args[0] == [[1, "1_a.pdf"], [2, "2_b.pdf"]]
+
+        # 兩個任務都還在排隊：再次啟動時不建立也不重設任務
+        db_client.prepare_stage1_analysis_tasks.reset_mock()
+        await start([2, 1])
+        db_client.prepare_stage1_analysis_tasks.assert_not_called()
+
+        release.set()
+        await asyncio.gather(*page4_analyzer._analysis_tasks)
+        assert not page4_analyzer._in_flight_task_ids
+        await start([1])
+        db_client.prepare_stage1_analysis_tasks.assert_called_once_with([[1, "1_a.pdf"]])
+        await asyncio.gather(*page4_analyzer._analysis_tasks)
+
+    asyncio.run(scenario())
+    database.close_connection_pool()
+
+
+def test_start_stage2_analysis_marks_processing_and_skips_in_flight_task(db_conn, monkeypatch):
+    """驗證第二階段實際寫入「處理中」狀態與所用模型 (欄位為 stage2_model_used)、把 force 傳給阻塞函式，且任務進行中再次啟動時不會重複排入。"""
+    from types import SimpleNamespace
+    from db import database
+
+    with db_conn:
+        db_conn.execute("INSERT INTO analysis_tasks (file_id, filename, stage1_status) VALUES (1, 'a.pdf', 'completed')")
+
+    db_client = MagicMock()
+    db_client.update_analysis_task.side_effect = database.update_analysis_task
+    db_client.get_analysis_task.side_effect = database.get_analysis_task
+    monkeypatch.setattr(page4_analyzer, "DB_CLIENT", db_client)
+    monkeypatch.setattr(page4_analyzer, "_send_websocket_notification", lambda port, message: None)
+
+    running, release, seen = threading.Event(), threading.Event(), []
+
+    def fake_stage2(task_id, model_name, server_port, force=False):
+        seen.append({**database.get_analysis_task(task_id), "force": force})
+        running.set()
+        release.wait(timeout=5)
+        return {"id": task_id, "stage2_status": "completed"}
+    monkeypatch.setattr(page4_analyzer, "_run_stage2_blocking_task", fake_stage2)
+
+    async def scenario():
+        request = SimpleNamespace(app=SimpleNamespace(state=SimpleNamespace(server_port=8000, analysis_semaphore=asyncio.Semaphore(3))))
+        start = lambda: page4_analyzer.start_stage2_analysis(request, page4_analyzer.Stage2Request(task_ids=[1], model_name="m2", force=True))
+
+        assert (await start())["message"].startswith("已為 1 個")
+        await asyncio.to_thread(running.wait, 5)
+        assert (await start())["message"].startswith("已為 0 個")
+        release.set()
+        await asyncio.gather(*page4_analyzer._analysis_tasks)
+
+    asyncio.run(scenario())
+    assert len(seen) == 1
+    assert (seen[0]["stage2_status"], seen[0]["stage2_model_used"]) == ("processing", "m2")
+    # 要求略過快取時，force 會一路傳到阻塞函式
+    assert seen[0]["force"] is True
+    database.close_connection_pool()
+
+
+def test_start_stage2_analysis_filters_eligible_tasks_in_one_query(db_conn, monkeypatch):
+    """驗證第二階段分析以單一查詢篩選出第一階段已完成的任務，不逐個透過 DBClient 讀取。"""
+    with db_conn:
+        db_conn.executemany(
+            "INSERT INTO analysis_tasks (file_id, filename, stage1_status) VALUES (?, ?, ?)",
+            [(1, "a.pdf", "completed"), (2, "b.pdf", "failed"), (3, "c.pdf", "completed")]
+        )
+
+    db_client = MagicMock()
+    monkeypatch.setattr(page4_analyzer, "DB_CLIENT", db_client)
+    monkeypatch.setattr(page4_analyzer, "run_analysis_task_wrapper", AsyncMock())
+    monkeypatch.setattr(app.state, "server_port", 8000, raising=False)
+
+    client = TestClient(app)
+    response = client.post("/api/analyzer/start_stage2_analysis", json={"task_ids": [3, 2, 99, 1, 3], "model_name": "m"})
+    assert response.status_code == 200
+    assert response.json()["message"].startswith("已為 2 個")
+
+    db_client.get_analysis_task.assert_not_called()
+    started = [call.kwargs["task_id"] for call in page4_analyzer.run_analysis_task_wrapper.call_args_list]
+    assert started == [3, 1]
+
+
+def test_get_stage1_result_streams_json_file(tmp_path, monkeypatch):
+    """驗證第一階段結果直接以檔案回傳原始 JSON，檔案遺失時回傳 404。"""
+    json_path = tmp_path / "stage1_1.json"
+    json_path.write_text('{"title": "台積電", "symbol": "TSM"}', encoding="utf-8")
+
+    db_client = MagicMock()
+    db_client.get_analysis_task.return_value = {"id": 1, "stage1_json_path": str(json_path)}
+    monkeypatch.setattr(page4_analyzer, "DB_CLIENT", db_client)
+
+    client = TestClient(app)
+    response = client.get("/api/analyzer/stage1_result/1")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/json"
+    assert response.json() == {"title": "台積電", "symbol": "TSM"}
+
+    # pretty=true 時回傳加上縮排的內容
+    pretty = client.get("/api/analyzer/stage1_result/1", params={"pretty": "true"})
+    assert pretty.text == '{\n  "title": "台積電",\n  "symbol": "TSM"\n}'
+
+    json_path.unlink()
+    assert client.get("/api/analyzer/stage1_result/1").status_code == 404
+
+
+def test_processed_files_lists_processed_and_analyzed(db_conn):
+    """驗證可供分析的檔案列表透過連線池查詢，並只列出已處理或已分析且有檔名的項目。"""
+    with db_conn:
+        db_conn.executemany(
+            "INSERT INTO extracted_urls (url, local_path, status) VALUES (?, ?, ?)",
+            [
+                ("https://a.example", "/downloads/1_a.pdf", "processed"),
+                ("https://b.example", "/downloads/2_b.pdf", "analyzed"),
+                ("https://c.example", "/downloads/3_c.pdf", "completed"),
+                ("https://d.example", None, "processed_unsupported"),
+            ]
+        )
+
+    client = TestClient(app)
+    response = client.get("/api/analyzer/processed_files")
+    assert response.status_code == 200
+    assert sorted(item["filename"] for item in response.json()) == ["1_a.pdf", "2_b.pdf"]
+    assert page4_analyzer.NEXT_OFFSET_HEADER not in response.headers
+
+    # 分頁時以標頭告知下一頁的 offset
+    first = client.get("/api/analyzer/processed_files", params={"limit": 1})
+    assert len(first.json()) == 1
+    assert first.headers[page4_analyzer.NEXT_OFFSET_HEADER] == "1"
+    second = client.get("/api/analyzer/processed_files", params={"limit": 1, "offset": 1})
+    assert page4_analyzer.NEXT_OFFSET_HEADER not in second.headers
+
+
+def test_stage2_uses_stage1_json_text_verbatim(tmp_path, monkeypatch):
+    """驗證第二階段直接把第一階段 JSON 檔案的文字放入提示詞，而不是解析後再重新序列化。"""
+    json_text = '{\n  "title": "台積電",\n  "value": 1.0\n}'
+    json_path = tmp_path / "stage1_1.json"
+    json_path.write_text(json_text, encoding="utf-8")
+
+    db_client = MagicMock()
+    db_client.get_analysis_task.return_value = {"id": 1, "stage1_json_path": str(json_path)}
+    monkeypatch.setattr(page4_analyzer, "DB_CLIENT", db_client)
+    monkeypatch.setattr(page4_analyzer, "REPORTS_DIR", tmp_path)
+    monkeypatch.setattr(page4_analyzer.analysis_cache, "CACHE_DIR", tmp_path / "cache")
+    monkeypatch.setattr(page4_analyzer.prompt_manager, "get_all_prompts", lambda: {"stage_2_generation_prompt": "資料：{data_package}"})
+    monkeypatch.setattr(page4_analyzer.key_manager, "get_all_valid_keys_for_manager", lambda: [{"name": "k", "value": "v"}])
+    page4_analyzer._cached_prompts.cache_clear()
+    page4_analyzer._cached_valid_keys.cache_clear()
+    gemini = MagicMock()
+    gemini.prompt_for_text.return_value = ("<html></html>", None, "k")
+    monkeypatch.setattr(page4_analyzer, "GeminiManager", MagicMock(return_value=gemini))
+
+    page4_analyzer._run_stage2_blocking_task(task_id=1, model_name="m", server_port=8000)
+
+    assert gemini.prompt_for_text.call_args.kwargs["prompt"] == "資料：" + json_text
+    updates = db_client.update_analysis_task.call_args.kwargs["updates"]
+    assert updates["stage2_status"] == "completed"
+
+
+def test_prompts_cache_follows_file_changes(tmp_path, monkeypatch):
+    """驗證提示詞快取在檔案未變更時不會重新讀取，檔案修改後則立即重新載入。"""
+    prompts_file = tmp_path / "prompts.json"
+    prompts_file.write_text("{}", encoding="utf-8")
+    loader = MagicMock(side_effect=[{"v": 1}, {"v": 2}])
+    monkeypatch.setattr(page4_analyzer.prompt_manager, "PROMPTS_FILE", prompts_file)
+    monkeypatch.setattr(page4_analyzer.prompt_manager, "get_all_prompts", loader)
+    page4_analyzer._cached_prompts.cache_clear()
+
+    assert page4_analyzer._get_prompts() == {"v": 1}
+    assert page4_analyzer._get_prompts() == {"v": 1}
+    assert loader.call_count == 1
+
+    stat = prompts_file.stat()
+    os.utime(prompts_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+    assert page4_analyzer._get_prompts() == {"v": 2}
+    page4_analyzer._cached_prompts.cache_clear()
+
+
+def test_analysis_wrapper_sends_notifications_off_the_event_loop(monkeypatch):
+    """驗證分析任務在專屬執行緒池中執行，通知交由背景執行緒依序發送，不在事件迴圈上等待 HTTP 回應。"""
+    sent = []
+    monkeypatch.setattr(
+        page4_analyzer, "_send_websocket_notification",
+        lambda port, message: sent.append((threading.current_thread().name, message["status"]))
+    )
+    db_client = MagicMock()
+    db_client.get_analysis_task.return_value = {"stage1_status": "completed"}
+    monkeypatch.setattr(page4_analyzer, "DB_CLIENT", db_client)
+
+    calls = []
+    asyncio.run(page4_analyzer.run_analysis_task_wrapper(
+        task_id=1, server_port=8000, semaphore=asyncio.Semaphore(1),
+        blocking_func=lambda **kwargs: calls.append((threading.current_thread().name, kwargs)),
+        file_id=1, model_name="m", stage=1
+    ))
+    page4_analyzer._NOTIFY_EXECUTOR.submit(lambda: None).result(timeout=5)
+
+    assert [status for _, status in sent] == ["processing", "completed"]
+    assert all(name.startswith("notify") for name, _ in sent)
+    # 阻塞函式以關鍵字參數在專屬的分析執行緒池中執行
+    assert len(calls) == 1
+    thread_name, kwargs = calls[0]
+    assert thread_name.startswith("ai-analysis")
+    assert kwargs == {"task_id": 1, "server_port": 8000, "file_id": 1, "model_name": "m"}
+
+
+def test_analysis_wrapper_calls_db_client_off_the_event_loop(monkeypatch):
+    """驗證包裝函式標記處理中與讀回任務狀態的 DBClient 呼叫都在執行緒中進行，不阻塞事件迴圈。"""
+    monkeypatch.setattr(page4_analyzer, "_send_websocket_notification", lambda port, message: None)
+    db_threads = []
+    db_client = MagicMock()
+    db_client.update_analysis_task.side_effect = lambda **kwargs: db_threads.append(threading.current_thread())
+    db_client.get_analysis_task.side_effect = lambda task_id: db_threads.append(threading.current_thread()) or {"stage1_status": "failed"}
+    monkeypatch.setattr(page4_analyzer, "DB_CLIENT", db_client)
+
+    def failing_blocking_func(**kwargs):
+        raise RuntimeError("模擬失敗")
+
+    async def run():
+        await page4_analyzer.run_analysis_task_wrapper(
+            task_id=1, server_port=8000, semaphore=asyncio.Semaphore(1),
+            blocking_func=failing_blocking_func, file_id=1, model_name="m", stage=1
+        )
+        return threading.current_thread()
+
+    loop_thread = asyncio.run(run())
+    # 阻塞函式未回傳最終狀態時才從資料庫讀回，兩次呼叫都不在事件迴圈的執行緒上
+    assert len(db_threads) == 2
+    assert all(thread is not loop_thread for thread in db_threads)
+
+
+def test_analysis_wrapper_notifies_with_returned_state(monkeypatch):
+    """驗證阻塞函式回傳最終狀態時，包裝函式直接以它作為通知內容，不再從資料庫讀回任務。"""
+    sent = []
+    monkeypatch.setattr(page4_analyzer, "_send_websocket_notification", lambda port, message: sent.append(message))
+    db_client = MagicMock()
+    monkeypatch.setattr(page4_analyzer, "DB_CLIENT", db_client)
+
+    final_state = {"id": 1, "stage2_status": "completed", "stage2_report_path": "/tmp/r.html"}
+    asyncio.run(page4_analyzer.run_analysis_task_wrapper(
+        task_id=1, server_port=8000, semaphore=asyncio.Semaphore(1),
+        blocking_func=lambda **kwargs: final_state, model_name="m", stage=2
+    ))
+    page4_analyzer._NOTIFY_EXECUTOR.submit(lambda: None).result(timeout=5)
+
+    db_client.get_analysis_task.assert_not_called()
+    assert sent[-1]["status"] == "completed"
+    assert sent[-1]["result"] == final_state
+
+
+def test_stage2_reuses_cached_report_for_same_prompt(tmp_path, monkeypatch):
+    """驗證相同模型與提示詞的第二次分析直接從快取還原報告，不再呼叫 API。"""
+    json_path = tmp_path / "stage1_1.json"
+    json_path.write_text('{"title": "台積電"}', encoding="utf-8")
+
+    db_client = MagicMock()
+    db_client.get_analysis_task.return_value = {"id": 1, "stage1_json_path": str(json_path)}
+    monkeypatch.setattr(page4_analyzer, "DB_CLIENT", db_client)
+    monkeypatch.setattr(page4_analyzer, "REPORTS_DIR", tmp_path)
+    monkeypatch.setattr(page4_analyzer.analysis_cache, "CACHE_DIR", tmp_path / "cache")
+    monkeypatch.setattr(page4_analyzer, "_get_prompts", lambda: {"stage_2_generation_prompt": "資料：{data_package}"})
+    monkeypatch.setattr(page4_analyzer, "_get_valid_keys", lambda: [{"name": "k", "value": "v"}])
+    gemini = MagicMock()
+    gemini.prompt_for_text.return_value = ("<html>報告</html>", None, "k")
+    monkeypatch.setattr(page4_analyzer, "GeminiManager", MagicMock(return_value=gemini))
+
+    page4_analyzer._run_stage2_blocking_task(task_id=1, model_name="m", server_port=8000)
+    page4_analyzer._run_stage2_blocking_task(task_id=2, model_name="m", server_port=8000)
+    assert gemini.prompt_for_text.call_count == 1
+
+    report_paths = [call.kwargs["updates"]["stage2_report_path"] for call in db_client.update_analysis_task.call_args_list]
+    assert len(set(report_paths)) == 2
+    assert all(Path(path).read_text(encoding="utf-8") == "<html>報告</html>" for path in report_paths)
+
+    # 換用其他模型時不應命中快取
+    page4_analyzer._run_stage2_blocking_task(task_id=3, model_name="other", server_port=8000)
+    assert gemini.prompt_for_text.call_count == 2
+
+
+def test_stage_force_bypasses_and_replaces_cached_result(tmp_path, monkeypatch):
+    """驗證 force 略過分析快取重新呼叫 API，並以新結果取代快取項目，之後的一般分析還原的是新結果。"""
+    db_client = MagicMock()
+    db_client.get_analysis_task.return_value = {"id": 1, "file_content_for_analysis": "內容"}
+    monkeypatch.setattr(page4_analyzer, "DB_CLIENT", db_client)
+    monkeypatch.setattr(page4_analyzer, "TEMP_JSON_DIR", tmp_path)
+    monkeypatch.setattr(page4_analyzer.analysis_cache, "CACHE_DIR", tmp_path / "cache")
+    monkeypatch.setattr(page4_analyzer, "_get_prompts", lambda: {"stage_1_extraction_prompt": "擷取：{document_text}"})
+    monkeypatch.setattr(page4_analyzer, "_get_valid_keys", lambda: [{"name": "k", "value": "v"}])
+    gemini = MagicMock()
+    gemini.prompt_for_json.side_effect = [({"v": 1}, None, "k"), ({"v": 2}, None, "k")]
+    monkeypatch.setattr(page4_analyzer, "GeminiManager", MagicMock(return_value=gemini))
+
+    run = lambda task_id, force=False: page4_analyzer._run_stage1_blocking_task(
+        task_id=task_id, file_id=1, model_name="m", server_port=8000, force=force
+    )
+    run(1)
+    run(2, force=True)
+    assert gemini.prompt_for_json.call_count == 2
+    state = run(3)
+    assert gemini.prompt_for_json.call_count == 2
+    assert orjson.loads(Path(state["stage1_json_path"]).read_bytes()) == {"v": 2}
+
+
+
+def test_spawned_analysis_tasks_run_concurrently(monkeypatch):
+    """驗證分析任務各自排入事件迴圈，在信號量的上限內同時執行，而不是依序等待。"""
+    async def scenario():
+        running, peak = 0, 0
+
+        async def fake_task():
+            nonlocal running, peak
+            async with semaphore:
+                running += 1
+                peak = max(peak, running)
+                await asyncio.sleep(0.01)
+                running -= 1
+
+        semaphore = asyncio.Semaphore(2)
+        for _ in range(4):
+            page4_analyzer._spawn_analysis_task(fake_task(), [])
+        await asyncio.gather(*page4_analyzer._analysis_tasks)
+        return peak
+
+    assert asyncio.run(scenario()) == 2
+    assert not page4_analyzer._analysis_tasks
+
+
+def test_gemini_manager_is_reused_until_keys_change(monkeypatch):
+    """驗證相同金鑰組合的任務共用同一個 GeminiManager，金鑰組合改變時才建立新的實例。"""
+    factory = MagicMock(side_effect=lambda api_keys: MagicMock(api_keys=api_keys))
+    monkeypatch.setattr(page4_analyzer, "GeminiManager", factory)
+    keys = [{"name": "a", "value": "1"}, {"name": "b", "value": "2"}]
+
+    first = page4_analyzer._get_gemini_manager(keys)
+    assert page4_analyzer._get_gemini_manager([dict(k) for k in keys]) is first
+    assert factory.call_count == 1
+    assert first.api_keys == keys
+
+    rotated = page4_analyzer._get_gemini_manager([{"name": "a", "value": "3"}])
+    assert rotated is not first
+    assert factory.call_count == 2
+
+
+def test_fill_prompt_matches_str_format():
+    """驗證預先拆分的範本組出的提示詞與 str.format 相同 (含跳脫的大括號)，且佔位符不符時立即失敗。"""
+    template = '請以 JSON 回傳 {{"title": "..."}}。\n文件：{document_text}\n結尾 {{}}'
+    assert page4_analyzer._fill_prompt(template, "document_text", "內容{x}") == template.format(document_text="內容{x}")
+
+    for bad_template in ["沒有佔位符", "{document_text}{document_text}", "{other}", "{document_text:>10}"]:
+        with pytest.raises(ValueError):
+            page4_analyzer._fill_prompt(bad_template, "document_text", "內容")
+
+
+def test_next_file_suffix_is_unique_hex():
+    """驗證產出檔名的序號為 8 位十六進位，且連續取得的序號互不相同。"""
+    suffixes = [page4_analyzer._next_file_suffix() for _ in range(100)]
+    assert len(set(suffixes)) == 100
+    assert all(len(suffix) == 8 and int(suffix, 16) >= 0 for suffix in suffixes)
+
+
+def test_write_atomically_leaves_no_temp_file(tmp_path):
+    """驗證原子寫入會以完整內容取代目標檔，且不留下暫存檔。"""
+    target = tmp_path / "report_1.html"
+    target.write_text("舊內容", encoding="utf-8")
+
+    page4_analyzer._write_atomically(target, "<html>新報告</html>".encode("utf-8"))
+
+    assert target.read_text(encoding="utf-8") == "<html>新報告</html>"
+    assert [p.name for p in tmp_path.iterdir()] == ["report_1.html"]
+
+
+def test_plan_stage1_batches_respects_limits(monkeypatch):
+    """驗證批次分組依輸入順序進行，且不超過字元數與份數上限；超過上限的單份文件獨立成組。"""
+    monkeypatch.setattr(page4_analyzer, "STAGE1_BATCH_MAX_CHARS", 100)
+    monkeypatch.setattr(page4_analyzer, "STAGE1_BATCH_MAX_DOCS", 3)
+    assert page4_analyzer._plan_stage1_batches([10, 20, 30, 40, 500, 5, 5]) == [[0, 1, 2], [3], [4], [5, 6]]
+    assert page4_analyzer._plan_stage1_batches([]) == []
+
+
+def _batch_documents(prompt):
+    """取出批次提示詞結尾的文章陣列。"""
+    return orjson.loads(prompt.rsplit(page4_analyzer.STAGE1_BATCH_FOOTER, 1)[1].removesuffix(page4_analyzer.STAGE1_BATCH_TRAILER))
+
+
+def test_stage1_batch_splits_response_per_task(tmp_path, monkeypatch):
+    """驗證批次分析只呼叫一次 API，並將回應陣列拆回各任務的 JSON 檔；回應中缺少的文件標記為失敗。"""
+    db_client = MagicMock()
+    db_client.get_analysis_task_contents.side_effect = lambda task_ids: [[task_id, f"文章{task_id}"] for task_id in task_ids]
+    monkeypatch.setattr(page4_analyzer, "DB_CLIENT", db_client)
+    monkeypatch.setattr(page4_analyzer, "TEMP_JSON_DIR", tmp_path)
+    monkeypatch.setattr(page4_analyzer.analysis_cache, "CACHE_DIR", tmp_path / "cache")
+    monkeypatch.setattr(page4_analyzer, "_get_prompts", lambda: {"stage_1_extraction_prompt": "文章：{document_text}"})
+    monkeypatch.setattr(page4_analyzer, "_get_valid_keys", lambda: [{"name": "k", "value": "v"}])
+    gemini = MagicMock()
+    gemini.prompt_for_json.return_value = ([{"id": 1, "title": "甲"}, {"id": 2, "title": "乙"}], None, "k")
+    monkeypatch.setattr(page4_analyzer, "GeminiManager", MagicMock(return_value=gemini))
+
+    final_states = page4_analyzer._run_stage1_batch_blocking_task(task_ids=[1, 2, 3], file_ids=[11, 12, 13], model_name="m", server_port=8000)
+
+    assert gemini.prompt_for_json.call_count == 1
+    db_client.get_analysis_task_contents.assert_called_once_with(task_ids=[1, 2, 3])
+    db_client.get_analysis_task.assert_not_called()
+    # 批次提示詞由使用者的第一階段提示詞衍生，文章陣列放在結尾
+    prompt = gemini.prompt_for_json.call_args.kwargs["prompt"]
+    assert prompt.startswith(page4_analyzer.STAGE1_BATCH_HEADER + "文章：" + page4_analyzer.STAGE1_BATCH_DOCUMENT_PLACEHOLDER)
+    assert [doc["text"] for doc in _batch_documents(prompt)] == ["文章1", "文章2", "文章3"]
+    # 整批任務的最終狀態以一次批次更新寫入，不再逐個任務呼叫 update_analysis_task
+    db_client.update_analysis_task.assert_not_called()
+    db_client.update_analysis_tasks.assert_called_once()
+    updates = dict(db_client.update_analysis_tasks.call_args.kwargs["items"])
+    assert updates[3]["stage1_status"] == "failed"
+    for task_id, title in [(1, "甲"), (2, "乙")]:
+        assert updates[task_id]["stage1_status"] == "completed"
+        # 只供第二階段使用的 JSON 以緊湊格式寫出，不含縮排空白
+        assert Path(updates[task_id]["stage1_json_path"]).read_text(encoding="utf-8") == f'{{"title":"{title}"}}'
+    # 回傳的最終狀態與寫入資料庫的欄位一致
+    assert final_states == {task_id: {"id": task_id, **task_updates} for task_id, task_updates in updates.items()}
+
+
+def test_stage1_batch_matches_string_ids(tmp_path, monkeypatch):
+    """驗證模型以字串帶回 id 時，仍能對應回各任務的結果。"""
+    db_client = MagicMock()
+    db_client.get_analysis_task_contents.side_effect = lambda task_ids: [[task_id, f"文章{task_id}"] for task_id in task_ids]
+    monkeypatch.setattr(page4_analyzer, "DB_CLIENT", db_client)
+    monkeypatch.setattr(page4_analyzer, "TEMP_JSON_DIR", tmp_path)
+    monkeypatch.setattr(page4_analyzer.analysis_cache, "CACHE_DIR", tmp_path / "cache")
+    monkeypatch.setattr(page4_analyzer, "_get_prompts", lambda: {"stage_1_extraction_prompt": "文章：{document_text}"})
+    monkeypatch.setattr(page4_analyzer, "_get_valid_keys", lambda: [{"name": "k", "value": "v"}])
+    gemini = MagicMock()
+    gemini.prompt_for_json.return_value = ([{"id": "12", "title": "甲"}, {"id": "13", "title": "乙"}], None, "k")
+    monkeypatch.setattr(page4_analyzer, "GeminiManager", MagicMock(return_value=gemini))
+
+    final_states = page4_analyzer._run_stage1_batch_blocking_task(task_ids=[12, 13], file_ids=[1, 2], model_name="m", server_port=8000)
+
+    assert {task_id: state["stage1_status"] for task_id, state in final_states.items()} == {12: "completed", 13: "completed"}
+    assert Path(final_states[13]["stage1_json_path"]).read_text(encoding="utf-8") == '{"title":"乙"}'
+
+
+def test_stage1_batch_reuses_cached_results_per_document(tmp_path, monkeypatch):
+    """驗證批次分析逐份快取結果：重新分析時只送出未命中快取的文件，全部命中時不呼叫 API。"""
+    db_client = MagicMock()
+    db_client.get_analysis_task_contents.side_effect = lambda task_ids: [[task_id, f"文章{task_id % 10}"] for task_id in task_ids]
+    monkeypatch.setattr(page4_analyzer, "DB_CLIENT", db_client)
+    monkeypatch.setattr(page4_analyzer, "TEMP_JSON_DIR", tmp_path)
+    monkeypatch.setattr(page4_analyzer.analysis_cache, "CACHE_DIR", tmp_path / "cache")
+    monkeypatch.setattr(page4_analyzer, "_get_prompts", lambda: {"stage_1_extraction_prompt": "文章：{document_text}"})
+    monkeypatch.setattr(page4_analyzer, "_get_valid_keys", lambda: [{"name": "k", "value": "v"}])
+    gemini = MagicMock()
+    gemini.prompt_for_json.side_effect = lambda prompt, model_name: (
+        [{"id": doc["id"], "title": doc["text"]} for doc in _batch_documents(prompt)], None, "k"
+    )
+    monkeypatch.setattr(page4_analyzer, "GeminiManager", MagicMock(return_value=gemini))
+
+    page4_analyzer._run_stage1_batch_blocking_task(task_ids=[1, 2], file_ids=[1, 2], model_name="m", server_port=8000)
+    assert gemini.prompt_for_json.call_count == 1
+
+    # 內容相同的文件 (11、12 的內容與 1、2 相同) 不論如何分組都直接從快取還原
+    final_states = page4_analyzer._run_stage1_batch_blocking_task(task_ids=[12, 11], file_ids=[12, 11], model_name="m", server_port=8000)
+    assert gemini.prompt_for_json.call_count == 1
+    assert Path(final_states[11]["stage1_json_path"]).read_text(encoding="utf-8") == '{"title":"文章1"}'
+
+    # 只有未命中快取的文件會送出分析
+    page4_analyzer._run_stage1_batch_blocking_task(task_ids=[21, 3], file_ids=[21, 3], model_name="m", server_port=8000)
+    assert gemini.prompt_for_json.call_count == 2
+    assert [doc["id"] for doc in _batch_documents(gemini.prompt_for_json.call_args.kwargs["prompt"])] == [3]
+
+
+def test_stage1_batch_force_bypasses_and_replaces_cached_results(tmp_path, monkeypatch):
+    """驗證批次分析在 force 時整批重新送出 (不還原快取)，並以新結果取代各文件的快取項目。"""
+    db_client = MagicMock()
+    db_client.get_analysis_task_contents.side_effect = lambda task_ids: [[task_id, f"文章{task_id % 10}"] for task_id in task_ids]
+    monkeypatch.setattr(page4_analyzer, "DB_CLIENT", db_client)
+    monkeypatch.setattr(page4_analyzer, "TEMP_JSON_DIR", tmp_path)
+    monkeypatch.setattr(page4_analyzer.analysis_cache, "CACHE_DIR", tmp_path / "cache")
+    monkeypatch.setattr(page4_analyzer, "_get_prompts", lambda: {"stage_1_extraction_prompt": "文章：{document_text}"})
+    monkeypatch.setattr(page4_analyzer, "_get_valid_keys", lambda: [{"name": "k", "value": "v"}])
+    gemini = MagicMock()
+    gemini.prompt_for_json.side_effect = lambda prompt, model_name: (
+        [{"id": doc["id"], "version": gemini.prompt_for_json.call_count} for doc in _batch_documents(prompt)], None, "k"
+    )
+    monkeypatch.setattr(page4_analyzer, "GeminiManager", MagicMock(return_value=gemini))
+    run = lambda task_ids, force=False: page4_analyzer._run_stage1_batch_blocking_task(
+        task_ids=task_ids, file_ids=task_ids, model_name="m", server_port=8000, force=force
+    )
+
+    run([1, 2])
+    run([11, 12], force=True)
+    assert gemini.prompt_for_json.call_count == 2
+    assert [doc["id"] for doc in _batch_documents(gemini.prompt_for_json.call_args.kwargs["prompt"])] == [11, 12]
+
+    # 之後的一般分析命中的是 force 產生的新結果
+    final_states = run([21, 22])
+    assert gemini.prompt_for_json.call_count == 2
+    assert orjson.loads(Path(final_states[21]["stage1_json_path"]).read_bytes()) == {"version": 2}
+
+
+def test_stage1_batch_falls_back_without_stage1_prompt(monkeypatch):
+    """驗證提示詞庫中沒有第一階段提示詞時，改為逐一執行單檔流程 (由單檔流程記錄錯誤)。"""
+    single = MagicMock()
+    monkeypatch.setattr(page4_analyzer, "_run_stage1_blocking_task", single)
+    monkeypatch.setattr(page4_analyzer, "_get_prompts", lambda: {})
+
+    page4_analyzer._run_stage1_batch_blocking_task(task_ids=[1, 2], file_ids=[11, 12], model_name="m", server_port=8000)
+
+    assert [call.kwargs["task_id"] for call in single.call_args_list] == [1, 2]
+
+
+def test_stage1_batch_prompt_follows_user_stage1_template(monkeypatch):
+    """驗證批次提示詞保留使用者第一階段提示詞的指示 ({{ }} 還原為單一大括號)；範本缺少佔位符時整批標記失敗且不呼叫 API。"""
+    prefix = page4_analyzer._stage1_batch_prompt_prefix('只要 "topic" 欄位，格式：{{"topic": "..."}}\n{document_text}')
+    assert '只要 "topic" 欄位，格式：{"topic": "..."}' in prefix
+    assert prefix.endswith(page4_analyzer.STAGE1_BATCH_FOOTER)
+
+    db_client = MagicMock()
+    db_client.get_analysis_task_contents.return_value = [[1, "文章"], [2, "文章"]]
+    monkeypatch.setattr(page4_analyzer, "DB_CLIENT", db_client)
+    monkeypatch.setattr(page4_analyzer, "_get_prompts", lambda: {"stage_1_extraction_prompt": "沒有佔位符"})
+    gemini_factory = MagicMock()
+    monkeypatch.setattr(page4_analyzer, "GeminiManager", gemini_factory)
+
+    final_states = page4_analyzer._run_stage1_batch_blocking_task(task_ids=[1, 2], file_ids=[11, 12], model_name="m", server_port=8000)
+
+    assert {task_id: state["stage1_status"] for task_id, state in final_states.items()} == {1: "failed", 2: "failed"}
+    gemini_factory.assert_not_called()
+
+
+def test_analysis_status_queries_off_the_event_loop(monkeypatch):
+    """驗證分析狀態端點在執行緒中呼叫同步的 DBClient，不在事件迴圈執行緒上等待查詢，並以標頭告知下一頁的 offset。"""
+    threads = []
+
+    def fake_get_all_analysis_tasks(limit, offset):
+        threads.append(threading.current_thread())
+        assert (limit, offset) == (3, 100)
+        return [{"id": i, "stage1_status": "completed"} for i in range(limit)]
+
+    db_client = MagicMock()
+    db_client.get_all_analysis_tasks.side_effect = fake_get_all_analysis_tasks
+    monkeypatch.setattr(page4_analyzer, "DB_CLIENT", db_client)
+
+    loop_threads = []
+
+    async def call_endpoint():
+        loop_threads.append(threading.current_thread())
+        return await page4_analyzer.get_analysis_status(limit=2, offset=100)
+
+    response = asyncio.run(call_endpoint())
+    # 多取的一筆只用來判斷是否還有下一頁，不會回傳
+    assert orjson.loads(response.body) == [{"id": 0, "stage1_status": "completed"}, {"id": 1, "stage1_status": "completed"}]
+    assert response.headers[page4_analyzer.NEXT_OFFSET_HEADER] == "102"
+    assert threads[0] is not loop_threads[0]
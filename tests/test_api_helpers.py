@@ -0,0 +1,90 @@
+import pytest
+import sys
+from pathlib import Path
+
+# --- 測試環境路徑設定 ---
+SRC_DIR = Path(__file__).resolve().parent.parent / "src"
+if str(SRC_DIR) not in sys.path:
+    sys.path.insert(0, str(SRC_DIR))
+
+from api.api_server import read_transcript_preview, parse_last_json_line
+
+
+def test_read_transcript_preview_short_file(tmp_path):
+    """驗證短逐字稿會完整讀出且不標記為截斷。"""
+    transcript = tmp_path / "short.txt"
+    transcript.write_text("  你好，世界  \n", encoding="utf-8")
+
+    preview, truncated = read_transcript_preview(transcript)
+    assert preview == "你好，世界"
+    assert truncated is False
+
+
+def test_read_transcript_preview_truncates_on_char_boundary(tmp_path):
+    """驗證長逐字稿只讀取上限內的內容，且不會在多位元組字元中間產生亂碼。"""
+    transcript = tmp_path / "long.txt"
+    transcript.write_text("字" * 100, encoding="utf-8")  # 每個字 3 位元組
+
+    preview, truncated = read_transcript_preview(transcript, max_bytes=10)
+    assert preview == "字" * 3
+    assert truncated is True
+
+
+def test_parse_last_json_line_skips_progress_lines():
+    """驗證只解析最後一個 JSON 物件行，並忽略前面的進度輸出與結尾空行。"""
+    output = '{"type": "progress", "percent": 50}\n[download] 100%\n{"status": "completed", "output_path": "/tmp/a.mp3"}\n\n'
+    assert parse_last_json_line(output) == {"status": "completed", "output_path": "/tmp/a.mp3"}
+
+
+def test_parse_last_json_line_without_json():
+    """驗證輸出中沒有 JSON 物件時會拋出 ValueError。"""
+    with pytest.raises(ValueError):
+        parse_last_json_line("no json here\n")
+
+
+def test_connection_manager_drops_failed_connections():
+    """驗證廣播時傳送失敗的連線會被移除，且不影響其他連線接收訊息。"""
+    import asyncio
+    from unittest.mock import AsyncMock
+    from api.api_server import ConnectionManager
+
+    manager = ConnectionManager()
+    healthy, broken = AsyncMock(), AsyncMock()
+    broken.send_json.side_effect = RuntimeError("connection closed")
+    manager.active_connections.update({healthy, broken})
+
+    asyncio.run(manager.broadcast_json({"type": "PING"}))
+
+    healthy.send_json.assert_awaited_once_with({"type": "PING"})
+    assert manager.active_connections == {healthy}
+    manager.disconnect(broken)  # 重複移除不應拋出例外
+
+
+def test_submit_job_broadcasts_queued_when_workers_busy(monkeypatch):
+    """驗證背景工作名額固定 (不隨核心數縮減)，名額用盡時新工作先廣播排隊中狀態，名額釋出後再開始。"""
+    import asyncio
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    from unittest.mock import AsyncMock
+    from api import api_server
+
+    assert api_server.JOB_MAX_WORKERS == 4
+    monkeypatch.setattr(api_server, "JOB_MAX_WORKERS", 1)
+    monkeypatch.setattr(api_server, "JOB_EXECUTOR", ThreadPoolExecutor(max_workers=1))
+    broadcast = AsyncMock()
+    monkeypatch.setattr(api_server.manager, "broadcast_json", broadcast)
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        release, ran = threading.Event(), []
+        api_server._submit_job(lambda: release.wait(5), loop, {"status": "queued", "id": 1})
+        api_server._submit_job(lambda: ran.append(2), loop, {"status": "queued", "id": 2})
+        await asyncio.sleep(0.05)
+        assert [call.args[0]["id"] for call in broadcast.await_args_list] == [2]
+        assert ran == []
+        release.set()
+        await asyncio.to_thread(api_server.JOB_EXECUTOR.shutdown, True)
+        assert ran == [2]
+        assert api_server._active_jobs == 0
+
+    asyncio.run(scenario())
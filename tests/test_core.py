@@ -1,6 +1,8 @@
 # tests/test_core.py
+import os
 import pytest
 import sys
+import time
 from pathlib import Path
 from freezegun import freeze_time
 
@@ -59,3 +61,77 @@ def test_format_iso_for_filename_invalid_inputs():
 
     # 3. 無法解析的亂碼
     assert format_iso_for_filename("這不是時間") == expected_fallback_ts
+
+
+def test_default_prompts_place_variable_content_last():
+    """
+    驗證預設提示詞把文件內容放在最後，前段靜態指示在每次呼叫時逐字相同，
+    讓模型供應端的前綴快取 (implicit prompt caching) 能夠生效。
+    """
+    import json
+    prompts = json.loads((SRC_DIR / "prompts" / "default_prompts.json").read_text(encoding="utf-8"))
+
+    for key, field in [
+        ("stage_1_extraction_prompt", "document_text"),
+        ("stage_2_generation_prompt", "data_package"),
+    ]:
+        template = prompts[key]
+        first = template.format(**{field: "文件甲"})
+        second = template.format(**{field: "另一份文件乙"})
+        prefix = template[:template.index("{" + field + "}")].format()
+        assert first.startswith(prefix) and second.startswith(prefix)
+        assert template.rstrip("-\n").endswith("{" + field + "}")
+
+
+def test_write_deduplicated_links_identical_content(tmp_path, monkeypatch):
+    """驗證內容相同的輸出只寫入一次，之後的輸出檔是指向同一份資料的硬連結。"""
+    from core import analysis_cache
+    monkeypatch.setattr(analysis_cache, "CACHE_DIR", tmp_path / "cache")
+
+    first, second, other = tmp_path / "a.json", tmp_path / "b.json", tmp_path / "c.json"
+    analysis_cache.write_deduplicated(first, b'{"title": "x"}')
+    analysis_cache.write_deduplicated(second, b'{"title": "x"}')
+    analysis_cache.write_deduplicated(other, b'{"title": "y"}')
+
+    assert second.read_bytes() == b'{"title": "x"}'
+    assert first.stat().st_ino == second.stat().st_ino
+    assert other.stat().st_ino != first.stat().st_ino
+    assert len(list((tmp_path / "cache" / analysis_cache.BY_HASH_DIR_NAME).rglob("*.json"))) == 2
+
+
+def test_prune_bounds_analysis_cache(tmp_path, monkeypatch):
+    """驗證 prune 刪除過期與超出數量上限 (最久未使用) 的項目，並清除已無人連結的去除重複資料。"""
+    from core import analysis_cache
+    monkeypatch.setattr(analysis_cache, "CACHE_DIR", tmp_path / "cache")
+    now = time.time()
+
+    outputs = []
+    for index in range(4):
+        output = tmp_path / f"out{index}.json"
+        analysis_cache.write_deduplicated(output, f'{{"n": {index}}}'.encode())
+        key = analysis_cache.make_key("m", f"prompt{index}")
+        analysis_cache.store(key, output)
+        outputs.append((key, output))
+    # 0 號已過期；其餘依序越來越新，1 號最久未使用
+    for index, (key, _) in enumerate(outputs):
+        entry = analysis_cache._entry_path(key, ".json")
+        age = 40 * 24 * 60 * 60 if index == 0 else 100 - index
+        os.utime(entry, (now - age, now - age))
+    # 0 號與 1 號的輸出檔也已被刪除，其去除重複資料不再有任何連結
+    outputs[0][1].unlink()
+    outputs[1][1].unlink()
+
+    assert analysis_cache.prune(max_entries=2) == 4
+    assert [analysis_cache.restore(key, tmp_path / f"restored{index}.json") for index, (key, _) in enumerate(outputs)] == [False, False, True, True]
+    assert len(list((tmp_path / "cache" / analysis_cache.BY_HASH_DIR_NAME).rglob("*.json"))) == 2
+
+
+def test_path_setup_does_not_duplicate_sys_path_entries():
+    """驗證模組重複載入 (例如熱重載) 時，路徑修正不會在 sys.path 中累積重複的 src 目錄。"""
+    import importlib
+    from core import key_manager, prompt_manager
+
+    before = sys.path.count(str(SRC_DIR))
+    for module in (key_manager, prompt_manager, key_manager):
+        importlib.reload(module)
+    assert sys.path.count(str(SRC_DIR)) == before
@@ -0,0 +1,209 @@
+import pytest
+import sys
+from pathlib import Path
+
+# --- 測試環境路徑設定 ---
+SRC_DIR = Path(__file__).resolve().parent.parent / "src"
+if str(SRC_DIR) not in sys.path:
+    sys.path.insert(0, str(SRC_DIR))
+
+from db import database
+
+
+def test_pooled_connection_is_reused(db_conn):
+    """驗證連線池會重複使用同一條連線，且連線已套用 WAL 與 synchronous=NORMAL。"""
+    with database.pooled_connection() as first:
+        assert first.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        assert first.execute("PRAGMA synchronous").fetchone()[0] == 1  # NORMAL
+        assert first.execute("PRAGMA temp_store").fetchone()[0] == 2  # MEMORY
+
+    with database.pooled_connection() as second:
+        assert second is first
+
+
+def test_pooled_connection_rolls_back_and_follows_db_path(db_conn, tmp_path, monkeypatch):
+    """驗證歸還時會回滾未提交的交易，且切換資料庫路徑後會建立新的連線池。"""
+    with database.pooled_connection() as conn:
+        conn.execute("INSERT INTO extracted_urls (url) VALUES ('https://uncommitted.example')")
+        old_conn = conn
+
+    with database.pooled_connection() as conn:
+        assert conn.execute("SELECT count(*) FROM extracted_urls").fetchone()[0] == 0
+
+    monkeypatch.setenv("TEST_DB_PATH", str(tmp_path / "other.db"))
+    with database.pooled_connection() as conn:
+        assert conn is not old_conn
+
+    database.close_connection_pool()
+
+
+def test_read_only_pool_is_separate_and_rejects_writes(db_conn):
+    """驗證唯讀連線來自獨立的連線池、可讀到已提交的寫入，且拒絕任何寫入。"""
+    import sqlite3
+
+    with database.pooled_connection() as writer:
+        with writer:
+            writer.execute("INSERT INTO extracted_urls (url) VALUES ('https://a.example')")
+
+    with database.pooled_connection(read_only=True) as reader:
+        assert reader is not writer
+        assert reader.execute("SELECT count(*) FROM extracted_urls").fetchone()[0] == 1
+        with pytest.raises(sqlite3.OperationalError):
+            reader.execute("INSERT INTO extracted_urls (url) VALUES ('https://b.example')")
+
+    with database.pooled_connection(read_only=True) as again:
+        assert again is reader
+    with database.pooled_connection() as again:
+        assert again is writer
+
+    database.close_connection_pool()
+
+
+def test_url_status_writer_batches_updates(db_conn):
+    """驗證批次寫入器會寫入所有排入的狀態更新，且失敗的更新不會清除既有的 local_path。"""
+    from db.writer import UrlStatusWriter
+
+    with db_conn:
+        db_conn.executemany(
+            "INSERT INTO extracted_urls (url, local_path) VALUES (?, ?)",
+            [("https://a.example", None), ("https://b.example", "/tmp/old.pdf")]
+        )
+
+    writer = UrlStatusWriter(flush_interval=0.01)
+    events = [
+        writer.enqueue(1, "completed", "/tmp/a.pdf", "下載成功"),
+        writer.enqueue(2, "download_failed", None, "下載失敗"),
+    ]
+    assert all(event.wait(timeout=5) for event in events)
+
+    rows = db_conn.execute("SELECT id, status, local_path, status_message FROM extracted_urls ORDER BY id").fetchall()
+    assert [tuple(row) for row in rows] == [
+        (1, "completed", "/tmp/a.pdf", "下載成功"),
+        (2, "download_failed", "/tmp/old.pdf", "下載失敗"),
+    ]
+    database.close_connection_pool()
+
+
+def test_url_status_writer_waits_for_write_lock(db_conn):
+    """驗證寫入器以 BEGIN IMMEDIATE 取得寫入鎖：其他連線持有寫入鎖時會等待，釋放後完成寫入。"""
+    from db.writer import UrlStatusWriter
+
+    with db_conn:
+        db_conn.execute("INSERT INTO extracted_urls (url) VALUES ('https://a.example')")
+
+    db_conn.execute("BEGIN IMMEDIATE")
+    writer = UrlStatusWriter(flush_interval=0.01)
+    done = writer.enqueue(1, "completed", "/tmp/a.pdf")
+    assert not done.wait(timeout=0.3)
+    db_conn.commit()
+
+    assert done.wait(timeout=5)
+    assert db_conn.execute("SELECT status FROM extracted_urls WHERE id = 1").fetchone()[0] == "completed"
+    database.close_connection_pool()
+
+
+def test_status_listing_uses_composite_index(db_conn):
+    """驗證依狀態篩選並依建立時間排序的列表查詢會使用複合索引，且不需要額外排序。"""
+    plan = db_conn.execute(
+        "EXPLAIN QUERY PLAN SELECT id, url FROM extracted_urls WHERE status = 'pending' ORDER BY created_at DESC"
+    ).fetchall()
+    details = " ".join(row[3] for row in plan)
+    assert "idx_urls_status_created" in details
+    assert "TEMP B-TREE" not in details
+
+
+def test_analysis_task_listing_pages_by_index_without_content(db_conn):
+    """驗證分析任務列表由索引提供順序 (不需額外排序)、依新到舊分頁，且不回傳待分析的全文。"""
+    plan = db_conn.execute(
+        "EXPLAIN QUERY PLAN SELECT at.id FROM analysis_tasks at LEFT JOIN extracted_urls eu ON at.file_id = eu.id "
+        "ORDER BY at.created_at DESC, at.id DESC LIMIT 10"
+    ).fetchall()
+    details = " ".join(row[3] for row in plan)
+    assert "idx_analysis_created" in details
+    assert "TEMP B-TREE" not in details
+
+    with db_conn:
+        db_conn.executemany(
+            "INSERT INTO analysis_tasks (file_id, filename, file_content_for_analysis, created_at) VALUES (?, ?, ?, ?)",
+            [(1, "a.pdf", "全文甲", "2025-01-01"), (2, "b.pdf", "全文乙", "2025-01-02"), (3, "c.pdf", "全文丙", "2025-01-02")]
+        )
+    tasks = database.get_all_analysis_tasks(limit=2, offset=1)
+    assert [task["filename"] for task in tasks] == ["b.pdf", "a.pdf"]
+    assert "file_content_for_analysis" not in tasks[0]
+    database.close_connection_pool()
+
+
+def test_local_filename_is_maintained_by_triggers(db_conn):
+    """驗證寫入或更新 local_path 時，觸發器會同步維護 local_filename (支援 Windows 分隔符)。"""
+    with db_conn:
+        db_conn.execute("INSERT INTO extracted_urls (url, local_path) VALUES ('https://a.example', '/downloads/1_a.pdf')")
+        db_conn.execute("INSERT INTO extracted_urls (url) VALUES ('https://b.example')")
+        db_conn.execute("UPDATE extracted_urls SET local_path = 'C:\\downloads\\2_b 檔案.docx' WHERE id = 2")
+
+    rows = db_conn.execute("SELECT local_filename FROM extracted_urls ORDER BY id").fetchall()
+    assert [row[0] for row in rows] == ["1_a.pdf", "2_b 檔案.docx"]
+
+
+def test_prepare_stage1_analysis_tasks_creates_and_resets_in_batch(db_conn):
+    """驗證批次準備分析任務會沿用既有任務、建立缺少的任務，並重設兩個階段的狀態。"""
+    with db_conn:
+        db_conn.execute(
+            "INSERT INTO analysis_tasks (file_id, filename, stage1_status, stage1_json_path, stage2_status) "
+            "VALUES (1, 'a.pdf', 'completed', '/tmp/a.json', 'failed')"
+        )
+
+    task_ids = database.prepare_stage1_analysis_tasks([[2, "b.pdf"], [1, "a.pdf"], [2, "b.pdf"]])
+    assert task_ids[1] == 1
+    assert task_ids[0] == task_ids[2] != 1
+
+    rows = db_conn.execute(
+        "SELECT id, file_id, stage1_status, stage1_json_path, stage2_status FROM analysis_tasks ORDER BY id"
+    ).fetchall()
+    assert [tuple(row) for row in rows] == [
+        (1, 1, "pending", None, "pending"),
+        (task_ids[0], 2, "pending", None, "pending"),
+    ]
+    assert database.prepare_stage1_analysis_tasks([]) == []
+
+
+def test_get_analysis_task_contents_fetches_in_one_query(db_conn):
+    """驗證批次查詢以 [task_id, 內容] 配對回傳多個任務的待分析文字，找不到的任務不出現在結果中。"""
+    with db_conn:
+        db_conn.executemany(
+            "INSERT INTO analysis_tasks (file_id, filename, file_content_for_analysis) VALUES (?, ?, ?)",
+            [(1, "a.pdf", "文章甲"), (2, "b.pdf", None)]
+        )
+
+    contents = database.get_analysis_task_contents([1, 2, 99])
+    assert sorted(contents, key=lambda pair: pair[0]) == [[1, "文章甲"], [2, None]]
+    assert database.get_analysis_task_contents([]) == []
+
+
+def test_analysis_task_functions_use_connection_pool(db_conn, monkeypatch):
+    """驗證分析任務的讀寫函式向連線池借用連線，不再每次呼叫都開啟新的資料庫連線。"""
+    def fail_to_open():
+        raise AssertionError("不應開啟新的資料庫連線")
+    monkeypatch.setattr(database, "get_db_connection", fail_to_open)
+
+    task_id = database.create_or_get_analysis_task(1, "a.pdf")["id"]
+    assert database.update_analysis_task(task_id, {"stage1_status": "completed"}) is True
+    assert database.get_analysis_task(task_id)["stage1_status"] == "completed"
+    assert database.get_analysis_task_by_file_id(1)["id"] == task_id
+    assert [task["id"] for task in database.get_all_analysis_tasks()] == [task_id]
+    database.close_connection_pool()
+
+
+def test_update_analysis_tasks_updates_in_one_transaction(db_conn):
+    """驗證批次更新會在同一個交易中寫入多個任務各自的欄位，空的更新會被略過。"""
+    task_ids = database.prepare_stage1_analysis_tasks([[1, "a.pdf"], [2, "b.pdf"]])
+
+    assert database.update_analysis_tasks([
+        [task_ids[0], {"stage1_status": "completed", "stage1_json_path": "/tmp/a.json"}],
+        [task_ids[1], {"stage1_status": "failed", "stage1_error_log": "錯誤"}],
+        [99, {}],
+    ]) is True
+
+    rows = db_conn.execute("SELECT stage1_status, stage1_json_path, stage1_error_log FROM analysis_tasks ORDER BY id").fetchall()
+    assert [tuple(row) for row in rows] == [("completed", "/tmp/a.json", None), ("failed", None, "錯誤")]
+    assert database.update_analysis_tasks([]) is False
+    database.close_connection_pool()
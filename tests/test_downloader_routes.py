@@ -0,0 +1,179 @@
+import pytest
+import sys
+from pathlib import Path
+from unittest.mock import AsyncMock
+from fastapi.testclient import TestClient
+
+# --- 測試環境路徑設定 ---
+SRC_DIR = Path(__file__).resolve().parent.parent / "src"
+if str(SRC_DIR) not in sys.path:
+    sys.path.insert(0, str(SRC_DIR))
+
+from api.api_server import app
+
+
+@pytest.fixture
+def seeded_urls(db_conn):
+    """建立一筆待下載與一筆已下載完成的網址。"""
+    from api.routes import page2_downloader
+    # 每個測試使用不同的暫存資料庫，避免讀到上一個測試留下的列表快取
+    page2_downloader.invalidate_list_cache()
+    with db_conn:
+        db_conn.executemany(
+            "INSERT INTO extracted_urls (url, author, status, local_path) VALUES (?, ?, ?, ?)",
+            [
+                ("https://pending.example/a.pdf", "Alice", "pending", None),
+                ("https://done.example/b.pdf", "Bob", "completed", "/downloads/b.pdf"),
+            ]
+        )
+    return db_conn
+
+
+def test_pending_and_completed_lists(seeded_urls, tmp_path, monkeypatch):
+    """驗證待處理與已完成列表端點透過連線池正確查詢資料。"""
+    from api.routes import page3_processor
+    monkeypatch.setattr(page3_processor, "DOWNLOAD_DIR", tmp_path)
+    (tmp_path / "b.pdf").write_bytes(b"%PDF")
+
+    client = TestClient(app)
+
+    response = client.get("/api/downloader/pending_urls")
+    assert response.status_code == 200
+    assert [item["url"] for item in response.json()] == ["https://pending.example/a.pdf"]
+
+    response = client.get("/api/downloader/completed")
+    assert response.status_code == 200
+    assert [item["filename"] for item in response.json()] == ["b.pdf"]
+
+    response = client.get("/api/processor/completed_files")
+    assert response.status_code == 200
+    assert [item["filename"] for item in response.json()] == ["b.pdf"]
+
+
+def test_completed_files_skips_missing_files(seeded_urls, tmp_path, monkeypatch):
+    """驗證 /completed_files 只列出仍存在於下載目錄中的檔案。"""
+    from api.routes import page3_processor
+    monkeypatch.setattr(page3_processor, "DOWNLOAD_DIR", tmp_path / "downloads")
+    client = TestClient(app)
+
+    # 下載目錄不存在時不應出錯
+    response = client.get("/api/processor/completed_files")
+    assert response.status_code == 200
+    assert response.json() == []
+
+    (tmp_path / "downloads").mkdir()
+    (tmp_path / "downloads" / "b.pdf").write_bytes(b"%PDF")
+    response = client.get("/api/processor/completed_files")
+    assert [item["filename"] for item in response.json()] == ["b.pdf"]
+
+
+def test_completed_files_pages_are_filled_past_missing_files(db_conn, tmp_path, monkeypatch):
+    """驗證 /completed_files 略過已刪除的檔案後仍補滿一頁，並以標頭提供下一頁的 offset，逐頁取回不會漏掉任何檔案。"""
+    from api.routes import page3_processor
+    monkeypatch.setattr(page3_processor, "DOWNLOAD_DIR", tmp_path)
+    with db_conn:
+        db_conn.executemany(
+            "INSERT INTO extracted_urls (url, status, local_path, created_at) VALUES (?, 'completed', ?, ?)",
+            [(f"https://{i}.example", f"/downloads/{i}.pdf", f"2025-01-{i:02d} 00:00:00") for i in range(1, 11)]
+        )
+    # 較新的 10~5 號檔案已被刪除，只剩 4~1 號
+    for i in range(1, 5):
+        (tmp_path / f"{i}.pdf").write_bytes(b"%PDF")
+
+    client = TestClient(app)
+    first = client.get("/api/processor/completed_files", params={"limit": 2})
+    assert [item["filename"] for item in first.json()] == ["4.pdf", "3.pdf"]
+    next_offset = first.headers[page3_processor.NEXT_OFFSET_HEADER]
+    assert next_offset == "8"
+
+    second = client.get("/api/processor/completed_files", params={"limit": 2, "offset": next_offset})
+    assert [item["filename"] for item in second.json()] == ["2.pdf", "1.pdf"]
+    assert page3_processor.NEXT_OFFSET_HEADER not in second.headers
+
+
+def test_downloads_run_concurrently_within_limit(monkeypatch):
+    """驗證多個下載會並行執行，但同時進行的數量不超過 DOWNLOAD_CONCURRENCY。"""
+    import asyncio
+    import threading
+    import time
+    from api.routes import page2_downloader
+
+    lock = threading.Lock()
+    state = {"running": 0, "peak": 0, "done": 0}
+
+    def fake_download_task(url_id, url, author, message_date, message_time):
+        with lock:
+            state["running"] += 1
+            state["peak"] = max(state["peak"], state["running"])
+            state["in_flight_peak"] = max(state.get("in_flight_peak", 0), page2_downloader._downloads_in_flight)
+        time.sleep(0.05)
+        with lock:
+            state["running"] -= 1
+            state["done"] += 1
+        return "completed", {"local_path": f"/downloads/{url_id}.pdf"}
+
+    monkeypatch.setattr(page2_downloader, "run_download_task", fake_download_task)
+
+    ws_manager = AsyncMock()
+
+    async def run_all():
+        rows = [{"id": i, "url": f"https://x.example/{i}", "author": None, "message_date": None, "message_time": None} for i in range(12)]
+        await asyncio.gather(*(page2_downloader._download_one(row, ws_manager) for row in rows))
+
+    asyncio.run(run_all())
+    assert state["done"] == 12
+    assert 1 < state["peak"] <= page2_downloader.DOWNLOAD_CONCURRENCY
+    # 超出執行緒池上限的下載在池中排隊，並反映在排隊深度上
+    assert state["in_flight_peak"] == 12
+    client = TestClient(app)
+    assert client.get("/api/downloader/queue_status").json() == {
+        "workers": page2_downloader.DOWNLOAD_CONCURRENCY, "active": 0, "queued": 0
+    }
+    # 每個下載完成後都直接透過 WebSocket 管理器廣播，而非 HTTP 回呼
+    assert ws_manager.broadcast_json.await_count == 12
+    message = ws_manager.broadcast_json.await_args.args[0]
+    assert message["type"] == "DOWNLOAD_COMPLETE"
+    assert message["payload"]["status"] == "completed"
+
+
+def test_start_downloads_passes_returned_rows(seeded_urls, monkeypatch):
+    """驗證 start_downloads 以 UPDATE ... RETURNING 取得網址資訊並直接傳給下載任務。"""
+    from api.routes import page2_downloader
+
+    # 避免背景任務真的執行下載
+    monkeypatch.setattr(page2_downloader, "run_download_task", lambda *args: ("completed", {}))
+    broadcast = AsyncMock()
+    monkeypatch.setattr(app.state.manager, "broadcast_json", broadcast)
+
+    client = TestClient(app)
+    response = client.post("/api/downloader/start_downloads", json={"ids": [1, 999]})
+    assert response.status_code == 200
+
+    status = seeded_urls.execute("SELECT status FROM extracted_urls WHERE id = 1").fetchone()[0]
+    assert status == "downloading"
+
+    # 整批下載只會廣播一則 DOWNLOAD_BATCH_STARTED 訊息
+    started = [call.args[0] for call in broadcast.await_args_list if call.args[0]["type"] == "DOWNLOAD_BATCH_STARTED"]
+    assert started == [{"type": "DOWNLOAD_BATCH_STARTED", "payload": {"task_ids": ["1"]}}]
+
+
+def test_list_responses_are_cached_with_etag(seeded_urls):
+    """驗證列表回應會在 TTL 內重用快取、支援 ETag 的 304 回應，且狀態寫入後快取會失效。"""
+    from db.writer import url_status_writer
+
+    client = TestClient(app)
+    first = client.get("/api/downloader/pending_urls")
+    etag = first.headers["etag"]
+
+    # 直接改動資料庫不會經過任何失效機制，TTL 內應回傳快取內容
+    with seeded_urls:
+        seeded_urls.execute("INSERT INTO extracted_urls (url) VALUES ('https://new.example')")
+    assert client.get("/api/downloader/pending_urls").json() == first.json()
+
+    response = client.get("/api/downloader/pending_urls", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    # 批次寫入器提交後快取失效，下一次輪詢會讀到最新資料
+    assert url_status_writer.enqueue(1, "completed", "/downloads/a.pdf").wait(timeout=5)
+    urls = [item["url"] for item in client.get("/api/downloader/pending_urls").json()]
+    assert urls == ["https://new.example"]
@@ -8,12 +8,15 @@ from collections import deque
 SRC_DIR = Path(__file__).resolve().parent.parent / "src"
 sys.path.insert(0, str(SRC_DIR))
 
+from tools import gemini_manager
 from tools.gemini_manager import GeminiManager, ApiKey
 
 class TestGeminiManager(unittest.TestCase):
 
     def setUp(self):
         """為每個測試案例設定環境"""
+        # 每個測試都會替換 genai，清除模組記錄的已生效金鑰
+        gemini_manager._configured_api_key = None
         self.api_keys_data = [
             {'name': 'key_1', 'value': 'value_1'},
             {'name': 'key_2', 'value': 'value_2'},
@@ -200,5 +203,40 @@ class TestGeminiManager(unittest.TestCase):
         self.assertNotIn("models/text-embedding-004", available_models)
 
 
+    @patch('tools.gemini_manager.genai')
+    def test_prompt_helpers_return_error_and_key_name(self, mock_genai):
+        """測試：prompt_for_json 與 prompt_for_text 回傳 (結果, 錯誤, 金鑰名稱)，呼叫端可取得失敗原因"""
+        manager = GeminiManager(api_keys=self.api_keys_data)
+        error = ValueError("quota")
+        with patch.object(manager, '_api_call_wrapper', side_effect=[({"a": 1}, None, 'key_1'), (None, error, 'all_keys_failed')]):
+            self.assertEqual(manager.prompt_for_json("p", "m"), ({"a": 1}, None, 'key_1'))
+            self.assertEqual(manager.prompt_for_text("p", "m"), (None, error, 'all_keys_failed'))
+
+
+class TestConfigureApiKey(unittest.TestCase):
+
+    def setUp(self):
+        gemini_manager._configured_api_key = None
+
+    @patch('tools.gemini_manager.genai')
+    def test_configure_only_when_key_changes(self, mock_genai):
+        """測試：連續使用同一金鑰時只設定一次，換用其他金鑰時才重新設定"""
+        gemini_manager._configure_api_key('value_1')
+        gemini_manager._configure_api_key('value_1')
+        gemini_manager._configure_api_key('value_2')
+
+        self.assertEqual(mock_genai.configure.call_args_list, [call(api_key='value_1'), call(api_key='value_2')])
+
+
+class TestStripCodeFence(unittest.TestCase):
+
+    def test_strips_only_fence_wrapping_whole_response(self):
+        """測試：只移除包住整個回應的程式碼區塊圍欄，內文中的程式碼區塊保持原樣"""
+        self.assertEqual(gemini_manager._strip_code_fence('```json\n{"a": 1}\n```'), '{"a": 1}')
+        self.assertEqual(gemini_manager._strip_code_fence('  ```html\n<pre>```x```</pre>\n```\n'), '<pre>```x```</pre>')
+        self.assertEqual(gemini_manager._strip_code_fence('```\nabc\n```'), 'abc')
+        self.assertEqual(gemini_manager._strip_code_fence('<p>```code```</p>'), '<p>```code```</p>')
+
+
 if __name__ == '__main__':
     unittest.main()
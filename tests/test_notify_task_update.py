@@ -0,0 +1,50 @@
+import pytest
+import sys
+from pathlib import Path
+from unittest.mock import MagicMock, AsyncMock
+from fastapi.testclient import TestClient
+
+# --- 測試環境路徑設定 ---
+SRC_DIR = Path(__file__).resolve().parent.parent / "src"
+if str(SRC_DIR) not in sys.path:
+    sys.path.insert(0, str(SRC_DIR))
+
+from api import api_server
+
+NOTIFY_ENDPOINT = "/api/internal/notify_task_update"
+
+
+@pytest.fixture
+def mocked_server(monkeypatch):
+    """以模擬物件取代 db_client 與 WebSocket 管理器。"""
+    fake_db = MagicMock()
+    fake_db.get_task_status.return_value = {"task_id": "t1", "type": "transcribe"}
+    monkeypatch.setattr(api_server, "db_client", fake_db)
+    broadcast = AsyncMock()
+    monkeypatch.setattr(api_server.manager, "broadcast_json", broadcast)
+    return fake_db, broadcast
+
+
+def test_notify_uses_task_type_from_payload(mocked_server):
+    """驗證 payload 帶有 task_type 時，不會再向資料庫查詢任務資訊。"""
+    fake_db, broadcast = mocked_server
+    client = TestClient(api_server.app)
+    response = client.post(NOTIFY_ENDPOINT, json={"task_id": "t1", "status": "completed", "result": "{}", "task_type": "download"})
+
+    assert response.status_code == 200
+    fake_db.get_task_status.assert_not_called()
+    message = broadcast.call_args.args[0]
+    assert message["type"] == "DOWNLOAD_COMPLETE"
+
+
+def test_notify_falls_back_to_db_lookup(mocked_server):
+    """驗證舊版 Worker 未提供 task_type 時，會退回查詢資料庫決定訊息類型。"""
+    fake_db, broadcast = mocked_server
+    client = TestClient(api_server.app)
+    response = client.post(NOTIFY_ENDPOINT, json={"task_id": "t1", "status": "completed"})
+
+    assert response.status_code == 200
+    fake_db.get_task_status.assert_called_once_with("t1")
+    message = broadcast.call_args.args[0]
+    assert message["type"] == "TRANSCRIPTION_STATUS"
+    assert message["payload"]["task_type"] == "transcribe"
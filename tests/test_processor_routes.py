@@ -0,0 +1,169 @@
+import pytest
+import json
+import sqlite3
+import sys
+import threading
+import time
+from pathlib import Path
+from fastapi.testclient import TestClient
+
+# --- 測試環境路徑設定 ---
+SRC_DIR = Path(__file__).resolve().parent.parent / "src"
+if str(SRC_DIR) not in sys.path:
+    sys.path.insert(0, str(SRC_DIR))
+
+from api.api_server import app
+from api.routes import page3_processor
+
+
+def test_report_images_are_compressed_in_parallel(db_conn, monkeypatch):
+    """驗證報告中的圖片會平行壓縮，且回傳的路徑維持原本的圖片順序。"""
+    image_paths = [f"/downloads/extracted_images/img{i}.png" for i in range(4)]
+    with db_conn:
+        db_conn.execute(
+            "INSERT INTO extracted_urls (url, status, extracted_text, extracted_image_paths) VALUES (?, 'processed', ?, ?)",
+            ("https://a.example", "內文", json.dumps(image_paths))
+        )
+
+    lock = threading.Lock()
+    state = {"running": 0, "peak": 0}
+
+    def fake_compress_image(image_path, output_dir):
+        with lock:
+            state["running"] += 1
+            state["peak"] = max(state["peak"], state["running"])
+        time.sleep(0.05)
+        with lock:
+            state["running"] -= 1
+        return str(Path(output_dir) / f"{Path(image_path).stem}_compressed.jpg")
+
+    monkeypatch.setattr(page3_processor, "compress_image", fake_compress_image)
+
+    client = TestClient(app)
+    response = client.get("/api/processor/report/1")
+    assert response.status_code == 200
+    data = response.json()
+    assert data["text_content"] == "內文"
+    assert data["image_paths"] == [f"downloads/compressed_images/img{i}_compressed.jpg" for i in range(4)]
+    if page3_processor._IMAGE_POOL._max_workers > 1:
+        assert state["peak"] > 1
+
+
+def test_report_text_is_streamed_as_valid_json(db_conn, monkeypatch):
+    """驗證報告文字以小分塊串流時，多位元組字元與需跳脫的字元跨越分塊邊界仍輸出正確的 JSON。"""
+    text = '第一行 "引號" \\ 反斜線\n第二行\t中文' * 50
+    with db_conn:
+        db_conn.executemany(
+            "INSERT INTO extracted_urls (url, status, extracted_text) VALUES (?, 'processed', ?)",
+            [("https://a.example", text), ("https://b.example", None)]
+        )
+    monkeypatch.setattr(page3_processor, "REPORT_TEXT_CHUNK_SIZE", 7)
+
+    client = TestClient(app)
+    response = client.get("/api/processor/report/1")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/json"
+    assert response.json() == {"text_content": text, "image_paths": []}
+
+    response = client.get("/api/processor/report/2")
+    assert response.json() == {"text_content": page3_processor.NO_TEXT_CONTENT, "image_paths": []}
+
+    assert client.get("/api/processor/report/999").status_code == 404
+
+
+def test_report_stream_reads_snapshot_taken_before_response(db_conn, monkeypatch):
+    """驗證報告在回應開始前就開啟 blob：之後該列被改寫或刪除，串流仍輸出完整的原始內容；開啟失敗則回傳 500 而非半截 JSON。"""
+    text = "原始報告內容" * 100
+    with db_conn:
+        db_conn.execute("INSERT INTO extracted_urls (url, status, extracted_text) VALUES ('https://a.example', 'processed', ?)", (text,))
+    monkeypatch.setattr(page3_processor, "REPORT_TEXT_CHUNK_SIZE", 16)
+
+    resources, row, blob = page3_processor._open_report_snapshot(1)
+    stream = page3_processor._stream_report_json(resources, blob, [])
+    first = next(stream)
+    # 串流期間重新處理 (改寫文字) 後再刪除此列
+    with db_conn:
+        db_conn.execute("UPDATE extracted_urls SET extracted_text = 'x' WHERE id = 1")
+    with db_conn:
+        db_conn.execute("DELETE FROM extracted_urls WHERE id = 1")
+    body = first + b"".join(stream)
+    assert json.loads(body) == {"text_content": text, "image_paths": []}
+
+    def broken_snapshot(file_id):
+        raise sqlite3.OperationalError("no such rowid")
+    monkeypatch.setattr(page3_processor, "_open_report_snapshot", broken_snapshot)
+    response = TestClient(app).get("/api/processor/report/1")
+    assert response.status_code == 500
+
+
+def test_wait_for_stable_file_returns_quickly_for_finished_file(tmp_path):
+    """驗證已寫入完成的檔案會在大小穩定後立即返回，空檔案則最多等待到逾時。"""
+    finished = tmp_path / "done.pdf"
+    finished.write_bytes(b"%PDF-1.4 content")
+    start = time.monotonic()
+    page3_processor._wait_for_stable_file(finished)
+    assert time.monotonic() - start < 0.5
+
+    empty = tmp_path / "empty.pdf"
+    empty.touch()
+    start = time.monotonic()
+    page3_processor._wait_for_stable_file(empty, timeout=0.1)
+    assert 0.1 <= time.monotonic() - start < 0.5
+
+
+def test_process_pool_workers_do_not_rebuild_api_server():
+    """驗證處理程序池的子程序數量有上限，且 spawn 子程序重新匯入伺服器入口模組時不會匯入 api_server。"""
+    import subprocess
+    assert 1 <= page3_processor.PROCESS_POOL_MAX_WORKERS <= 4
+
+    # spawn 以 run_name="__mp_main__" 重新執行主模組，這裡以相同方式執行入口模組
+    code = (
+        "import runpy, sys; runpy.run_module('api.server_main', run_name='__mp_main__'); "
+        "print('api.api_server' in sys.modules)"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], cwd=SRC_DIR, capture_output=True, text=True, timeout=30
+    )
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == "False"
+
+
+def test_pdf_is_hashed_and_extracted_from_one_mapping(tmp_path, monkeypatch):
+    """驗證 PDF 以同一份 mmap 映射計算雜湊並解析內容，結果與直接讀檔一致。"""
+    import fitz
+    import hashlib
+
+    pdf_path = tmp_path / "report.pdf"
+    with fitz.open() as doc:
+        doc.new_page().insert_text((72, 72), "quarterly report")
+        doc.save(pdf_path)
+
+    # PDF 不應再經由檔案路徑另外讀取一次來計算雜湊
+    monkeypatch.setattr(page3_processor, "calculate_sha256", lambda path: pytest.fail("不應以路徑重新讀檔"))
+    content_data, file_hash = page3_processor._hash_and_extract(pdf_path, tmp_path / "images")
+
+    assert file_hash == hashlib.sha256(pdf_path.read_bytes()).hexdigest()
+    assert "quarterly report" in content_data["text"]
+
+
+def test_processed_list_is_paginated_newest_first(db_conn):
+    """驗證已處理列表依建立時間新到舊分頁、以標頭告知下一頁的 offset，並拒絕超出範圍的 limit。"""
+    with db_conn:
+        db_conn.executemany(
+            "INSERT INTO extracted_urls (url, local_path, status, created_at) VALUES (?, ?, 'processed', ?)",
+            [(f"https://{i}.example", f"/downloads/{i}.pdf", f"2025-01-0{i} 00:00:00") for i in range(1, 6)]
+        )
+
+    client = TestClient(app)
+    first = client.get("/api/processor/processed", params={"limit": 2})
+    second = client.get("/api/processor/processed", params={"limit": 2, "offset": 2})
+    last = client.get("/api/processor/processed", params={"limit": 2, "offset": 4})
+    assert [item["filename"] for item in first.json()] == ["5.pdf", "4.pdf"]
+    assert [item["filename"] for item in second.json()] == ["3.pdf", "2.pdf"]
+    assert [item["filename"] for item in last.json()] == ["1.pdf"]
+    # 還有下一頁時以標頭告知下一頁的 offset，最後一頁沒有此標頭
+    assert first.headers[page3_processor.NEXT_OFFSET_HEADER] == "2"
+    assert second.headers[page3_processor.NEXT_OFFSET_HEADER] == "4"
+    assert page3_processor.NEXT_OFFSET_HEADER not in last.headers
+    assert len(client.get("/api/processor/processed").json()) == 5
+    assert client.get("/api/processor/processed", params={"limit": 0}).status_code == 422
@@ -17,6 +17,7 @@ if str(SRC_DIR) not in sys.path:
 # 這些是我們想要測試的核心工具
 from tools.content_extractor import extract_content
 from tools.image_compressor import compress_image
+from tools import file_hasher
 
 # --- Pytest Fixtures (測試輔助工具) ---
 
@@ -123,3 +124,54 @@ def test_file_processing_pipeline_simulation(simulated_docx_path, temp_test_dir)
     print(f"  - 原始 DOCX: {simulated_docx_path}")
     print(f"  - 提取的圖片: {extracted_image_path} (大小: {original_size} 位元組)")
     print(f"  - 壓縮後圖片: {compressed_path} (大小: {compressed_size} 位元組)")
+
+
+def test_calculate_sha256_matches_hashlib(tmp_path, monkeypatch):
+    """驗證一般路徑與大檔案的 mmap 路徑都產生與 hashlib 相同的雜湊值。"""
+    import hashlib
+
+    data = os.urandom(300_000)
+    target = tmp_path / "payload.bin"
+    target.write_bytes(data)
+    expected = hashlib.sha256(data).hexdigest()
+
+    assert file_hasher.calculate_sha256(target) == expected
+
+    # 調低門檻以走 mmap 分支
+    monkeypatch.setattr(file_hasher, "MMAP_THRESHOLD", 1024)
+    assert file_hasher.calculate_sha256(target) == expected
+
+    assert file_hasher.calculate_sha256(tmp_path / "missing.bin") is None
+
+
+def test_compress_image_downscales_large_jpeg(tmp_path):
+    """驗證大張 JPEG 經解碼時縮小 (draft) 後，輸出仍精確縮放到目標寬度並維持長寬比。"""
+    source = tmp_path / "large.jpg"
+    Image.effect_noise((3200, 2400), 60).convert("RGB").save(source, quality=95)
+
+    output = compress_image(str(source), str(tmp_path / "out"), target_width=800)
+    assert output is not None
+    with Image.open(output) as img:
+        assert img.size == (800, 600)
+        assert img.format == "JPEG"
+
+
+def test_compress_image_reuses_result_for_same_content(tmp_path, monkeypatch):
+    """驗證內容相同的圖片 (即使路徑不同) 只會壓縮一次，之後直接回傳既有的輸出檔案。"""
+    from tools import image_compressor
+
+    first = tmp_path / "a.png"
+    Image.effect_noise((1200, 900), 60).convert("RGB").save(first)
+    second = tmp_path / "copy_of_a.png"
+    second.write_bytes(first.read_bytes())
+    output_dir = tmp_path / "out"
+
+    output = compress_image(str(first), str(output_dir))
+    assert output is not None
+
+    # 快取命中時不應再開啟圖片進行壓縮
+    def fail_open(*args, **kwargs):
+        raise AssertionError("不應重新壓縮")
+    monkeypatch.setattr(image_compressor.Image, "open", fail_open)
+    assert compress_image(str(second), str(output_dir)) == output
+    assert list(output_dir.iterdir()) == [Path(output)]
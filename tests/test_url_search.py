@@ -0,0 +1,73 @@
+import sys
+from pathlib import Path
+from fastapi.testclient import TestClient
+
+# --- 測試環境路徑設定 ---
+SRC_DIR = Path(__file__).resolve().parent.parent / "src"
+if str(SRC_DIR) not in sys.path:
+    sys.path.insert(0, str(SRC_DIR))
+
+from api.api_server import app
+
+SEARCH_ENDPOINT = "/api/ingestion/api/search_urls"
+
+
+def _insert_urls(conn, urls):
+    """輔助函式：直接將網址寫入 extracted_urls 資料表。"""
+    with conn:
+        conn.executemany("INSERT INTO extracted_urls (url) VALUES (?)", [(u,) for u in urls])
+
+
+def test_search_urls_uses_fts_index(db_conn):
+    """
+    驗證 FTS5 索引會隨 extracted_urls 的寫入同步更新，
+    且搜尋端點能以子字串 (含大小寫差異) 找到對應網址。
+    """
+    _insert_urls(db_conn, [
+        "https://drive.google.com/file/d/abc123/view",
+        "https://example.com/report.pdf",
+    ])
+
+    # FTS 虛擬表應已由觸發器同步
+    count = db_conn.execute("SELECT count(*) FROM extracted_urls_fts WHERE extracted_urls_fts MATCH '\"drive\"'").fetchone()[0]
+    assert count == 1
+
+    client = TestClient(app)
+    response = client.get(SEARCH_ENDPOINT, params={"q": "GOOGLE.com/file"})
+    assert response.status_code == 200
+    urls = [item["url"] for item in response.json()]
+    assert urls == ["https://drive.google.com/file/d/abc123/view"]
+
+
+def test_search_urls_short_and_special_queries(db_conn):
+    """
+    驗證少於 3 個字元的關鍵字會退回 LIKE 搜尋，
+    而包含 FTS 語法字元的關鍵字也不會造成伺服器錯誤。
+    """
+    _insert_urls(db_conn, ["https://a.io/x", "https://b.io/\"quoted\""])
+    client = TestClient(app)
+
+    response = client.get(SEARCH_ENDPOINT, params={"q": "a."})
+    assert response.status_code == 200
+    assert [item["url"] for item in response.json()] == ["https://a.io/x"]
+
+    response = client.get(SEARCH_ENDPOINT, params={"q": "\"quoted"})
+    assert response.status_code == 200
+    assert [item["url"] for item in response.json()] == ["https://b.io/\"quoted\""]
+
+
+def test_search_urls_multiple_terms(db_conn):
+    """驗證以空白分隔的多個關鍵字會以 AND 條件比對 (FTS 與 LIKE 兩條路徑皆同)。"""
+    _insert_urls(db_conn, [
+        "https://drive.google.com/file/d/abc123/view",
+        "https://drive.google.com/folders/xyz",
+        "https://example.com/file/a.pdf",
+    ])
+    client = TestClient(app)
+
+    response = client.get(SEARCH_ENDPOINT, params={"q": "drive file"})
+    assert [item["url"] for item in response.json()] == ["https://drive.google.com/file/d/abc123/view"]
+
+    # 含短詞時退回固定形狀的 LIKE 查詢
+    response = client.get(SEARCH_ENDPOINT, params={"q": "drive d/ view"})
+    assert [item["url"] for item in response.json()] == ["https://drive.google.com/file/d/abc123/view"]